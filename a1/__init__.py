@@ -16,21 +16,60 @@
 # ==================================================================================
 """
 contains the app; broken out here for ease of unit testing
+
+The app is built when a1.app is first used (PEP 562), so that the tools and modules that don't serve the REST API
+don't pay for loading connexion and the API spec. It is built once per process; a1/run.py builds it before forking
+its workers, so they share it.
 """
-import connexion
-from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+import functools
+import os
+from threading import Lock
+
+_APP = None
+_APP_LOCK = Lock()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_spec():
+    """
+    answers the parsed API spec, parsed once; libyaml's parser is several times faster than the pure python one
+    connexion would use, and the spec needs no template rendering
+    """
+    import yaml  # pylint: disable=import-outside-toplevel
+
+    with open(os.path.join(os.path.dirname(__file__), "openapi.yaml"), "rb") as f:
+        return yaml.load(f, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
+
+def _create_app():
+    # pylint: disable=import-outside-toplevel
+    import connexion
+    from prometheus_client import CollectorRegistry, generate_latest, multiprocess
+    from a1 import metrics as a1_metrics
+
+    app = connexion.App(__name__, specification_dir=".")
+    app.add_api(_load_spec())
+    a1_metrics.instrument_app(app.app)
 
+    # python decorators feel like black magic to me
+    @app.app.route('/a1-p/metrics', methods=['GET'])
+    def metrics():  # pylint: disable=unused-variable
+        # /metrics API shouldn't be visible in the API documentation,
+        # hence it's added here in the create_app step
+        # requires environment variable prometheus_multiproc_dir
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry)
 
-app = connexion.App(__name__, specification_dir=".")
-app.add_api("openapi.yaml", arguments={"title": "My Title"})
+    return app
 
 
-# python decorators feel like black magic to me
-@app.app.route('/a1-p/metrics', methods=['GET'])
-def metrics():  # pylint: disable=unused-variable
-    # /metrics API shouldn't be visible in the API documentation,
-    # hence it's added here in the create_app step
-    # requires environment variable prometheus_multiproc_dir
-    registry = CollectorRegistry()
-    multiprocess.MultiProcessCollector(registry)
-    return generate_latest(registry)
+def __getattr__(name):
+    global _APP
+    if name != "app":
+        raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+    if _APP is None:
+        with _APP_LOCK:
+            if _APP is None:
+                _APP = _create_app()
+    return _APP
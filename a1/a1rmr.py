@@ -18,15 +18,17 @@
 A1 RMR functionality
 """
 import os
+import bisect
 import queue
 import time
 import json
-import requests
-from threading import Thread
+from collections import OrderedDict
+from threading import Thread, Event
 from ricxappframe.rmr import rmr, helpers
 from mdclogpy import Logger
-from a1 import data, messages
-from a1.exceptions import PolicyTypeNotFound, PolicyInstanceNotFound
+from prometheus_client import Counter, Histogram
+from a1 import data, messages, ecs, metrics, queues, ipc
+from a1.exceptions import PolicyTypeNotFound, RmrUnavailable
 
 mdc_logger = Logger()
 mdc_logger.mdclog_format_init(configmap_monitor=True)
@@ -38,6 +40,24 @@
 # and a retry state happened often for even moderately "verbose" applications.
 # With SI95 there is still a possibility that a retry is necessary, but it is very rare.
 RETRY_TIMES = int(os.environ.get("A1_RMR_RETRY_TIMES", 4))
+# how long (ms) a receive waits for a message to arrive; this also bounds how often the loop reports it is alive
+RCV_TIMEOUT_MS = int(os.environ.get("A1_RMR_RCV_TIMEOUT_MS", 1000))
+# seconds the send thread waits before retrying after a whole send pass failed
+SEND_FAILURE_DELAY = 1
+# how many instances a policy query replay reads from SDL and encodes at a time
+REPLAY_BATCH_SIZE = int(os.environ.get("A1_REPLAY_BATCH_SIZE", 100))
+# the most messages each send queue holds in memory, 0 for no bound; what a put into a full queue does is up to
+# A1_QUEUE_FULL_POLICY, one of queues.POLICIES
+INSTANCE_SEND_QUEUE_SIZE = int(os.environ.get("A1_INSTANCE_SEND_QUEUE_SIZE", 10000))
+EI_JOB_RESULT_QUEUE_SIZE = int(os.environ.get("A1_EI_JOB_RESULT_QUEUE_SIZE", 10000))
+QUEUE_FULL_POLICY = os.environ.get("A1_QUEUE_FULL_POLICY", queues.REJECT)
+# payload capacities (bytes) of the pooled send buffers; a larger payload gets a buffer of its own, freed after the send
+SEND_BUFFER_CLASSES = (1024, 4096, 16384, 65536)
+# the most idle send buffers kept per capacity
+SEND_BUFFER_POOL_SIZE = int(os.environ.get("A1_SEND_BUFFER_POOL_SIZE", 16))
+# number of threads writing received policy statuses to SDL, and the most statuses each one holds before the loop waits for it
+STATUS_WORKERS = int(os.environ.get("A1_STATUS_WORKERS", 4))
+STATUS_QUEUE_SIZE = int(os.environ.get("A1_STATUS_QUEUE_SIZE", 1000))
 A1_POLICY_REQUEST = 20010
 A1_POLICY_RESPONSE = 20011
 A1_POLICY_QUERY = 20012
@@ -46,14 +66,245 @@
 A1_EI_CREATE_JOB = 20015
 A1_EI_CREATE_JOB_RESP = 20016
 A1_EI_DATA_DELIVERY = 20017
-ECS_SERVICE_HOST = os.environ.get("ECS_SERVICE_HOST", "http://ecs-service:8083")
-ESC_EI_TYPE_PATH = ECS_SERVICE_HOST + "/A1-EI/v1/eitypes"
-ECS_EI_JOB_PATH = ECS_SERVICE_HOST + "/A1-EI/v1/eijobs/"
+MTYPE_NAMES = {
+    A1_POLICY_REQUEST: "A1_POLICY_REQUEST",
+    A1_POLICY_RESPONSE: "A1_POLICY_RESPONSE",
+    A1_POLICY_QUERY: "A1_POLICY_QUERY",
+    A1_EI_QUERY_ALL: "A1_EI_QUERY_ALL",
+    AI_EI_QUERY_ALL_RESP: "AI_EI_QUERY_ALL_RESP",
+    A1_EI_CREATE_JOB: "A1_EI_CREATE_JOB",
+    A1_EI_CREATE_JOB_RESP: "A1_EI_CREATE_JOB_RESP",
+    A1_EI_DATA_DELIVERY: "A1_EI_DATA_DELIVERY",
+}
 
 
 # Note; yes, globals are bad, but this is a private (to this module) global
 # No other module can import/access this (well, python doesn't enforce this, but all linters will complain)
 __RMR_LOOP__ = None
+# in a process that does not own the rmr loop, the client of the process that does, see a1/run.py
+__RMR_OWNER__ = None
+
+send_latency_histogram = Histogram(
+    'A1PolicySendLatency', 'Seconds from queueing a policy instance message until RMR finished sending it',
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float("inf")),
+)
+coalesced_counter = Counter('A1CoalescedSends', 'Policy instance messages not sent because a newer one replaced them')
+# looked up once, see a1/metrics.py; message types A1 does not know are counted together so that they can't blow up the labels
+_received_counters = {mtype: metrics.rmr_received_counter.labels(mtype=name) for mtype, name in MTYPE_NAMES.items()}
+_received_other_counter = metrics.rmr_received_counter.labels(mtype="other")
+_instance_send_depth = metrics.queue_depth_gauge.labels(queue="instance_send")
+_ei_job_result_depth = metrics.queue_depth_gauge.labels(queue="ei_job_result")
+_status_update_depth = metrics.queue_depth_gauge.labels(queue="status_update")
+send_buffer_counter = Counter(
+    'A1RmrSendBuffers', 'RMR send buffers allocated, reused from the pool, freed, and payloads copied into them', ['event']
+)
+_send_buffer_counters = {event: send_buffer_counter.labels(event=event) for event in ("alloc", "reuse", "free", "copy")}
+
+
+def _coalesce(pending_operation, operation):
+    """
+    answers the one operation that leaves the handlers in the same state as pending_operation followed by operation,
+    or None if the two cancel out
+    """
+    if pending_operation == "CREATE":
+        # the handlers never heard of this instance; they still don't need to if it is gone again
+        return None if operation == "DELETE" else "CREATE"
+    if operation == "DELETE":
+        return "DELETE"
+    # the handlers have (or had) this instance; give them the latest body
+    return "UPDATE"
+
+
+class _InstanceSendQueue(queues.BoundedQueue):
+    """
+    Bounded FIFO of policy instance messages that keeps at most one pending message per
+    (policy_type_id, policy_instance_id): the newest body wins, and the operation is merged with the pending one.
+    A merged message keeps the place (and queue time) of the one it replaced, and takes no room of its own.
+    Entries are (work_item, queued_at).
+    """
+
+    def __init__(self, maxsize=0, policy=queues.REJECT):
+        self._pending = OrderedDict()  # (type id, instance id) -> ((operation, type id, instance id, payload), queued_at)
+        super().__init__("instance_send", maxsize, policy)
+
+    def _merge(self, entry):
+        work_item, _ = entry
+        key = (work_item[1], work_item[2])
+        pending = self._pending.get(key)
+        if pending is None:
+            return False
+        operation = _coalesce(pending[0][0], work_item[0])
+        if operation is None:
+            del self._pending[key]
+            coalesced_counter.inc(2)
+        else:
+            self._pending[key] = ((operation,) + tuple(work_item[1:]), pending[1])
+            coalesced_counter.inc()
+        return True
+
+    def _append(self, entry):
+        work_item, _ = entry
+        self._pending[(work_item[1], work_item[2])] = entry
+
+    def _popleft(self):
+        return self._pending.popitem(last=False)[1]
+
+    def _size(self):
+        return len(self._pending)
+
+    def _restore(self, entry):
+        work_item, queued_at = entry
+        return tuple(work_item), queued_at
+
+
+class _SendBufferPool:
+    """
+    Idle RMR send buffers, kept by payload capacity, so that sending does not allocate and free a buffer per message.
+    RMR hands back a buffer of the same capacity after a send, which goes back into the pool.
+    Only the send thread uses it.
+    """
+
+    def __init__(self, mrc, size_classes=SEND_BUFFER_CLASSES, depth=None):
+        """
+        Parameters
+        ----------
+        mrc: RMR context the buffers are allocated from
+        size_classes: tuple of int (optional)
+            ascending payload capacities of the pooled buffers
+        depth: int (optional)
+            the most idle buffers kept per capacity, default SEND_BUFFER_POOL_SIZE
+        """
+        self.mrc = mrc
+        self.size_classes = size_classes
+        self.depth = SEND_BUFFER_POOL_SIZE if depth is None else depth
+        self._idle = {size: [] for size in size_classes}
+        self.stats = {event: 0 for event in _send_buffer_counters}
+
+    def _count(self, event):
+        self.stats[event] += 1
+        _send_buffer_counters[event].inc()
+
+    def take(self, payload, mtype, sub_id):
+        """
+        answers a buffer holding payload, with a new transaction id, ready to send
+        """
+        i = bisect.bisect_left(self.size_classes, len(payload))
+        # the smallest idle buffer the payload fits in
+        idle = next((self._idle[size] for size in self.size_classes[i:] if self._idle[size]), None)
+        if idle:
+            sbuf = idle.pop()
+            self._count("reuse")
+        else:
+            sbuf = rmr.rmr_alloc_msg(self.mrc, self.size_classes[i] if i < len(self.size_classes) else len(payload))
+            self._count("alloc")
+        rmr.set_payload_and_length(payload, sbuf)
+        self._count("copy")
+        rmr.generate_and_set_transaction_id(sbuf)
+        sbuf.contents.mtype = mtype
+        sbuf.contents.sub_id = sub_id
+        return sbuf
+
+    def give(self, sbuf):
+        """
+        takes back a buffer that was sent; it is kept if there is room for it, else freed
+        """
+        i = bisect.bisect_right(self.size_classes, rmr.rmr_payload_size(sbuf)) - 1
+        if i >= 0 and len(self._idle[self.size_classes[i]]) < self.depth:
+            self._idle[self.size_classes[i]].append(sbuf)
+            return
+        rmr.rmr_free_msg(sbuf)
+        self._count("free")
+
+    def clear(self):
+        """
+        frees every idle buffer
+        """
+        for idle in self._idle.values():
+            while idle:
+                rmr.rmr_free_msg(idle.pop())
+                self._count("free")
+
+
+class _StatusWorkers:
+    """
+    Writes received policy statuses from a few threads. The statuses of one instance always go to the same
+    thread, so they are written in the order they arrived, while different instances are written in parallel.
+    Each thread writes whatever has queued up for it in one batch, see data.set_policy_instance_statuses.
+    """
+
+    def __init__(self, workers=None, maxsize=None):
+        """
+        Parameters
+        ----------
+        workers: int (optional)
+            number of threads, default STATUS_WORKERS
+        maxsize: int (optional)
+            the most statuses waiting per thread before put() blocks, default STATUS_QUEUE_SIZE;
+            this is also the most statuses written in one batch
+        """
+        maxsize = STATUS_QUEUE_SIZE if maxsize is None else maxsize
+        self._queues = [queue.Queue(maxsize) for _ in range(workers or STATUS_WORKERS)]
+        self.threads = [Thread(target=self._work, args=(q,), daemon=True) for q in self._queues]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, policy_type_id, policy_instance_id, handler_id, status):
+        """
+        queues a status on the thread of its instance; blocks while that thread is too far behind.
+        Raises TypeError if an id can't be hashed, so one malformed status can't spoil the batch it would be written in.
+        """
+        hash(handler_id)
+        partition = hash((policy_type_id, policy_instance_id)) % len(self._queues)
+        self._queues[partition].put((policy_type_id, policy_instance_id, handler_id, status))
+        _status_update_depth.inc()
+
+    def _work(self, work_queue):
+        stopping = False
+        while not stopping:
+            batch = [work_queue.get()]
+            while not work_queue.maxsize or len(batch) < work_queue.maxsize:
+                try:
+                    batch.append(work_queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = None in batch
+            statuses = [item for item in batch if item is not None]
+            try:
+                _status_update_depth.dec(len(statuses))
+                if statuses:
+                    self._write(statuses)
+            finally:
+                for _ in batch:
+                    work_queue.task_done()
+
+    @staticmethod
+    def _write(statuses):
+        try:
+            for policy_type_id, policy_instance_id in data.set_policy_instance_statuses(statuses):
+                mdc_logger.warning("Received a response for a non-existent type/instance: {0}".format((policy_type_id, policy_instance_id)))
+            mdc_logger.debug("Successfully received {0} status updates".format(len(statuses)))
+        except Exception as exc:  # pylint: disable=broad-except
+            mdc_logger.warning("Failed to write {0} statuses: {1}".format(len(statuses), repr(exc)))
+
+    def join(self):
+        """
+        waits until every queued status has been written
+        """
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def is_alive(self):
+        """
+        answers whether every thread is running
+        """
+        return all(thread.is_alive() for thread in self.threads)
+
+    def stop(self):
+        """
+        stops the threads once the statuses queued so far are written
+        """
+        for work_queue in self._queues:
+            work_queue.put(None)
 
 
 class _RmrLoop:
@@ -84,9 +335,15 @@ def __init__(self, init_func_override=None, rcv_func_override=None):
         self.last_ran = time.time()
 
         # see docs/overview#resiliency for a discussion of this
-        self.instance_send_queue = queue.Queue()  # thread safe queue https://docs.python.org/3/library/queue.html
+        self.instance_send_queue = _InstanceSendQueue(INSTANCE_SEND_QUEUE_SIZE, QUEUE_FULL_POLICY)
         # queue for data delivery item
-        self.ei_job_result_queue = queue.Queue()
+        self.ei_job_result_queue = queues.FifoQueue("ei_job_result", EI_JOB_RESULT_QUEUE_SIZE, QUEUE_FULL_POLICY)
+        # set whenever something is queued, so that the send thread wakes up right away
+        self.send_ready = Event()
+        # ei queries are answered from the ecs client's workers, see _handle_ei_query_all
+        self.ecs = ecs.EcsClient()
+        # received statuses are written to SDL from these, see loop
+        self.status_workers = _StatusWorkers()
 
         # intialize rmr context
         if init_func_override:
@@ -99,47 +356,59 @@ def __init__(self, init_func_override=None, rcv_func_override=None):
             self.mrc = rmr.rmr_init(b"4562", rmr.RMR_MAX_RCV_BYTES, rmr.RMRFL_MTCALL)
             while rmr.rmr_ready(self.mrc) == 0:
                 time.sleep(0.5)
+        self.send_buffers = _SendBufferPool(self.mrc)
 
         # set the receive function
-        self.rcv_func = (
-            rcv_func_override
-            if rcv_func_override
-            else lambda: helpers.rmr_rcvall_msgs_raw(self.mrc, [A1_POLICY_RESPONSE, A1_POLICY_QUERY, A1_EI_QUERY_ALL, A1_EI_CREATE_JOB])
-        )
-
-        # start the work loop
+        if rcv_func_override:
+            self.rcv_func = rcv_func_override
+            # an override may answer right away, so the loop paces itself instead
+            self.rcv_blocks = False
+        else:
+            # waits up to RCV_TIMEOUT_MS for the first message, so the loop handles messages as soon as they arrive
+            self.rcv_func = lambda: helpers.rmr_rcvall_msgs_raw(
+                self.mrc, [A1_POLICY_RESPONSE, A1_POLICY_QUERY, A1_EI_QUERY_ALL, A1_EI_CREATE_JOB], RCV_TIMEOUT_MS
+            )
+            self.rcv_blocks = True
+
+        # start the send thread and the work loop
+        self.send_thread = Thread(target=self.send_loop)
+        self.send_thread.start()
         self.thread = Thread(target=self.loop)
         self.thread.start()
 
-    def _assert_good_send(self, sbuf, pre_send_summary):
+    def stop(self):
+        """
+        stops both loops and waits for them, so that no buffer is sent or freed once this returns
+        """
+        self.keep_going = False
+        self.send_ready.set()
+        self.ecs.shutdown()
+        self.send_thread.join()
+        self.thread.join()
+
+    def _log_failed_send(self, func, sbuf, attempts):
         """
-        Extracts the send result and logs a detailed warning if the send failed.
-        Returns the message state, an integer that indicates the result.
+        Logs a detailed warning about a send that failed for good.
+        This is the only place a message summary is built, so successful sends never pay for one.
         """
-        post_send_summary = rmr.message_summary(sbuf)
-        if post_send_summary[rmr.RMR_MS_MSG_STATE] != rmr.RMR_OK:
-            mdc_logger.warning("RMR send failed; pre-send summary: {0}, post-send summary: {1}".format(pre_send_summary, post_send_summary))
-        return post_send_summary[rmr.RMR_MS_MSG_STATE]
+        mdc_logger.warning("{0}: failed after {1} attempts: {2}".format(func, attempts, rmr.message_summary(sbuf)))
 
     def _send_msg(self, pay, mtype, subid):
         """
-        Creates and sends a message via RMR's send-message feature with the specified payload
-        using the specified message type and subscription ID.
+        Sends a message via RMR's send-message feature with the specified payload
+        using the specified message type and subscription ID, in a buffer from the pool.
         """
-        sbuf = rmr.rmr_alloc_msg(self.mrc, len(pay), payload=pay, gen_transaction_id=True, mtype=mtype, sub_id=subid)
-        sbuf.contents.sub_id = subid
-        pre_send_summary = rmr.message_summary(sbuf)
-        for _ in range(0, RETRY_TIMES):
-            mdc_logger.debug("_send_msg: sending: {}".format(pre_send_summary))
+        sbuf = self.send_buffers.take(pay, mtype, subid)
+        for attempts in range(1, RETRY_TIMES + 1):
             sbuf = rmr.rmr_send_msg(self.mrc, sbuf)
-            msg_state = self._assert_good_send(sbuf, pre_send_summary)
-            mdc_logger.debug("_send_msg: result message state: {}".format(msg_state))
+            msg_state = sbuf.contents.state
             if msg_state != rmr.RMR_ERR_RETRY:
                 break
 
-        rmr.rmr_free_msg(sbuf)
         if msg_state != rmr.RMR_OK:
-            mdc_logger.warning("_send_msg: failed after {} retries".format(RETRY_TIMES))
+            self._log_failed_send("_send_msg", sbuf, attempts)
+        self.send_buffers.give(sbuf)
+        metrics.observe_rmr_send("send", MTYPE_NAMES.get(mtype, "other"), attempts, msg_state == rmr.RMR_OK)
 
     def _rts_msg(self, pay, sbuf_rts, mtype):
         """
@@ -147,75 +416,166 @@ def _rts_msg(self, pay, sbuf_rts, mtype):
         This neither allocates nor frees a message buffer because we may rts many times.
         Returns the message buffer from the RTS function, which may reallocate it.
         """
-        pre_send_summary = rmr.message_summary(sbuf_rts)
-        for _ in range(0, RETRY_TIMES):
-            mdc_logger.debug("_rts_msg: sending: {}".format(pre_send_summary))
+        for attempts in range(1, RETRY_TIMES + 1):
             sbuf_rts = rmr.rmr_rts_msg(self.mrc, sbuf_rts, payload=pay, mtype=mtype)
-            msg_state = self._assert_good_send(sbuf_rts, pre_send_summary)
-            mdc_logger.debug("_rts_msg: result message state: {}".format(msg_state))
+            msg_state = sbuf_rts.contents.state
             if msg_state != rmr.RMR_ERR_RETRY:
                 break
 
+        metrics.observe_rmr_send("rts", MTYPE_NAMES.get(mtype, "other"), attempts, msg_state == rmr.RMR_OK)
         if msg_state != rmr.RMR_OK:
-            mdc_logger.warning("_rts_msg: failed after {} retries".format(RETRY_TIMES))
+            self._log_failed_send("_rts_msg", sbuf_rts, attempts)
         return sbuf_rts  # in some cases rts may return a new sbuf
 
+    def _send_instance(self, work_item, queued_at):
+        operation, policy_type_id, policy_instance_id, instance = work_item
+        if operation == "DELETE":
+            encoded = messages.dumps(instance)
+        else:
+            encoded = data.encode_policy_instance(policy_type_id, policy_instance_id, instance)
+        payload = messages.a1_to_handler_bytes(operation, policy_type_id, policy_instance_id, encoded)
+        self._send_msg(payload, A1_POLICY_REQUEST, policy_type_id)
+        send_latency_histogram.observe(time.time() - queued_at)
+
+    def _send_ei_job_result(self, work_item):
+        mdc_logger.debug("perform data delivery to consumer")
+        payload = messages.dumps(messages.ei_to_handler(*work_item))
+        ei_job_id = int(work_item[0])
+        mdc_logger.debug("data-delivery: {}".format(payload))
+
+        # send the payload to consumer subscribed for ei_job_id
+        self._send_msg(payload, A1_EI_DATA_DELIVERY, ei_job_id)
+
     def _handle_sends(self):
-        # send out all messages waiting for us
-        while not self.instance_send_queue.empty():
-            work_item = self.instance_send_queue.get(block=False, timeout=None)
-            payload = json.dumps(messages.a1_to_handler(*work_item)).encode("utf-8")
-            self._send_msg(payload, A1_POLICY_REQUEST, work_item[1])
+        """
+        sends out all messages waiting for us; a message that can't be sent (eg a bad payload, or no buffer to put it in)
+        is logged and dropped, so that it does not hold up the others
+        """
+        while True:
+            try:
+                work_item, queued_at = self.instance_send_queue.get(block=False, timeout=None)
+            except queue.Empty:  # also when spilled messages could not be read back yet
+                break
+            try:
+                self._send_instance(work_item, queued_at)
+            except Exception as exc:  # pylint: disable=broad-except
+                mdc_logger.error("Dropping policy message {0} that could not be sent: {1}".format(work_item[:3], repr(exc)))
+        _instance_send_depth.set(self.instance_send_queue.qsize())
 
         # now send all the ei-job related data
-        while not self.ei_job_result_queue.empty():
-            mdc_logger.debug("perform data delivery to consumer")
+        while True:
+            try:
+                work_item = self.ei_job_result_queue.get(block=False, timeout=None)
+            except queue.Empty:
+                break
+            try:
+                self._send_ei_job_result(work_item)
+            except Exception as exc:  # pylint: disable=broad-except
+                mdc_logger.error("Dropping EI job result {0} that could not be sent: {1}".format(work_item[0], repr(exc)))
+        _ei_job_result_depth.set(self.ei_job_result_queue.qsize())
 
-            work_item = self.ei_job_result_queue.get(block=False, timeout=None)
-            payload = json.dumps(messages.ei_to_handler(*work_item)).encode("utf-8")
-            ei_job_id = int(work_item[0])
-            mdc_logger.debug("data-delivery: {}".format(payload))
+    def _handle_ei_query_all(self, msg, sbuf):  # pylint: disable=unused-argument
+        """
+        query A1-EI co-ordinator service to get the EI-types, and send the complete list to the xApp;
+        runs on an ecs worker and frees the sbuf
+        """
+        # only EI messages need requests, so it is not imported until one arrives, see ecs.EcsClient.session
+        import requests  # pylint: disable=import-outside-toplevel
+
+        try:
+            resp = self.ecs.get_ei_types()
+            if resp.status_code != 200:
+                mdc_logger.warning("Received no reponse from A1-EI service")
+            mdc_logger.debug("response from A1-EI service : {0}".format(resp.text))
+            sbuf = self._rts_msg(resp.content, sbuf, AI_EI_QUERY_ALL_RESP)
+        except requests.exceptions.RequestException as exc:
+            mdc_logger.warning("Failed to query EI types from A1-EI service: {0}".format(repr(exc)))
+        finally:
+            rmr.rmr_free_msg(sbuf)
+
+    def _handle_ei_create_job(self, msg, sbuf):
+        """
+        send request to A1-EI Service to create A1-EI JOB, and inform the xApp of the job status;
+        runs on an ecs worker and frees the sbuf
+        """
+        import requests  # pylint: disable=import-outside-toplevel
+
+        try:
+            payload = json.loads(msg[rmr.RMR_MS_PAYLOAD])
+            mdc_logger.debug("Payload: {0}".format(payload))
+
+            uuidStr = payload["job-id"]
+            del payload["job-id"]
+
+            mdc_logger.debug("Payload after removing job-id: {0}".format(payload))
+
+            r = self.ecs.create_ei_job(uuidStr, payload)
+            if (r.status_code != 201) and (r.status_code != 200):
+                mdc_logger.warning("failed to create EIJOB : {0}".format(r))
+            else:
+                mdc_logger.debug("received successful response (ei-job-id) :{0}".format(uuidStr))
+                rmr_data = """{{
+                        "ei_job_id": "{id}"
+                        }}""".format(id=uuidStr)
+                mdc_logger.debug("rmr_Data to send: {0}".format(rmr_data))
+                sbuf = self._rts_msg(str.encode(rmr_data), sbuf, A1_EI_CREATE_JOB_RESP)
+        except (KeyError, TypeError, json.decoder.JSONDecodeError):
+            mdc_logger.warning("Dropping malformed EI job request: {0}".format(msg))
+        except requests.exceptions.RequestException as exc:
+            mdc_logger.warning("Failed to create EIJOB {0}".format(repr(exc)))
+        finally:
+            rmr.rmr_free_msg(sbuf)
+
+    def send_loop(self):
+        """
+        This loop runs forever, sending out any messages that have to go out (create instance, delete instance, ei data delivery)
+        as soon as they are queued.
 
-            # send the payload to consumer subscribed for ei_job_id
-            self._send_msg(payload, A1_EI_DATA_DELIVERY, ei_job_id)
+        Sends have their own thread because under SI95 a send may block for some arbitrary period of time on the first send
+        to an endpoint for which a connection is not established. If that blocked the work loop, the healthcheck would fail,
+        which will cause Kubernetes to whack A1 and all kinds of horrible things happen.
+        """
+        mdc_logger.debug("Send loop starting")
+        while self.keep_going:
+            # the timeout only matters for noticing that we should stop
+            self.send_ready.wait(timeout=1)
+            # clear before draining; anything queued from here on sets it again
+            self.send_ready.clear()
+            try:
+                self._handle_sends()
+            except Exception as exc:  # pylint: disable=broad-except
+                # eg SDL failing to read back spilled messages; this thread is the only sender, so it must keep going
+                mdc_logger.error("Send pass failed, retrying: {0}".format(repr(exc)))
+                time.sleep(SEND_FAILURE_DELAY)
+                self.send_ready.set()
+        self.send_buffers.clear()
 
     def loop(self):
         """
-        This loop runs forever, and has 3 jobs:
-        - send out any messages that have to go out (create instance, delete instance)
-        - read a1s mailbox and update the status of all instances based on acks from downstream policy handlers
-        - clean up the database (eg delete the instance) under certain conditions based on those statuses (NOT DONE YET)
+        This loop runs forever, and has 2 jobs:
+        - read a1s mailbox and hand the acks from downstream policy handlers to the status workers, which update the status of the instances
+        - answer policy queries from xapps, and hand ei queries and ei job creation to the ecs workers
         """
         # loop forever
         mdc_logger.debug("Work loop starting")
         while self.keep_going:
 
-            # Update 3/20/2020
-            # We now handle our sends in a thread (that will just exit when it's done) because there is a difference between how send works in SI95 vs NNG.
-            # Send_msg via NNG formerly never blocked.
-            # However under SI95 this send may block for some arbitrary period of time on the first send to an endpoint for which a connection is not established
-            # If this send takes too long, this loop blocks, and the healthcheck will fail, which will cause A1s healthcheck to fail, which will cause Kubernetes to whack A1 and all kinds of horrible things happen.
-            # Therefore, now under SI95, we thread this.
-            Thread(target=self._handle_sends).start()
-
             # read our mailbox
-            for (msg, sbuf) in self.rcv_func():
+            msgs = self.rcv_func()
+            started = time.perf_counter()
+            for (msg, sbuf) in msgs:
                 # TODO: in the future we may also have to catch SDL errors
                 try:
                     mtype = msg[rmr.RMR_MS_MSG_TYPE]
+                    _received_counters.get(mtype, _received_other_counter).inc()
                 except (KeyError, TypeError, json.decoder.JSONDecodeError):
                     mdc_logger.warning("Dropping malformed message: {0}".format(msg))
 
                 if mtype == A1_POLICY_RESPONSE:
                     try:
-                        # got a policy response, update status
+                        # got a policy response; a status worker updates the status, the sbuf is freed below as the payload is parsed already
                         pay = json.loads(msg[rmr.RMR_MS_PAYLOAD])
-                        data.set_policy_instance_status(
-                            pay["policy_type_id"], pay["policy_instance_id"], pay["handler_id"], pay["status"]
-                        )
-                        mdc_logger.debug("Successfully received status update: {0}".format(pay))
-                    except (PolicyTypeNotFound, PolicyInstanceNotFound):
-                        mdc_logger.warning("Received a response for a non-existent type/instance: {0}".format(msg))
+                        self.status_workers.put(pay["policy_type_id"], pay["policy_instance_id"], pay["handler_id"], pay["status"])
                     except (KeyError, TypeError, json.decoder.JSONDecodeError):
                         mdc_logger.warning("Dropping malformed policy response: {0}".format(msg))
 
@@ -223,62 +583,37 @@ def loop(self):
                     try:
                         # got a query, do a lookup and send out all instances
                         pti = json.loads(msg[rmr.RMR_MS_PAYLOAD])["policy_type_id"]
-                        instance_list = data.get_instance_list(pti)  # will raise if a bad type
+                        batches = data.get_encoded_instances_in_batches(pti, REPLAY_BATCH_SIZE)  # will raise if a bad type
                         mdc_logger.debug("Received a query for a known policy type: {0}".format(msg))
-                        for pii in instance_list:
-                            instance = data.get_policy_instance(pti, pii)
-                            payload = json.dumps(messages.a1_to_handler("CREATE", pti, pii, instance)).encode("utf-8")
-                            sbuf = self._rts_msg(payload, sbuf, A1_POLICY_REQUEST)
+                        for batch in batches:
+                            payloads = [messages.a1_to_handler_bytes("CREATE", pti, pii, encoded) for pii, encoded in batch]
+                            for payload in payloads:
+                                sbuf = self._rts_msg(payload, sbuf, A1_POLICY_REQUEST)
                     except (PolicyTypeNotFound):
                         mdc_logger.warning("Received a policy query for a non-existent type: {0}".format(msg))
                     except (KeyError, TypeError, json.decoder.JSONDecodeError):
                         mdc_logger.warning("Dropping malformed policy query: {0}".format(msg))
 
-                elif mtype == A1_EI_QUERY_ALL:
-                    mdc_logger.debug("Received messaage {0}".format(msg))
-
-                    # query A1-EI co-ordinator service to get the EI-types
-                    resp = requests.get(ESC_EI_TYPE_PATH)
-                    if resp.status_code != 200:
-                        mdc_logger.warning("Received no reponse from A1-EI service")
-
-                    mdc_logger.debug("response from A1-EI service : {0}".format(resp.json()))
-
-                    # send the complete list of EI-types to xApp
-                    sbuf = self._rts_msg(resp.content, sbuf, AI_EI_QUERY_ALL_RESP)
-
-                elif mtype == A1_EI_CREATE_JOB:
+                elif mtype in (A1_EI_QUERY_ALL, A1_EI_CREATE_JOB):
                     mdc_logger.debug("Received message {0}".format(msg))
-                    payload = json.loads(msg[rmr.RMR_MS_PAYLOAD])
-                    mdc_logger.debug("Payload: {0}".format(payload))
-
-                    uuidStr = payload["job-id"]
-                    del payload["job-id"]
-
-                    mdc_logger.debug("Payload after removing job-id: {0}".format(payload))
-
-                    # 1. send request to A1-EI Service to create A1-EI JOB
-                    headers = {'Content-type': 'application/json'}
-                    r = requests.put(ECS_EI_JOB_PATH + uuidStr, data=json.dumps(payload), headers=headers)
-                    if (r.status_code != 201) and (r.status_code != 200):
-                        mdc_logger.warning("failed to create EIJOB : {0}".format(r))
-                    else:
-                        # 2. inform xApp for Job status
-                        mdc_logger.debug("received successful response (ei-job-id) :{0}".format(uuidStr))
-                        rmr_data = """{{
-                                "ei_job_id": "{id}"
-                                }}""".format(id=uuidStr)
-                        mdc_logger.debug("rmr_Data to send: {0}".format(rmr_data))
-                        sbuf = self._rts_msg(str.encode(rmr_data), sbuf, A1_EI_CREATE_JOB_RESP)
+                    handler = self._handle_ei_query_all if mtype == A1_EI_QUERY_ALL else self._handle_ei_create_job
+                    # the worker answers and frees the sbuf
+                    if self.ecs.submit(handler, msg, sbuf):
+                        continue
+                    mdc_logger.warning("Dropping EI message, too many ECS requests are pending: {0}".format(msg))
 
                 else:
                     mdc_logger.warning("Received message type {0} but A1 does not handle this".format(mtype))
 
                 # we must free each sbuf
                 rmr.rmr_free_msg(sbuf)
+            if msgs:
+                metrics.rmr_loop_histogram.observe(time.perf_counter() - started)
             self.last_ran = time.time()
-            time.sleep(1)
+            if not self.rcv_blocks:
+                time.sleep(1)
 
+        self.status_workers.stop()
         mdc_logger.debug("RMR Thread Ending!")
 
 
@@ -306,34 +641,109 @@ def start_rmr_thread(init_func_override=None, rcv_func_override=None):
 
 def stop_rmr_thread():
     """
-    stops the rmr thread
+    stops the rmr thread, and waits for it
+    """
+    __RMR_LOOP__.stop()
+
+
+def serve_rmr_workers(path):
+    """
+    lets other processes (see connect_rmr_owner) queue sends on, and health check, the rmr thread of this one;
+    answers the ipc.Server
     """
-    __RMR_LOOP__.keep_going = False
+    return ipc.Server(path, {
+        "check_instance_send_room": check_instance_send_room,
+        "queue_instance_sends": lambda items: queue_instance_sends([tuple(i) for i in items]),
+        "queue_ei_job_result": lambda item: queue_ei_job_result(tuple(item)),
+        "healthcheck_rmr_thread": healthcheck_rmr_thread,
+    })
+
+
+def connect_rmr_owner(path):
+    """
+    for a process without an rmr thread: hand sends and health checks to the process serving them at path.
+    Raises RmrUnavailable from then on whenever that process can't be reached.
+    """
+    global __RMR_OWNER__
+    __RMR_OWNER__ = ipc.Client(path)
+
+
+def check_instance_send_room(count=1):
+    """
+    raises QueueFull if the instance send queue rejects messages when full and has no room for count more
+    """
+    if __RMR_OWNER__ is not None:
+        __RMR_OWNER__.call("check_instance_send_room", count)
+        return
+    __RMR_LOOP__.instance_send_queue.check_room(count)
 
 
 def queue_instance_send(item):
     """
     push an item into the work queue
     currently the only type of work is to send out messages
+    raises QueueFull if the queue is full and rejects it
+    """
+    if __RMR_OWNER__ is not None:
+        __RMR_OWNER__.call("queue_instance_sends", [item])
+        return
+    try:
+        __RMR_LOOP__.instance_send_queue.put((item, time.time()))
+    finally:
+        _instance_send_depth.set(__RMR_LOOP__.instance_send_queue.qsize())
+    __RMR_LOOP__.send_ready.set()
+
+
+def queue_instance_sends(items):
+    """
+    push several items into the work queue, waking the send thread once
     """
-    __RMR_LOOP__.instance_send_queue.put(item)
+    if __RMR_OWNER__ is not None:
+        __RMR_OWNER__.call("queue_instance_sends", items)
+        return
+    queued_at = time.time()
+    try:
+        for item in items:
+            __RMR_LOOP__.instance_send_queue.put((item, queued_at))
+    finally:
+        _instance_send_depth.set(__RMR_LOOP__.instance_send_queue.qsize())
+        __RMR_LOOP__.send_ready.set()
 
 
 def queue_ei_job_result(item):
     """
     push an item into the ei_job_queue
+    raises QueueFull if the queue is full and rejects it
     """
+    if __RMR_OWNER__ is not None:
+        __RMR_OWNER__.call("queue_ei_job_result", item)
+        return
     mdc_logger.debug("queuing data delivery item {0}".format(item))
-    __RMR_LOOP__.ei_job_result_queue.put(item)
+    try:
+        __RMR_LOOP__.ei_job_result_queue.put(item)
+    finally:
+        _ei_job_result_depth.set(__RMR_LOOP__.ei_job_result_queue.qsize())
+    __RMR_LOOP__.send_ready.set()
 
 
 def healthcheck_rmr_thread(seconds=30):
     """
     returns a boolean representing whether the rmr loop is healthy, by checking two attributes:
-    1. is it running?,
+    1. is it (and its send thread and status workers) running?,
     2. is it stuck in a long (> seconds) loop?
+    In a process without an rmr thread, the loop of the process that owns it must be healthy and reachable.
     """
-    return __RMR_LOOP__.thread.is_alive() and ((time.time() - __RMR_LOOP__.last_ran) < seconds)
+    if __RMR_OWNER__ is not None:
+        try:
+            return __RMR_OWNER__.call("healthcheck_rmr_thread", seconds)
+        except RmrUnavailable:
+            return False
+    return (
+        __RMR_LOOP__.thread.is_alive()
+        and __RMR_LOOP__.send_thread.is_alive()
+        and __RMR_LOOP__.status_workers.is_alive()
+        and ((time.time() - __RMR_LOOP__.last_ran) < seconds)
+    )
 
 
 def replace_rcv_func(rcv_func):
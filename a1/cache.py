@@ -0,0 +1,152 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+In-process caches that can be plugged into the data layer
+"""
+import time
+from collections import OrderedDict
+from threading import Lock
+
+
+# answered by get() when a key is not cached; None can't be used because it is a legal value
+MISSING = object()
+
+
+class NoCache:
+    """
+    A cache that never holds anything; used when caching is disabled
+    """
+
+    generation = 0
+
+    def get(self, _key):
+        """always a miss"""
+        return MISSING
+
+    def put(self, _key, _value):
+        """nothing to do"""
+
+    def fill(self, _key, _value, _generation):
+        """nothing to do"""
+
+    def invalidate(self, _key):
+        """nothing to do"""
+
+    def clear(self):
+        """nothing to do"""
+
+    def __len__(self):
+        return 0
+
+
+class LruCache:
+    """
+    A thread safe LRU cache whose entries also expire after ttl seconds.
+
+    Writers call put() with the value they just wrote (write-through).
+    Readers that miss call fill() with the value they just read, passing the generation
+    they saw *before* the read; if a write or invalidation of the same key happened in between, the fill is dropped,
+    because the value read may be older than it. Fills of other keys are not affected.
+    The generation at which keys last changed is kept for the maxsize most recently changed keys;
+    a fill that started before a key was forgotten from there is dropped too, as is one that started before a clear().
+    """
+
+    def __init__(self, maxsize, ttl):
+        """
+        Parameters
+        ----------
+        maxsize: int
+            maximum number of entries; the least recently used entry is evicted beyond that
+        ttl: float
+            seconds after which an entry is considered stale; 0 means entries never expire
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._entries = OrderedDict()  # key -> (expiry, value)
+        self._changed = OrderedDict()  # key -> generation of its last put or invalidation, least recent first
+        self._floor = 0  # fills that started before this generation are dropped
+        self._lock = Lock()
+
+    def get(self, key):
+        """
+        answers the cached value for key, or MISSING
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            expiry, value = entry
+            if expiry is not None and expiry < time.monotonic():
+                del self._entries[key]
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def _store(self, key, value):
+        """caller must hold the lock"""
+        expiry = time.monotonic() + self.ttl if self.ttl else None
+        self._entries[key] = (expiry, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _changing(self, key):
+        """caller must hold the lock; fills of key that started before now are dropped"""
+        self.generation += 1
+        self._changed[key] = self.generation
+        self._changed.move_to_end(key)
+        while len(self._changed) > self.maxsize:
+            self._floor = self._changed.popitem(last=False)[1]
+
+    def put(self, key, value):
+        """
+        cache a value that was just written; fills of the key with values read before it are dropped
+        """
+        with self._lock:
+            self._changing(key)
+            self._store(key, value)
+
+    def fill(self, key, value, generation):
+        """
+        cache a value that was just read, unless a write or an invalidation of the key raced with the read
+        """
+        with self._lock:
+            if generation >= self._floor and self._changed.get(key, 0) <= generation:
+                self._store(key, value)
+
+    def invalidate(self, key):
+        """
+        drop a key, eg because it was changed or deleted elsewhere
+        """
+        with self._lock:
+            self._changing(key)
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """
+        drop everything, and every fill under way
+        """
+        with self._lock:
+            self.generation += 1
+            self._floor = self.generation
+            self._changed.clear()
+            self._entries.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
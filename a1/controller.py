@@ -17,13 +17,18 @@
 """
 Main a1 controller
 """
-from jsonschema import validate
-from jsonschema.exceptions import ValidationError
+import base64
+import binascii
+import json
+import os
+from jsonschema.exceptions import ValidationError, SchemaError
 import connexion
+import flask
 from prometheus_client import Counter
 from mdclogpy import Logger
 from ricsdl.exceptions import RejectedByBackend, NotConnected, BackendError
-from a1 import a1rmr, exceptions, data
+from a1 import a1rmr, exceptions, data, messages, validation, warmup
+from a1.cache import LruCache, NoCache, MISSING
 
 
 mdc_logger = Logger(name=__name__)
@@ -31,6 +36,22 @@
 
 a1_counters = Counter('A1Policy', 'Policy type and instance counters', ['counter'])
 
+# the most instances one bulk request may put and delete
+BULK_MAX_ITEMS = int(os.environ.get("A1_BULK_MAX_ITEMS", 1000))
+NDJSON = "application/x-ndjson"
+# ids per chunk of a streamed listing
+STREAM_CHUNK_SIZE = 1000
+# answered when a send queue is full and rejects work, see A1_QUEUE_FULL_POLICY in a1/a1rmr.py; 503 or 429
+QUEUE_FULL_STATUS = int(os.environ.get("A1_QUEUE_FULL_STATUS", 503))
+# seconds a client told to slow down should wait before retrying
+QUEUE_FULL_RETRY_AFTER = 1
+# number of serialized type, instance and status bodies kept, by path and version; 0 disables keeping them
+RESPONSE_CACHE_SIZE = int(os.environ.get("A1_RESPONSE_CACHE_SIZE", 1000))
+
+response_cache_counters = Counter('A1ResponseCache', 'Versioned GET responses served from the response cache (hit), serialized (miss) or answered 304 (not_modified)', ['result'])
+
+_RESPONSES = LruCache(RESPONSE_CACHE_SIZE, 0) if RESPONSE_CACHE_SIZE > 0 else NoCache()
+
 
 def _log_build_http_resp(exception, http_resp_code):
     """
@@ -47,10 +68,19 @@ def _try_func_return(func):
     """
     try:
         return func()
-    except (ValidationError, exceptions.PolicyTypeAlreadyExists, exceptions.PolicyTypeIdMismatch, exceptions.CantDeleteNonEmptyType) as exc:
+    except (ValidationError, SchemaError, exceptions.PolicyTypeAlreadyExists, exceptions.PolicyTypeIdMismatch, exceptions.CantDeleteNonEmptyType, exceptions.InvalidCursor) as exc:
         return _log_build_http_resp(exc, 400)
     except (exceptions.PolicyTypeNotFound, exceptions.PolicyInstanceNotFound) as exc:
         return _log_build_http_resp(exc, 404)
+    except exceptions.BulkRequestTooLarge as exc:
+        return _log_build_http_resp(exc, 413)
+    except exceptions.QueueFull as exc:
+        # tell the client to slow down rather than buffer without bound
+        msg, code = _log_build_http_resp(exc, QUEUE_FULL_STATUS)
+        return msg, code, {"Retry-After": str(QUEUE_FULL_RETRY_AFTER)}
+    except exceptions.RmrUnavailable as exc:
+        # another process of this A1 owns RMR, and it is restarting
+        return _log_build_http_resp(exc, 503)
     except (RejectedByBackend, NotConnected, BackendError) as exc:
         """
         These are SDL errors. At the time of development here, we do not have a good understanding
@@ -65,6 +95,94 @@ def _try_func_return(func):
     # let other types of unexpected exceptions blow up and log
 
 
+def _encode_cursor(after):
+    """
+    the cursor handed to clients is opaque, so that its format may change
+    """
+    return base64.urlsafe_b64encode(json.dumps(after).encode("utf-8")).decode("ascii")
+
+
+def _decode_cursor(cursor, id_type):
+    """
+    answers the id a cursor continues after, or None for no cursor; raises InvalidCursor for a cursor of another listing
+    """
+    if cursor is None:
+        return None
+    try:
+        after = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, binascii.Error) as exc:
+        raise exceptions.InvalidCursor(cursor) from exc
+    if not isinstance(after, id_type) or isinstance(after, bool):
+        raise exceptions.InvalidCursor(cursor)
+    return after
+
+
+def _stream_ids(ids):
+    for start in range(0, len(ids), STREAM_CHUNK_SIZE):
+        yield "".join(json.dumps(i) + "\n" for i in ids[start:start + STREAM_CHUNK_SIZE])
+
+
+def _id_list_response(ids, next_after):
+    """
+    answers a page of ids as a json array, or as newline delimited json streamed in chunks if the client accepts that;
+    X-Next-Cursor is set unless this is the last page
+    """
+    headers = {} if next_after is None else {"X-Next-Cursor": _encode_cursor(next_after)}
+    if connexion.request.accept_mimetypes.best_match(["application/json", NDJSON]) == NDJSON:
+        return flask.Response(_stream_ids(ids), mimetype=NDJSON, headers=headers)
+    return ids, 200, headers
+
+
+def _not_modified(version):
+    """
+    answers a 304 if the client already has this version, else None
+    """
+    if not connexion.request.if_none_match.contains_weak(version):
+        return None
+    response_cache_counters.labels(result='not_modified').inc()
+    response = flask.Response(status=304)
+    response.set_etag(version)
+    return response
+
+
+def _versioned_response(peek_version, load):
+    """
+    Answers a json body with its version as ETag, or a 304 if If-None-Match has that version already.
+    peek_version() answers the current version without reading the body, or None if it can't tell;
+    load() answers (version, body). Serialized bodies are kept by path and version, so as long as a body
+    does not change, a client that polls it costs a version read, and neither reading nor serializing the body.
+    """
+    version = peek_version()
+    if version is not None:
+        response = _not_modified(version)
+        if response is not None:
+            return response
+        encoded = _RESPONSES.get((connexion.request.path, version))
+        if encoded is not MISSING:
+            response_cache_counters.labels(result='hit').inc()
+            return _json_response(encoded, version)
+
+    version, body = load()
+    response = _not_modified(version)
+    if response is not None:
+        return response
+    key = (connexion.request.path, version)
+    encoded = _RESPONSES.get(key)
+    if encoded is MISSING:
+        response_cache_counters.labels(result='miss').inc()
+        encoded = messages.dumps(body)
+        _RESPONSES.put(key, encoded)
+    else:
+        response_cache_counters.labels(result='hit').inc()
+    return _json_response(encoded, version)
+
+
+def _json_response(encoded, version):
+    response = flask.Response(encoded, mimetype="application/json")
+    response.set_etag(version)
+    return response
+
+
 # Healthcheck
 
 
@@ -85,14 +203,24 @@ def get_healthcheck():
     return "", 200
 
 
+def get_readiness():
+    """
+    Handles readiness GET
+    A1 is ready for traffic once it is healthy and has warmed up its caches, see a1.warmup
+    """
+    if not warmup.is_ready():
+        return "warming up", 503
+    return get_healthcheck()
+
+
 # Policy types
 
 
-def get_all_policy_types():
+def get_all_policy_types(limit=None, cursor=None):
     """
     Handles GET /a1-p/policytypes
     """
-    return _try_func_return(data.get_type_list)
+    return _try_func_return(lambda: _id_list_response(*data.get_type_page(limit, _decode_cursor(cursor, int))))
 
 
 def create_policy_type(policy_type_id):
@@ -113,8 +241,11 @@ def put_type_handler():
 def get_policy_type(policy_type_id):
     """
     Handles GET /a1-p/policytypes/policy_type_id
+    Conditional on If-None-Match, see _versioned_response
     """
-    return _try_func_return(lambda: data.get_policy_type(policy_type_id))
+    return _try_func_return(
+        lambda: _versioned_response(lambda: data.get_policy_type_version(policy_type_id), lambda: data.get_versioned_policy_type(policy_type_id))
+    )
 
 
 def delete_policy_type(policy_type_id):
@@ -134,18 +265,24 @@ def delete_policy_type_handler():
 # Policy instances
 
 
-def get_all_instances_for_type(policy_type_id):
+def get_all_instances_for_type(policy_type_id, limit=None, cursor=None):
     """
     Handles GET /a1-p/policytypes/policy_type_id/policies
     """
-    return _try_func_return(lambda: data.get_instance_list(policy_type_id))
+    return _try_func_return(lambda: _id_list_response(*data.get_instance_page(policy_type_id, limit, _decode_cursor(cursor, str))))
 
 
 def get_policy_instance(policy_type_id, policy_instance_id):
     """
     Handles GET /a1-p/policytypes/polidyid/policies/policy_instance_id
+    Conditional on If-None-Match, see _versioned_response
     """
-    return _try_func_return(lambda: data.get_policy_instance(policy_type_id, policy_instance_id))
+    return _try_func_return(
+        lambda: _versioned_response(
+            lambda: data.get_policy_instance_version(policy_type_id, policy_instance_id),
+            lambda: data.get_versioned_policy_instance(policy_type_id, policy_instance_id),
+        )
+    )
 
 
 def get_policy_instance_status(policy_type_id, policy_instance_id):
@@ -156,8 +293,22 @@ def get_policy_instance_status(policy_type_id, policy_instance_id):
         1. If a1 has received at least one status, and *all* received statuses are "DELETED", we blow away the instance and return a 404
         2. if a1 has received at least one status and at least one is OK, we return "IN EFFECT"
         3. "NOT IN EFFECT" otherwise (no statuses, or none are OK but not all are deleted)
+
+    Conditional on If-None-Match, see _versioned_response; the status is read in one round trip with its version anyway
+    """
+    return _try_func_return(
+        lambda: _versioned_response(lambda: None, lambda: data.get_versioned_policy_instance_status(policy_type_id, policy_instance_id))
+    )
+
+
+def get_type_statuses(policy_type_id, instance_status=None, has_been_deleted=None):
+    """
+    Handles GET /a1-p/policytypes/policy_type_id/status
+
+    Return the status of every instance of the type, by the same rules as get_policy_instance_status,
+    optionally only the instances with the given instance_status and/or has_been_deleted
     """
-    return _try_func_return(lambda: data.get_policy_instance_status(policy_type_id, policy_instance_id))
+    return _try_func_return(lambda: data.get_type_statuses(policy_type_id, instance_status, has_been_deleted))
 
 
 def create_or_replace_policy_instance(policy_type_id, policy_instance_id):
@@ -173,9 +324,11 @@ def put_instance_handler():
 
         For now, policy_type_id is used as the message type
         """
-        #  validate the PUT against the schema
-        schema = data.get_policy_type(policy_type_id)["create_schema"]
-        validate(instance=instance, schema=schema)
+        #  validate the PUT against the schema; the type is only fetched if its validator is not cached yet
+        validation.validate_instance(data.get_type_validator(policy_type_id), instance)
+
+        # refuse before storing anything if the instance could not be sent
+        a1rmr.check_instance_send_room()
 
         # store the instance
         operation = data.store_policy_instance(policy_type_id, policy_instance_id, instance)
@@ -195,6 +348,7 @@ def delete_policy_instance(policy_type_id, policy_instance_id):
     a1_counters.labels(counter='DeletePolicyInstanceReqs').inc()
 
     def delete_instance_handler():
+        a1rmr.check_instance_send_room()
         data.delete_policy_instance(policy_type_id, policy_instance_id)
 
         # queue rmr send (best effort)
@@ -205,6 +359,60 @@ def delete_instance_handler():
     return _try_func_return(delete_instance_handler)
 
 
+def bulk_policy_instances(policy_type_id):
+    """
+    Handles POST /a1-p/policytypes/policy_type_id/policies
+
+    Creates or replaces the instances under "put" and deletes the instances under "delete", answering a result per instance.
+    An item fails on its own (400 for a bad body, 404 for deleting an unknown instance) without failing the others;
+    the request fails as a whole for an unknown type (404), too many items (413) or a database error (503).
+    """
+    a1_counters.labels(counter='BulkPolicyInstanceReqs').inc()
+    body = connexion.request.json
+
+    def bulk_handler():
+        puts = body.get("put", {})
+        deletes = body.get("delete", [])
+        if len(puts) + len(deletes) > BULK_MAX_ITEMS:
+            raise exceptions.BulkRequestTooLarge("{0} items, at most {1} are allowed".format(len(puts) + len(deletes), BULK_MAX_ITEMS))
+
+        failed = {}
+        for policy_instance_id in set(puts).intersection(deletes):
+            failed[policy_instance_id] = "instance is both put and deleted"
+        errors = validation.validate_instances(data.get_type_validator(policy_type_id), {i: b for i, b in puts.items() if i not in failed})
+        failed.update((i, error.message) for i, error in errors.items())
+
+        valid_puts = {i: b for i, b in puts.items() if i not in failed}
+        valid_deletes = [i for i in deletes if i not in failed]
+        # refuse before storing anything if the instances could not be sent
+        a1rmr.check_instance_send_room(len(valid_puts) + len(valid_deletes))
+        operations = data.store_policy_instances(policy_type_id, valid_puts)
+        deleted = set(data.delete_policy_instances(policy_type_id, valid_deletes))
+
+        # queue rmr sends (best effort)
+        a1rmr.queue_instance_sends(
+            [(operations[i], policy_type_id, i, puts[i]) for i in puts if i in operations]
+            + [("DELETE", policy_type_id, i, "") for i in deletes if i in deleted]
+        )
+
+        results = []
+        for policy_instance_id in puts:
+            if policy_instance_id in failed:
+                results.append({"policy_instance_id": policy_instance_id, "operation": "PUT", "status": 400, "error": failed[policy_instance_id]})
+            else:
+                results.append({"policy_instance_id": policy_instance_id, "operation": "PUT", "status": 202})
+        for policy_instance_id in deletes:
+            if policy_instance_id in failed:
+                results.append({"policy_instance_id": policy_instance_id, "operation": "DELETE", "status": 400, "error": failed[policy_instance_id]})
+            elif policy_instance_id in deleted:
+                results.append({"policy_instance_id": policy_instance_id, "operation": "DELETE", "status": 202})
+            else:
+                results.append({"policy_instance_id": policy_instance_id, "operation": "DELETE", "status": 404, "error": "no such policy instance"})
+        return {"results": results}, 200
+
+    return _try_func_return(bulk_handler)
+
+
 # data delivery
 
 
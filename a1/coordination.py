@@ -0,0 +1,241 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Coordinates the replicas of A1 that share one SDL, so that they can all serve the REST API while
+background work is done once: every replica keeps a heartbeat, the live replicas split the pending
+deletions between them by rendezvous hashing, and one of them holds a leader lease and runs the periodic jobs.
+
+Heartbeats and leases are wall clock deadlines, so replicas need reasonably synchronized clocks;
+a replica whose heartbeat has expired is no longer given work, and its work moves to the others.
+"""
+import hashlib
+import os
+import time
+from threading import Thread, Event
+import msgpack
+from mdclogpy import Logger
+from prometheus_client import Gauge
+from a1 import data
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+# seconds between heartbeats, which is also how often membership and the leader lease are checked
+HEARTBEAT_INTERVAL = float(os.environ.get("A1_HEARTBEAT_INTERVAL", 2))
+# seconds after its last heartbeat that a replica is considered gone, and its leader lease lapses
+REPLICA_TTL = float(os.environ.get("A1_REPLICA_TTL", 10))
+# seconds between rebuilds of the status aggregates by the leader; 0 disables them
+RECONCILE_INTERVAL = float(os.environ.get("A1_RECONCILE_INTERVAL", 300))
+# seconds between looks, by every replica, for the pending deletions it owns that another replica accepted; 0 disables them
+DELETION_SWEEP_INTERVAL = float(os.environ.get("A1_DELETION_SWEEP_INTERVAL", 120))
+
+REPLICA_PREFIX = "a1.replica."
+LEADER_KEY = "a1.leader"
+
+replicas_gauge = Gauge('A1Replicas', 'Live A1 replicas sharing the SDL, as last seen', multiprocess_mode='max')
+leader_gauge = Gauge('A1Leader', '1 for the replica that holds the leader lease', multiprocess_mode='livesum')
+
+# Note; yes, globals are bad, but this is a private (to this module) global
+__COORDINATOR__ = None
+
+
+def _weight(replica_id, key):
+    return hashlib.blake2b("{0}:{1}".format(replica_id, key).encode(), digest_size=8).digest()
+
+
+class Coordinator:
+    """
+    One replica's view of the others. tick() does one round of heartbeat, membership and leader lease,
+    and start() runs it every HEARTBEAT_INTERVAL seconds from a thread. Several coordinators with different
+    replica ids may share one SDL in one process, which is how they are tested.
+    """
+
+    def __init__(self, sdl=None, replica_id=None, ttl=None, clock=time.time):
+        """
+        Parameters
+        ----------
+        sdl: SDLWrapper (optional)
+            the SDL shared by the replicas; default data.SDL
+        replica_id: str (optional)
+            default data.REPLICA_ID
+        ttl: float (optional)
+            default REPLICA_TTL
+        clock: function (optional)
+            answers the time, default time.time
+        """
+        self._sdl = sdl
+        self.replica_id = replica_id or data.REPLICA_ID
+        self.ttl = ttl or REPLICA_TTL
+        self.clock = clock
+        self.members = (self.replica_id,)
+        self.is_leader = False
+        self._lease = None  # the leader record we last wrote
+        self._jobs = []  # [interval, function, leader only, next run]; a job first runs one interval after the first tick
+        self._listeners = []
+        self._stopped = Event()
+        self.thread = None
+
+    @property
+    def sdl(self):
+        return self._sdl or data.SDL
+
+    def add_job(self, func, interval, leader_only=True):
+        """
+        run func every interval seconds (every tick if 0), on the leader only unless leader_only is False
+        """
+        self._jobs.append([interval, func, leader_only, None])
+
+    def on_change(self, func):
+        """
+        call func(), with no arguments, whenever the live replicas change
+        """
+        self._listeners.append(func)
+
+    def owns(self, key):
+        """
+        answers whether this replica does the work for key; every key is owned by exactly one live replica
+        """
+        members = self.members
+        return max(members, key=lambda r: _weight(r, key)) == self.replica_id
+
+    def _heartbeat(self, now):
+        """
+        writes our heartbeat and answers the live replicas, and the heartbeat keys of long gone ones
+        """
+        self.sdl.set(data.A1NS, REPLICA_PREFIX + self.replica_id, now + self.ttl)
+        live, gone = {self.replica_id}, []
+        for key, alive_until in self.sdl.find_and_get(data.A1NS, REPLICA_PREFIX).items():
+            if alive_until > now:
+                live.add(key[len(REPLICA_PREFIX):])
+            elif alive_until < now - self.ttl:
+                gone.append(key)
+        return tuple(sorted(live)), gone
+
+    def _lead(self, now):
+        """
+        takes the leader lease if nobody holds it, or renews ours; answers whether we hold it.
+        The lease is only ever replaced by compare and set, so two replicas can't both take it.
+        """
+        storage = self.sdl._sdl
+        lease = msgpack.packb([self.replica_id, now + self.ttl], use_bin_type=True)
+        current = storage.get(data.A1NS, {LEADER_KEY}).get(LEADER_KEY)
+        if current is None:
+            taken = storage.set_if_not_exists(data.A1NS, LEADER_KEY, lease)
+        else:
+            holder, until = msgpack.unpackb(current, raw=False)
+            taken = (holder == self.replica_id or until <= now) and storage.set_if(data.A1NS, LEADER_KEY, current, lease)
+        self._lease = lease if taken else None
+        return bool(taken)
+
+    def tick(self):
+        """
+        one round of heartbeat, membership, leader lease and due jobs
+        """
+        now = self.clock()
+        members, gone = self._heartbeat(now)
+        leader = self._lead(now)
+        if leader != self.is_leader:
+            mdc_logger.debug("Replica {0} {1} the leader".format(self.replica_id, "is now" if leader else "is no longer"))
+            self.is_leader = leader
+            leader_gauge.set(int(leader))
+        replicas_gauge.set(len(members))
+        if members != self.members:
+            mdc_logger.debug("Replicas are now {0}".format(", ".join(members)))
+            self.members = members
+            for listener in self._listeners:
+                listener()
+        if leader and gone:
+            self.sdl._sdl.remove(data.A1NS, set(gone))
+        for job in self._jobs:
+            interval, func, leader_only, next_run = job
+            if next_run is None:
+                job[3] = now + interval
+            elif next_run <= now and (leader or not leader_only):
+                job[3] = now + interval
+                try:
+                    func()
+                except Exception as exc:  # pylint: disable=broad-except
+                    mdc_logger.warning("Periodic job {0} failed: {1}".format(func.__name__, repr(exc)))
+
+    def loop(self):
+        """
+        ticks until stopped; a failed tick (eg SDL briefly unavailable) is tried again on the next one
+        """
+        while not self._stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                self.tick()
+            except Exception as exc:  # pylint: disable=broad-except
+                mdc_logger.warning("Coordination failed, retrying in {0}s: {1}".format(HEARTBEAT_INTERVAL, repr(exc)))
+
+    def start(self):
+        """
+        ticks once, so that membership is known when this returns, then keeps ticking from a thread
+        """
+        self.tick()
+        self.thread = Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """
+        stops ticking, and leaves: our heartbeat goes, and so does our lease, so the others take over on their next tick
+        """
+        self._stopped.set()
+        storage = self.sdl._sdl
+        storage.remove(data.A1NS, {REPLICA_PREFIX + self.replica_id})
+        if self._lease is not None:
+            storage.remove_if(data.A1NS, LEADER_KEY, self._lease)
+            self._lease = None
+        self.is_leader = False
+        leader_gauge.set(0)
+
+
+def _resume_deletions_if_shared():
+    """
+    a deletion accepted by a replica that does not own it waits for its owner to find it, at the latest on the next sweep;
+    with one replica there are none
+    """
+    if len(__COORDINATOR__.members) > 1:
+        data.resume_deletions()
+
+
+def start_coordination():
+    """
+    joins the replicas sharing the SDL and resumes this replica's share of the pending deletions
+    """
+    global __COORDINATOR__
+    if __COORDINATOR__ is not None:
+        return
+    __COORDINATOR__ = Coordinator()
+    data.set_ownership(__COORDINATOR__.owns)
+    __COORDINATOR__.on_change(data.resume_deletions)
+    if DELETION_SWEEP_INTERVAL:
+        __COORDINATOR__.add_job(_resume_deletions_if_shared, DELETION_SWEEP_INTERVAL, leader_only=False)
+    if RECONCILE_INTERVAL:
+        __COORDINATOR__.add_job(data.reconcile_statuses, RECONCILE_INTERVAL)
+    __COORDINATOR__.start()
+    mdc_logger.debug("Resumed {0} pending instance deletions".format(data.resume_deletions()))
+
+
+def stop_coordination():
+    """
+    leaves the replicas; the work of this one moves to the others
+    """
+    global __COORDINATOR__
+    if __COORDINATOR__ is not None:
+        __COORDINATOR__.stop()
+        data.set_ownership(None)
+        __COORDINATOR__ = None
@@ -17,30 +17,353 @@
 """
 Represents A1s database and database access functions.
 """
+import bisect
 import distutils.util
+import hashlib
+import itertools
+import json
 import os
 import time
-from threading import Thread
+import uuid
+from threading import Lock
+import msgpack
 from mdclogpy import Logger
-from ricxappframe.xapp_sdl import SDLWrapper
+from prometheus_client import Counter, Gauge
+from a1 import validation, messages, metrics
+from a1.cache import LruCache, NoCache, MISSING
+from a1.scheduler import DeadlineScheduler
 from a1.exceptions import PolicyTypeNotFound, PolicyInstanceNotFound, PolicyTypeAlreadyExists, PolicyTypeIdMismatch, CantDeleteNonEmptyType
 
 # constants
 INSTANCE_DELETE_NO_RESP_TTL = int(os.environ.get("INSTANCE_DELETE_NO_RESP_TTL", 5))
 INSTANCE_DELETE_RESP_TTL = int(os.environ.get("INSTANCE_DELETE_RESP_TTL", 5))
+INSTANCE_DELETE_BATCH_SIZE = int(os.environ.get("INSTANCE_DELETE_BATCH_SIZE", 100))
 USE_FAKE_SDL = bool(distutils.util.strtobool(os.environ.get("USE_FAKE_SDL", "False")))
+# 0 disables the cache; when enabled, it must be enabled on every replica sharing the SDL so that writes publish invalidations
+CACHE_SIZE = int(os.environ.get("A1_CACHE_SIZE", 0))
+CACHE_TTL = float(os.environ.get("A1_CACHE_TTL", 30))
+# number of encoded instance bodies kept for sends and policy query replays; 0 disables keeping them
+ENCODED_CACHE_SIZE = int(os.environ.get("A1_ENCODED_CACHE_SIZE", 1000))
+# seconds the sorted ids of a listing are kept for its next pages; ids other replicas add or remove show up after at most this long
+ID_LIST_TTL = float(os.environ.get("A1_ID_LIST_TTL", 5))
 A1NS = "A1m_ns"
 TYPE_PREFIX = "a1.policy_type."
+# per type hash of its body, written and deleted along with it, so the body need not be read to tell if it changed
+TYPE_VERSION_PREFIX = "a1.policy_type_version."
 INSTANCE_PREFIX = "a1.policy_instance."
 METADATA_PREFIX = "a1.policy_inst_metadata."
 HANDLER_PREFIX = "a1.policy_handler."
+# per instance aggregate of its handler statuses, kept up to date by every status write
+STATUS_PREFIX = "a1.policy_inst_status."
+# SDL groups (sets) of ids, so that listing and existence checks don't have to scan keys or fetch values
+TYPE_INDEX = "a1.index.policy_types"
+INSTANCE_INDEX_PREFIX = "a1.index.policy_instances."
+HANDLER_INDEX_PREFIX = "a1.index.policy_handlers."
+INDEX_VERSION_KEY = "a1.index.version"
+# instances waiting to be deleted; members are json [policy_type_id, policy_instance_id, deadline]
+PENDING_DELETE_INDEX = "a1.index.pending_deletes"
+# 2 added the status aggregates
+INDEX_VERSION = 2
+# entries of full queues, see a1/queues.py; keys sort in the order the entries were spilled
+SPILL_PREFIX = "a1.queue_spill."
+CACHE_INVALIDATION_CHANNEL = "a1.cache_invalidation"
+REPLICA_ID = uuid.uuid4().hex
 
 
 mdc_logger = Logger(name=__name__)
 mdc_logger.mdclog_format_init(configmap_monitor=True)
-if USE_FAKE_SDL:
-    mdc_logger.debug("Using fake SDL")
-SDL = SDLWrapper(use_fake_sdl=USE_FAKE_SDL)
+
+
+class _LazySDL:
+    """
+    Stands in for the SDLWrapper until it is first used, so that importing a1 neither connects to SDL nor loads
+    the SDL client; see init_sdl. Anything it is asked for, or told, goes to the wrapper.
+    """
+
+    def __init__(self):
+        object.__setattr__(self, "_wrapper", None)
+        object.__setattr__(self, "_lock", Lock())
+
+    def connect(self):
+        """
+        answers the SDLWrapper, connecting on the first call
+        """
+        wrapper = self._wrapper
+        if wrapper is None:
+            with self._lock:
+                if self._wrapper is None:
+                    from ricxappframe.xapp_sdl import SDLWrapper  # pylint: disable=import-outside-toplevel
+
+                    if USE_FAKE_SDL:
+                        mdc_logger.debug("Using fake SDL")
+                    connected = SDLWrapper(use_fake_sdl=USE_FAKE_SDL)
+                    connected._sdl = metrics.TimedStorage(connected._sdl)
+                    object.__setattr__(self, "_wrapper", connected)
+                wrapper = self._wrapper
+        return wrapper
+
+    def __getattr__(self, name):
+        return getattr(self.connect(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self.connect(), name, value)
+
+
+SDL = _LazySDL()
+
+cache_counters = Counter('A1DataCache', 'Data layer cache lookups', ['result'])
+encoded_cache_counters = Counter('A1EncodedInstanceCache', 'Encoded policy instance lookups', ['result'])
+status_write_counters = Counter('A1StatusWrites', 'Handler statuses received, by whether they were written or skipped as unchanged', ['result'])
+pending_deletions_gauge = Gauge('A1PendingDeletions', 'Policy instances waiting to be deleted', multiprocess_mode='livesum')
+
+# types, instances and metadata are cached; handler statuses are not, they are written by the rmr thread far more often than read
+_CACHE = LruCache(CACHE_SIZE, CACHE_TTL) if CACHE_SIZE > 0 else NoCache()
+# instance key -> (created_at, instance, encoded instance); created_at of the metadata changes whenever the instance does
+_ENCODED = LruCache(ENCODED_CACHE_SIZE, 0) if ENCODED_CACHE_SIZE > 0 else NoCache()
+# index group -> (generation, read at, sorted ids), see _sorted_ids
+_ID_LISTS = {}
+# index group -> bumped whenever this replica adds or removes ids; only groups that were listed are tracked
+_ID_GENERATIONS = {}
+_ID_LISTS_LOCK = Lock()
+_SUBSCRIBED_SDL = None
+_SUBSCRIBE_LOCK = Lock()
+_DELETION_SCHEDULER = None
+_DELETION_SCHEDULER_LOCK = Lock()
+# answers whether this replica does the background work for a key, see set_ownership
+_OWNS = None
+
+
+def _after_fork():
+    """
+    a forked process (see a1/run.py) is a replica of its own: it gets its own id, and its own subscription, deletion
+    scheduler and coordination when it needs them, since the threads of those were not forked along
+    """
+    global REPLICA_ID, _SUBSCRIBED_SDL, _DELETION_SCHEDULER, _SUBSCRIBE_LOCK, _DELETION_SCHEDULER_LOCK, _OWNS, _ID_LISTS_LOCK
+    REPLICA_ID = uuid.uuid4().hex
+    _OWNS = None
+    _SUBSCRIBED_SDL = None
+    _DELETION_SCHEDULER = None
+    _SUBSCRIBE_LOCK = Lock()
+    _DELETION_SCHEDULER_LOCK = Lock()
+    _ID_LISTS_LOCK = Lock()
+    _CACHE.clear()
+
+
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def init_sdl():
+    """
+    connects to SDL now rather than on first use, eg so that the first request does not wait for it
+    """
+    if isinstance(SDL, _LazySDL):
+        SDL.connect()
+
+
+def set_ownership(owns):
+    """
+    plug in which background work (pending deletions) this replica does, eg a1.coordination.Coordinator.owns;
+    owns answers whether this replica does the work for a key. None, the default, means all of it.
+    """
+    global _OWNS
+    _OWNS = owns
+
+
+def _owned(key):
+    return _OWNS is None or _OWNS(key)
+
+
+# Cache
+
+
+def set_cache(cache):
+    """
+    plug in a different cache (see a1.cache); NoCache() disables caching
+    """
+    global _CACHE
+    _CACHE = cache
+
+
+def caching_enabled():
+    """
+    answers whether a cache is plugged in, see set_cache
+    """
+    return not isinstance(_CACHE, NoCache)
+
+
+def _caching():
+    """
+    answers whether a cache is plugged in; makes sure we hear about writes made by other replicas if so
+    """
+    global _SUBSCRIBED_SDL
+    if isinstance(_CACHE, NoCache):
+        return False
+    if _SUBSCRIBED_SDL is not SDL:
+        with _SUBSCRIBE_LOCK:
+            if _SUBSCRIBED_SDL is not SDL:
+                # the wrapper does not expose pub/sub, so go to the SDL storage it wraps
+                SDL._sdl.subscribe_channel(A1NS, _on_invalidation, CACHE_INVALIDATION_CHANNEL)
+                SDL._sdl.start_event_listener()
+                _CACHE.clear()  # anything cached came from some other SDL
+                _SUBSCRIBED_SDL = SDL
+    return True
+
+
+def _on_invalidation(_channel, events):
+    """
+    SDL event callback; each event is "<replica id>:<key>" for a key that was written or deleted
+    """
+    for event in events:
+        replica_id, _, key = event.partition(":")
+        if replica_id != REPLICA_ID:  # we wrote our own changes through already
+            _CACHE.invalidate(key)
+
+
+def _invalidation_event(key):
+    return "{0}:{1}".format(REPLICA_ID, key)
+
+
+def _get(key):
+    """
+    read-through get of a cached key
+    """
+    return _get_cached_many([key]).get(key)
+
+
+def _get_cached_many(keys):
+    """
+    read-through get of several cached keys; whatever is not cached is fetched in one round trip.
+    answers a dict of the keys that exist
+    """
+    if not _caching():
+        return _get_many(keys)
+    found = {}
+    missing = []
+    for key in keys:
+        value = _CACHE.get(key)
+        if value is MISSING:
+            missing.append(key)
+        else:
+            found[key] = value
+    cache_counters.labels(result='hit').inc(len(found))
+    if missing:
+        cache_counters.labels(result='miss').inc(len(missing))
+        generation = _CACHE.generation
+        fetched = _get_many(missing)
+        for key, value in fetched.items():
+            _CACHE.fill(key, value, generation)
+        found.update(fetched)
+    return found
+
+
+def _set(key, value):
+    """
+    write-through set of a cached key; other replicas are told to drop their copy in the same round trip
+    """
+    if not _caching():
+        SDL.set(A1NS, key, value)
+        return
+    SDL._sdl.set_and_publish(A1NS, {CACHE_INVALIDATION_CHANNEL: _invalidation_event(key)}, {key: msgpack.packb(value, use_bin_type=True)})
+    _CACHE.put(key, value)
+
+
+def _set_many(values):
+    """
+    write-through set of several cached keys, given as a dict, in one round trip
+    """
+    if not values:
+        return
+    if not _caching():
+        _set_many_uncached(values)
+        return
+    packed = {k: msgpack.packb(v, use_bin_type=True) for k, v in values.items()}
+    SDL._sdl.set_and_publish(A1NS, {CACHE_INVALIDATION_CHANNEL: [_invalidation_event(k) for k in values]}, packed)
+    for key, value in values.items():
+        _CACHE.put(key, value)
+
+
+def _set_many_uncached(values):
+    """
+    set several keys that are never cached, given as a dict, in one round trip
+    """
+    if values:
+        SDL._sdl.set(A1NS, {k: msgpack.packb(v, use_bin_type=True) for k, v in values.items()})
+
+
+def _delete(keys):
+    """
+    delete cached keys here, in SDL, and on the other replicas
+    """
+    if not _caching():
+        SDL._sdl.remove(A1NS, set(keys))
+        return
+    SDL._sdl.remove_and_publish(A1NS, {CACHE_INVALIDATION_CHANNEL: [_invalidation_event(k) for k in keys]}, set(keys))
+    for key in keys:
+        _CACHE.invalidate(key)
+
+
+def _get_many(keys):
+    """
+    get several keys in one round trip; answers a dict of the keys that exist
+    """
+    if not keys:
+        return {}
+    return {k: msgpack.unpackb(v, raw=False) for k, v in SDL._sdl.get(A1NS, set(keys)).items()}
+
+
+def _add_members(group, members):
+    """
+    add ids to an index group in one round trip; ids are always stored as strings
+    """
+    if members:
+        SDL._sdl.add_member(A1NS, group, {msgpack.packb(str(m), use_bin_type=True) for m in members})
+        _ids_changed(group)
+
+
+def _remove_members(group, members):
+    """
+    remove ids from an index group in one round trip
+    """
+    if members:
+        SDL._sdl.remove_member(A1NS, group, {msgpack.packb(str(m), use_bin_type=True) for m in members})
+        _ids_changed(group)
+
+
+def _is_member(group, member):
+    return SDL.is_member(A1NS, group, str(member))
+
+
+def _get_members(group):
+    return SDL.get_members(A1NS, group)
+
+
+def _ids_changed(group):
+    """
+    drops the sorted ids of a group, if it was listed, after this replica changed them in SDL
+    """
+    with _ID_LISTS_LOCK:
+        if group in _ID_GENERATIONS:
+            _ID_GENERATIONS[group] += 1
+            _ID_LISTS.pop(group, None)
+
+
+def _sorted_ids(group, id_type, reuse):
+    """
+    Answers the ids of a group, as id_type, sorted. With reuse, ids read less than ID_LIST_TTL seconds ago are
+    answered again unless this replica changed the group since, so that the pages of a listing after the first do not
+    each read and sort every id. The list answered is shared, and must not be changed.
+    """
+    now = time.monotonic()
+    with _ID_LISTS_LOCK:
+        generation = _ID_GENERATIONS.setdefault(group, 0)
+        cached = _ID_LISTS.get(group)
+    if reuse and cached is not None and cached[0] == generation and now - cached[1] < ID_LIST_TTL:
+        return cached[2]
+    ids = sorted(id_type(i) for i in _get_members(group))
+    with _ID_LISTS_LOCK:
+        if _ID_GENERATIONS[group] == generation:  # else a change of ours may be missing from what we read
+            _ID_LISTS[group] = (generation, now, ids)
+    return ids
 
 # Internal helpers
 
@@ -52,6 +375,27 @@ def _generate_type_key(policy_type_id):
     return "{0}{1}".format(TYPE_PREFIX, policy_type_id)
 
 
+def _generate_type_version_key(policy_type_id):
+    """
+    generate a key for the version of a policy type
+    """
+    return "{0}{1}".format(TYPE_VERSION_PREFIX, policy_type_id)
+
+
+def _type_version(body):
+    """
+    the version of a type is a hash of its body; types can't be replaced, only deleted and created again
+    """
+    return hashlib.sha256(json.dumps(body, sort_keys=True).encode("utf-8")).hexdigest()[:32]
+
+
+def _instance_version(metadata):
+    """
+    the version of an instance is its creation time, which every create or replace sets anew
+    """
+    return repr(metadata["created_at"])
+
+
 def _generate_instance_key(policy_type_id, policy_instance_id):
     """
     generate a key for a policy instance
@@ -66,6 +410,20 @@ def _generate_instance_metadata_key(policy_type_id, policy_instance_id):
     return "{0}{1}.{2}".format(METADATA_PREFIX, policy_type_id, policy_instance_id)
 
 
+def _generate_status_key(policy_type_id, policy_instance_id):
+    """
+    generate a key for the status aggregate of a policy instance
+    """
+    return "{0}{1}.{2}".format(STATUS_PREFIX, policy_type_id, policy_instance_id)
+
+
+def _empty_status():
+    """
+    the status aggregate of an instance no handler reported on yet
+    """
+    return {"handlers": 0, "ok": 0, "updated_at": None}
+
+
 def _generate_handler_prefix(policy_type_id, policy_instance_id):
     """
     generate the prefix to a handler key
@@ -80,30 +438,75 @@ def _generate_handler_key(policy_type_id, policy_instance_id, handler_id):
     return "{0}{1}".format(_generate_handler_prefix(policy_type_id, policy_instance_id), handler_id)
 
 
+def _generate_instance_index(policy_type_id):
+    """
+    generate the group holding the instance ids of a type
+    """
+    return "{0}{1}".format(INSTANCE_INDEX_PREFIX, policy_type_id)
+
+
+def _generate_handler_index(policy_type_id, policy_instance_id):
+    """
+    generate the group holding the handler ids that reported a status for an instance
+    """
+    return "{0}{1}.{2}".format(HANDLER_INDEX_PREFIX, policy_type_id, policy_instance_id)
+
+
+def _type_exists(policy_type_id):
+    """
+    answers whether a type exists, without fetching it
+    """
+    if _caching() and _CACHE.get(_generate_type_key(policy_type_id)) is not MISSING:
+        return True
+    return _is_member(TYPE_INDEX, policy_type_id)
+
+
+def _instance_exists(policy_type_id, policy_instance_id):
+    """
+    answers whether an instance exists, without fetching it
+    """
+    if _caching() and _CACHE.get(_generate_instance_key(policy_type_id, policy_instance_id)) is not MISSING:
+        return True
+    return _is_member(_generate_instance_index(policy_type_id), policy_instance_id)
+
+
 def _type_is_valid(policy_type_id):
     """
     check that a type is valid
     """
-    if SDL.get(A1NS, _generate_type_key(policy_type_id)) is None:
+    if not _type_exists(policy_type_id):
         raise PolicyTypeNotFound(policy_type_id)
 
 
+def _get_instance_records(policy_type_id, policy_instance_id, with_instance=False):
+    """
+    Validates the type and instance and fetches the instance metadata, plus the instance itself if asked,
+    in one round trip. Answers (metadata, instance).
+
+    The metadata is written along with the instance and deleted along with it, and a type can't be deleted
+    while it has instances, so finding the metadata proves both the type and the instance exist.
+    """
+    metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
+    instance_key = _generate_instance_key(policy_type_id, policy_instance_id)
+    records = _get_cached_many([metadata_key, instance_key] if with_instance else [metadata_key])
+    if metadata_key not in records:
+        _type_is_valid(policy_type_id)  # only costs a round trip when we are about to answer a 404 anyway
+        raise PolicyInstanceNotFound(policy_type_id)
+    return records[metadata_key], records.get(instance_key)
+
+
 def _instance_is_valid(policy_type_id, policy_instance_id):
     """
     check that an instance is valid
     """
-    _type_is_valid(policy_type_id)
-    if SDL.get(A1NS, _generate_instance_key(policy_type_id, policy_instance_id)) is None:
-        raise PolicyInstanceNotFound(policy_type_id)
+    _get_instance_records(policy_type_id, policy_instance_id)
 
 
-def _get_statuses(policy_type_id, policy_instance_id):
+def _get_handler_ids(policy_type_id, policy_instance_id):
     """
-    shared helper to get statuses for an instance
+    ids of the handlers that reported a status for an instance; does not validate
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    prefixes_for_handler = "{0}{1}.{2}.".format(HANDLER_PREFIX, policy_type_id, policy_instance_id)
-    return list(SDL.find_and_get(A1NS, prefixes_for_handler).values())
+    return _get_members(_generate_handler_index(policy_type_id, policy_instance_id))
 
 
 def _get_instance_list(policy_type_id):
@@ -111,58 +514,156 @@ def _get_instance_list(policy_type_id):
     shared helper to get instance list for a type
     """
     _type_is_valid(policy_type_id)
-    prefixes_for_type = "{0}{1}.".format(INSTANCE_PREFIX, policy_type_id)
-    instancekeys = SDL.find_and_get(A1NS, prefixes_for_type).keys()
-    return [k.split(prefixes_for_type)[1] for k in instancekeys]
+    return sorted(_get_members(_generate_instance_index(policy_type_id)))
 
 
 def _clear_handlers(policy_type_id, policy_instance_id):
     """
     delete all the handlers for a policy instance
     """
-    all_handlers_pref = _generate_handler_prefix(policy_type_id, policy_instance_id)
-    keys = SDL.find_and_get(A1NS, all_handlers_pref)
-    for k in keys:
-        SDL.delete(A1NS, k)
+    _clear_handlers_many(policy_type_id, [policy_instance_id])
+
+
+def _clear_handlers_many(policy_type_id, policy_instance_ids):
+    """
+    delete all the handlers of several policy instances; the handler keys and handler index groups go in one remove
+    """
+    doomed = set()
+    for policy_instance_id in policy_instance_ids:
+        handler_index = _generate_handler_index(policy_type_id, policy_instance_id)
+        doomed.add(handler_index)
+        doomed.update(_generate_handler_key(policy_type_id, policy_instance_id, h) for h in _get_members(handler_index))
+    if doomed:
+        SDL._sdl.remove(A1NS, doomed)
+
+
+def _deletion_ttl(policy_type_id, policy_instance_id):
+    """
+    the seconds to wait before deleting a deleted instance
+    """
+    return _deletion_ttl_for(bool(_get_handler_ids(policy_type_id, policy_instance_id)))
+
+
+def _deletion_ttl_for(has_handlers):
+    """
+    the seconds to wait before deleting a deleted instance, given whether any handler reported a status for it
+    """
+    if not has_handlers:
+        # handler is empty; we wait for t1 to expire then goodnight
+        return INSTANCE_DELETE_NO_RESP_TTL
+    # handler is not empty, we wait max t1,t2 to expire then goodnight
+    return max(INSTANCE_DELETE_RESP_TTL, INSTANCE_DELETE_NO_RESP_TTL)
 
 
 def _get_metadata(policy_type_id, policy_instance_id):
     """
     get instance metadata
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
-    return SDL.get(A1NS, metadata_key)
+    return _get_instance_records(policy_type_id, policy_instance_id)[0]
+
+
+def _deletion_scheduler():
+    """
+    the one scheduler that owns all pending deletions of this process; started on first use
+    """
+    global _DELETION_SCHEDULER
+    with _DELETION_SCHEDULER_LOCK:
+        if _DELETION_SCHEDULER is None:
+            _DELETION_SCHEDULER = DeadlineScheduler(_delete_pending, INSTANCE_DELETE_BATCH_SIZE, pending_deletions_gauge)
+        return _DELETION_SCHEDULER
+
+
+def _schedule_delete(pending):
+    """
+    hand a pending deletion member to the scheduler, if this replica does that deletion; the replica that does
+    finds it when it next resumes deletions
+    """
+    if _owned(pending):
+        _deletion_scheduler().schedule(pending, json.loads(pending)[2])
 
 
-def _delete_after(policy_type_id, policy_instance_id, ttl):
+@metrics.data_function
+def _delete_pending(pendings):
     """
-    this is a blocking function, must call this in a thread to not block!
-    waits ttl seconds, then deletes the instance
+    Deletes the instances of a batch of due pending deletions; called from the deletion scheduler thread.
+    An instance that was re-created since its delete (has_been_deleted is no longer set) is left alone,
+    and so are deletions that another replica has taken over since they were scheduled.
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
+    pendings = [p for p in pendings if _owned(p)]
+    if not pendings:
+        return
+    instances = [tuple(json.loads(p)[:2]) for p in pendings]
+    metadata = _get_many([_generate_instance_metadata_key(t, i) for t, i in instances])
+    doomed = {(t, i) for t, i in instances if metadata.get(_generate_instance_metadata_key(t, i), {}).get("has_been_deleted")}
 
-    time.sleep(ttl)
+    # drop them from the indexes first so nobody finds a half deleted instance
+    by_type = {}
+    for policy_type_id, policy_instance_id in doomed:
+        by_type.setdefault(policy_type_id, []).append(policy_instance_id)
+    for policy_type_id, instance_ids in by_type.items():
+        _remove_members(_generate_instance_index(policy_type_id), instance_ids)
 
-    # ready to delete
-    _clear_handlers(policy_type_id, policy_instance_id)  # delete all the handlers
-    SDL.delete(A1NS, _generate_instance_key(policy_type_id, policy_instance_id))  # delete instance
-    SDL.delete(A1NS, _generate_instance_metadata_key(policy_type_id, policy_instance_id))  # delete instance metadata
-    mdc_logger.debug("type {0} instance {1} deleted".format(policy_type_id, policy_instance_id))
+    # handler keys, handler index groups and status aggregates are plain keys in SDL, so they all go in one remove
+    handler_keys = {_generate_status_key(t, i) for t, i in doomed}
+    for policy_type_id, policy_instance_id in doomed:
+        handler_keys.add(_generate_handler_index(policy_type_id, policy_instance_id))
+        handler_keys.update(_generate_handler_key(policy_type_id, policy_instance_id, h) for h in _get_handler_ids(policy_type_id, policy_instance_id))
+    if handler_keys:
+        SDL._sdl.remove(A1NS, handler_keys)
+
+    # delete instance and instance metadata
+    if doomed:
+        _delete([k for t, i in doomed for k in (_generate_instance_key(t, i), _generate_instance_metadata_key(t, i))])
+        for policy_type_id, policy_instance_id in doomed:
+            _ENCODED.invalidate(_generate_instance_key(policy_type_id, policy_instance_id))
+    _remove_members(PENDING_DELETE_INDEX, pendings)
+    for policy_type_id, policy_instance_id in doomed:
+        mdc_logger.debug("type {0} instance {1} deleted".format(policy_type_id, policy_instance_id))
+
+
+@metrics.data_function
+def resume_deletions():
+    """
+    schedule the pending deletions persisted in SDL, eg by a process that has since restarted, that this replica does;
+    ones scheduled already are left as they are. Answers the number of pending deletions.
+    """
+    pendings = _get_members(PENDING_DELETE_INDEX)
+    for pending in pendings:
+        _schedule_delete(pending)
+    return len(pendings)
 
 
 # Types
 
 
+@metrics.data_function
 def get_type_list():
     """
     retrieve all type ids
     """
-    typekeys = SDL.find_and_get(A1NS, TYPE_PREFIX).keys()
     # policy types are ints but they get butchered to strings in the KV
-    return [int(k.split(TYPE_PREFIX)[1]) for k in typekeys]
+    return sorted(int(t) for t in _get_members(TYPE_INDEX))
 
 
+def _page(ids, limit, after):
+    """
+    answers the ids (sorted) that follow after, at most limit of them, and the after of the next page, None if this is the last page
+    """
+    start = bisect.bisect_right(ids, after) if after is not None else 0
+    end = len(ids) if limit is None else min(start + limit, len(ids))
+    return ids[start:end], (ids[end - 1] if end < len(ids) else None)
+
+
+@metrics.data_function
+def get_type_page(limit=None, after=None):
+    """
+    retrieve the type ids that follow the type id after, at most limit of them; see _page.
+    The first page reads the ids, the pages that follow reuse them for a while, see _sorted_ids
+    """
+    return _page(_sorted_ids(TYPE_INDEX, int, after is not None), limit, after)
+
+
+@metrics.data_function
 def store_policy_type(policy_type_id, body):
     """
     store a policy type if it doesn't already exist
@@ -170,33 +671,104 @@ def store_policy_type(policy_type_id, body):
     if policy_type_id != body['policy_type_id']:
         raise PolicyTypeIdMismatch("{0} vs. {1}".format(policy_type_id, body['policy_type_id']))
     key = _generate_type_key(policy_type_id)
-    if SDL.get(A1NS, key) is not None:
+    if _type_exists(policy_type_id):
         raise PolicyTypeAlreadyExists(policy_type_id)
-    SDL.set(A1NS, key, body)
+    # compile before storing so a type with a broken schema is never accepted
+    validator = validation.compile_validator(body['create_schema'])
+    version = _type_version(body)
+    _set(key, body)
+    # readers that find no version yet work it out from the body, so a failure in between does no harm
+    _set(_generate_type_version_key(policy_type_id), version)
+    _add_members(TYPE_INDEX, [policy_type_id])
+    validation.cache_validator(policy_type_id, version, validator)
 
 
+@metrics.data_function
 def delete_policy_type(policy_type_id):
     """
     delete a policy type; can only be done if there are no instances (business logic)
     """
     pil = get_instance_list(policy_type_id)
     if pil == []:  # empty, can delete
-        SDL.delete(A1NS, _generate_type_key(policy_type_id))
+        _remove_members(TYPE_INDEX, [policy_type_id])
+        _delete([_generate_type_key(policy_type_id), _generate_type_version_key(policy_type_id)])
+        SDL.remove_group(A1NS, _generate_instance_index(policy_type_id))
+        validation.evict_validator(policy_type_id)
     else:
         raise CantDeleteNonEmptyType(policy_type_id)
 
 
+@metrics.data_function
 def get_policy_type(policy_type_id):
     """
     retrieve a type
     """
     _type_is_valid(policy_type_id)
-    return SDL.get(A1NS, _generate_type_key(policy_type_id))
+    return _get(_generate_type_key(policy_type_id))
+
+
+@metrics.data_function
+def get_policy_type_version(policy_type_id):
+    """
+    retrieve the version of a type without its body; answers None for an unknown type, or for a type stored by
+    an older A1 that did not version types, in which case get_versioned_policy_type answers it
+    """
+    return _get(_generate_type_version_key(policy_type_id))
+
+
+@metrics.data_function
+def get_versioned_policy_type(policy_type_id):
+    """
+    retrieve a type and its version in one round trip; answers (version, body)
+    """
+    return _get_versioned_type(policy_type_id)
+
+
+def _get_versioned_type(policy_type_id):
+    key = _generate_type_key(policy_type_id)
+    version_key = _generate_type_version_key(policy_type_id)
+    records = _get_cached_many([key, version_key])
+    if key not in records:
+        raise PolicyTypeNotFound(policy_type_id)
+    body = records[key]
+    return records.get(version_key) or _type_version(body), body
+
+
+@metrics.data_function
+def get_type_validator(policy_type_id):
+    """
+    retrieve the compiled validator of the create_schema of a type. It is compiled once per version of the type, so
+    a type that any process deleted and created again with another schema is validated against the new schema.
+    Costs a read of the type version (cached if the data layer caches); the type itself is only read to compile.
+    """
+    version = _get(_generate_type_version_key(policy_type_id))
+    if version is None:  # an unknown type, or one stored by an older A1
+        version, body = _get_versioned_type(policy_type_id)
+        return validation.get_validator(policy_type_id, version, lambda: body["create_schema"])
+    return validation.get_validator(policy_type_id, version, lambda: _get_versioned_type(policy_type_id)[1]["create_schema"])
+
+
+@metrics.data_function
+def warm_policy_types(policy_type_ids):
+    """
+    loads the given types and their versions in one round trip, into the cache if there is one, and compiles their schemas;
+    answers the number of types found
+    """
+    found = _get_cached_many([k for t in policy_type_ids for k in (_generate_type_key(t), _generate_type_version_key(t))])
+    loaded = 0
+    for policy_type_id in policy_type_ids:
+        body = found.get(_generate_type_key(policy_type_id))
+        if body is not None:
+            loaded += 1
+            version = found.get(_generate_type_version_key(policy_type_id)) or _type_version(body)
+            validation.get_validator(policy_type_id, version, lambda: body["create_schema"])  # pylint: disable=cell-var-from-loop
+    return loaded
 
 
 # Instances
 
 
+@metrics.data_function
 def store_policy_instance(policy_type_id, policy_instance_id, instance):
     """
     Store a policy instance
@@ -207,26 +779,109 @@ def store_policy_instance(policy_type_id, policy_instance_id, instance):
     # store the instance
     operation = "CREATE"
     key = _generate_instance_key(policy_type_id, policy_instance_id)
-    if SDL.get(A1NS, key) is not None:
+    if _instance_exists(policy_type_id, policy_instance_id):
         operation = "UPDATE"
         # Reset the statuses because this is a new policy instance, even if it was overwritten
         _clear_handlers(policy_type_id, policy_instance_id)  # delete all the handlers
-    SDL.set(A1NS, key, instance)
-
     metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
-    SDL.set(A1NS, metadata_key, {"created_at": creation_timestamp, "has_been_deleted": False})
+    _set_many({
+        key: instance,
+        metadata_key: {"created_at": creation_timestamp, "has_been_deleted": False},
+        _generate_status_key(policy_type_id, policy_instance_id): _empty_status(),
+    })
+    _ENCODED.put(key, (creation_timestamp, instance, messages.dumps(instance)))
+    if operation == "CREATE":
+        _add_members(_generate_instance_index(policy_type_id), [policy_instance_id])
 
     return operation
 
 
+@metrics.data_function
+def store_policy_instances(policy_type_id, instances):
+    """
+    Like store_policy_instance, for several instances of a type given as a dict of policy_instance_id to instance.
+    Instances and metadata are written in one round trip. Answers a dict of policy_instance_id to operation.
+    """
+    _type_is_valid(policy_type_id)
+    if not instances:
+        return {}
+    creation_timestamp = time.time()
+
+    # finding the metadata proves the instance exists, see _get_instance_records
+    metadata_keys = {i: _generate_instance_metadata_key(policy_type_id, i) for i in instances}
+    existing = _get_cached_many(list(metadata_keys.values()))
+    operations = {i: "UPDATE" if metadata_keys[i] in existing else "CREATE" for i in instances}
+
+    # Reset the statuses of replaced instances, like store_policy_instance does
+    _clear_handlers_many(policy_type_id, [i for i, op in operations.items() if op == "UPDATE"])
+    values = {}
+    for policy_instance_id, instance in instances.items():
+        values[_generate_instance_key(policy_type_id, policy_instance_id)] = instance
+        values[metadata_keys[policy_instance_id]] = {"created_at": creation_timestamp, "has_been_deleted": False}
+        values[_generate_status_key(policy_type_id, policy_instance_id)] = _empty_status()
+    _set_many(values)
+    _add_members(_generate_instance_index(policy_type_id), [i for i, op in operations.items() if op == "CREATE"])
+
+    for policy_instance_id, instance in instances.items():
+        _ENCODED.put(_generate_instance_key(policy_type_id, policy_instance_id), (creation_timestamp, instance, messages.dumps(instance)))
+    return operations
+
+
+@metrics.data_function
 def get_policy_instance(policy_type_id, policy_instance_id):
     """
     Retrieve a policy instance
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    return SDL.get(A1NS, _generate_instance_key(policy_type_id, policy_instance_id))
+    return _get_instance_records(policy_type_id, policy_instance_id, with_instance=True)[1]
+
+
+@metrics.data_function
+def get_policy_instance_version(policy_type_id, policy_instance_id):
+    """
+    retrieve the version of an instance from its metadata, without the instance
+    """
+    return _instance_version(_get_metadata(policy_type_id, policy_instance_id))
+
+
+@metrics.data_function
+def get_versioned_policy_instance(policy_type_id, policy_instance_id):
+    """
+    retrieve an instance and its version in one round trip; answers (version, instance)
+    """
+    metadata, instance = _get_instance_records(policy_type_id, policy_instance_id, with_instance=True)
+    return _instance_version(metadata), instance
+
+
+@metrics.data_function
+def get_instance_page(policy_type_id, limit=None, after=None):
+    """
+    retrieve the instance ids of a type that follow the instance id after, at most limit of them; see _page.
+    The first page reads the ids, the pages that follow reuse them for a while, see _sorted_ids
+    """
+    _type_is_valid(policy_type_id)
+    return _page(_sorted_ids(_generate_instance_index(policy_type_id), str, after is not None), limit, after)
+
+
+def encode_policy_instance(policy_type_id, policy_instance_id, instance, created_at=None):
+    """
+    answers the instance encoded with messages.dumps, reusing the encoding done when it was stored.
+    The stored encoding is used for the very instance object that was stored, or for any copy of it read back
+    together with its metadata created_at.
+    """
+    key = _generate_instance_key(policy_type_id, policy_instance_id)
+    entry = _ENCODED.get(key)
+    if entry is not MISSING and (entry[1] is instance or (created_at is not None and entry[0] == created_at)):
+        encoded_cache_counters.labels(result='hit').inc()
+        return entry[2]
+
+    encoded_cache_counters.labels(result='miss').inc()
+    encoded = messages.dumps(instance)
+    if created_at is not None:
+        _ENCODED.put(key, (created_at, instance, encoded))
+    return encoded
 
 
+@metrics.data_function
 def get_instance_list(policy_type_id):
     """
     retrieve all instance ids for a type
@@ -234,58 +889,373 @@ def get_instance_list(policy_type_id):
     return _get_instance_list(policy_type_id)
 
 
+@metrics.data_function
+def warm_instance_metadata(policy_type_id, policy_instance_ids):
+    """
+    loads the metadata of the given instances into the cache in one round trip; answers the number found
+    """
+    return len(_get_cached_many([_generate_instance_metadata_key(policy_type_id, i) for i in policy_instance_ids]))
+
+
+def _iter_encoded_instance_batches(policy_type_id, instance_ids, batch_size):
+    for start in range(0, len(instance_ids), batch_size):
+        batch = instance_ids[start:start + batch_size]
+        keys = [(_generate_instance_key(policy_type_id, i), _generate_instance_metadata_key(policy_type_id, i)) for i in batch]
+        records = _get_cached_many([k for pair in keys for k in pair])
+        # instances deleted since the listing are skipped
+        yield [
+            (i, encode_policy_instance(policy_type_id, i, records[k], records[mk]["created_at"]))
+            for i, (k, mk) in zip(batch, keys) if k in records and mk in records
+        ]
+
+
+def get_encoded_instances_in_batches(policy_type_id, batch_size):
+    """
+    retrieve all instances of a type, encoded with messages.dumps, as an iterator of lists of (policy_instance_id, encoded instance);
+    each list is read in one round trip, so at most batch_size instances are held at a time.
+    the type is validated right away, not when iterating
+    """
+    return _iter_encoded_instance_batches(policy_type_id, _get_instance_list(policy_type_id), batch_size)
+
+
+@metrics.data_function
 def delete_policy_instance(policy_type_id, policy_instance_id):
     """
     initially sets has_been_deleted in the status
-    then launches a thread that waits until the relevent timer expires, and finally deletes the instance
+    then schedules the instance to be deleted once the relevent timer expires
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
+    existing_metadata = _get_metadata(policy_type_id, policy_instance_id)
 
     # set the metadata first
     deleted_timestamp = time.time()
     metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
-    existing_metadata = _get_metadata(policy_type_id, policy_instance_id)
-    SDL.set(
-        A1NS,
-        metadata_key,
-        {"created_at": existing_metadata["created_at"], "has_been_deleted": True, "deleted_at": deleted_timestamp},
-    )
-
-    # wait, then delete
-    vector = _get_statuses(policy_type_id, policy_instance_id)
-    if vector == []:
-        # handler is empty; we wait for t1 to expire then goodnight
-        clos = lambda: _delete_after(policy_type_id, policy_instance_id, INSTANCE_DELETE_NO_RESP_TTL)
-    else:
-        # handler is not empty, we wait max t1,t2 to expire then goodnight
-        clos = lambda: _delete_after(
-            policy_type_id, policy_instance_id, max(INSTANCE_DELETE_RESP_TTL, INSTANCE_DELETE_NO_RESP_TTL)
-        )
-    Thread(target=clos).start()
+    _set(metadata_key, {"created_at": existing_metadata["created_at"], "has_been_deleted": True, "deleted_at": deleted_timestamp})
+
+    # wait, then delete; the deadline is persisted so that a restarted A1 still deletes the instance
+    pending = json.dumps([policy_type_id, policy_instance_id, deleted_timestamp + _deletion_ttl(policy_type_id, policy_instance_id)])
+    _add_members(PENDING_DELETE_INDEX, [pending])
+    _schedule_delete(pending)
+
+
+@metrics.data_function
+def delete_policy_instances(policy_type_id, policy_instance_ids):
+    """
+    Like delete_policy_instance, for several instances of a type, with batched reads and writes.
+    Answers the ids of the instances that were found; the others are left alone.
+    """
+    _type_is_valid(policy_type_id)
+    metadata_keys = {i: _generate_instance_metadata_key(policy_type_id, i) for i in policy_instance_ids}
+    # the status aggregates tell which instances have handlers; read in the same round trip as the metadata
+    status_keys = {i: _generate_status_key(policy_type_id, i) for i in policy_instance_ids}
+    existing = _get_many(list(metadata_keys.values()) + list(status_keys.values()))
+    found = [i for i in policy_instance_ids if metadata_keys[i] in existing]
+
+    deleted_timestamp = time.time()
+    _set_many({
+        metadata_keys[i]: {"created_at": existing[metadata_keys[i]]["created_at"], "has_been_deleted": True, "deleted_at": deleted_timestamp}
+        for i in found
+    })
+    pendings = [
+        json.dumps([policy_type_id, i, deleted_timestamp + _deletion_ttl_for(existing.get(status_keys[i], _empty_status())["handlers"])])
+        for i in found
+    ]
+    _add_members(PENDING_DELETE_INDEX, pendings)
+    for pending in pendings:
+        _schedule_delete(pending)
+    return found
 
 
 # Statuses
 
 
+@metrics.data_function
 def set_policy_instance_status(policy_type_id, policy_instance_id, handler_id, status):
     """
-    update the database status for a handler
-    called from a1's rmr thread
+    update the database status for a handler, and the status aggregate of the instance along with it;
+    see set_policy_instance_statuses
     """
-    _type_is_valid(policy_type_id)
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    SDL.set(A1NS, _generate_handler_key(policy_type_id, policy_instance_id, handler_id), status)
+    if set_policy_instance_statuses([(policy_type_id, policy_instance_id, handler_id, status)]):
+        _type_is_valid(policy_type_id)
+        raise PolicyInstanceNotFound(policy_type_id)
+
+
+@metrics.data_function
+def set_policy_instance_statuses(statuses):
+    """
+    Updates the database status of many handlers, and the status aggregates of their instances along with them.
+    statuses is a list of (policy_type_id, policy_instance_id, handler_id, status), in the order received;
+    the last status of a handler wins. Answers the set of (policy_type_id, policy_instance_id) that don't exist,
+    whose statuses are dropped. Called from a1's status workers.
+
+    Each distinct instance is validated once, and the metadata, handler statuses and aggregates are read in one
+    round trip. Statuses that don't change anything are not written; the rest are written in one more round trip.
+
+    The aggregates are read, changed and written back, so two processes writing statuses of the same instance
+    at the same time may leave one off by one; reconcile_statuses() rebuilds them from the handler keys.
+    """
+    latest = {}  # (type id, instance id) -> {handler id: status}
+    for policy_type_id, policy_instance_id, handler_id, status in statuses:
+        latest.setdefault((policy_type_id, policy_instance_id), {})[handler_id] = status
+
+    keys = []
+    for (policy_type_id, policy_instance_id), handlers in latest.items():
+        keys.append(_generate_instance_metadata_key(policy_type_id, policy_instance_id))
+        keys.append(_generate_status_key(policy_type_id, policy_instance_id))
+        keys.extend(_generate_handler_key(policy_type_id, policy_instance_id, h) for h in handlers)
+    records = _get_many(keys)
+
+    missing = set()
+    values = {}
+    new_handlers = {}
+    written = 0
+    now = time.time()
+    for (policy_type_id, policy_instance_id), handlers in latest.items():
+        if _generate_instance_metadata_key(policy_type_id, policy_instance_id) not in records:
+            missing.add((policy_type_id, policy_instance_id))
+            continue
+        status_key = _generate_status_key(policy_type_id, policy_instance_id)
+        aggregate = records.get(status_key) or _empty_status()
+        for handler_id, status in handlers.items():
+            handler_key = _generate_handler_key(policy_type_id, policy_instance_id, handler_id)
+            previous = records.get(handler_key)
+            if previous == status:
+                continue
+            if previous is None:
+                aggregate["handlers"] += 1
+                new_handlers.setdefault((policy_type_id, policy_instance_id), []).append(handler_id)
+            aggregate["ok"] += (status == "OK") - (previous == "OK")
+            aggregate["updated_at"] = now
+            values[handler_key] = status
+            values[status_key] = aggregate
+            written += 1
+
+    dropped = sum(1 for status in statuses if (status[0], status[1]) in missing)
+    status_write_counters.labels(result="written").inc(written)
+    status_write_counters.labels(result="skipped").inc(len(statuses) - dropped - written)
+    _set_many_uncached(values)
+    for (policy_type_id, policy_instance_id), handler_ids in new_handlers.items():
+        _add_members(_generate_handler_index(policy_type_id, policy_instance_id), handler_ids)
+    return missing
 
 
+@metrics.data_function
 def get_policy_instance_status(policy_type_id, policy_instance_id):
     """
-    Gets the status of an instance
+    Gets the status of an instance from its metadata and status aggregate, in one round trip
+    """
+    return _get_versioned_status(policy_type_id, policy_instance_id)[1]
+
+
+@metrics.data_function
+def get_versioned_policy_instance_status(policy_type_id, policy_instance_id):
+    """
+    Like get_policy_instance_status, answering (version, status); the version changes whenever the status does
+    """
+    return _get_versioned_status(policy_type_id, policy_instance_id)
+
+
+def _get_versioned_status(policy_type_id, policy_instance_id):
+    metadata_key = _generate_instance_metadata_key(policy_type_id, policy_instance_id)
+    status_key = _generate_status_key(policy_type_id, policy_instance_id)
+    # status aggregates change with every status message, so they are never cached; neither is this read
+    records = _get_many([metadata_key, status_key])
+    if metadata_key not in records:
+        _type_is_valid(policy_type_id)
+        raise PolicyInstanceNotFound(policy_type_id)
+    metadata = records[metadata_key]
+    metadata["instance_status"] = _instance_status(records.get(status_key))
+    version = "{0}-{1!r}-{2}".format(_instance_version(metadata), metadata.get("deleted_at"), int(metadata["instance_status"] == "IN EFFECT"))
+    return version, metadata
+
+
+def _instance_status(aggregate):
+    """
+    an instance is in effect if at least one handler reported OK
+    """
+    return "IN EFFECT" if aggregate and aggregate["ok"] > 0 else "NOT IN EFFECT"
+
+
+def _handler_instance_id(remainder, instance_ids):
+    """
+    answers the instance id of a handler key, given what follows the type in it (instance id, dot, handler id);
+    instance ids may contain dots too, so the longest known instance id wins
+    """
+    end = remainder.rfind(".")
+    while end > 0:
+        if remainder[:end] in instance_ids:
+            return remainder[:end]
+        end = remainder.rfind(".", 0, end)
+    return None
+
+
+@metrics.data_function
+def get_type_statuses(policy_type_id, instance_status=None, has_been_deleted=None):
+    """
+    Gets the status and metadata of every instance of a type, in instance id order, optionally only those with
+    the given instance_status and/or has_been_deleted. The metadata and status aggregates are read in one batch.
     """
-    _instance_is_valid(policy_type_id, policy_instance_id)
-    metadata = _get_metadata(policy_type_id, policy_instance_id)
-    metadata["instance_status"] = "NOT IN EFFECT"
-    for i in _get_statuses(policy_type_id, policy_instance_id):
-        if i == "OK":
-            metadata["instance_status"] = "IN EFFECT"
-            break
-    return metadata
+    instance_ids = _get_instance_list(policy_type_id)
+    keys = {i: (_generate_instance_metadata_key(policy_type_id, i), _generate_status_key(policy_type_id, i)) for i in instance_ids}
+    records = _get_many([k for pair in keys.values() for k in pair])
+    answer = []
+    for policy_instance_id in instance_ids:
+        metadata_key, status_key = keys[policy_instance_id]
+        if metadata_key not in records:  # deleted since the listing
+            continue
+        entry = dict(records[metadata_key], policy_instance_id=policy_instance_id, instance_status=_instance_status(records.get(status_key)))
+        if instance_status is not None and entry["instance_status"] != instance_status:
+            continue
+        if has_been_deleted is not None and entry["has_been_deleted"] != has_been_deleted:
+            continue
+        answer.append(entry)
+    return answer
+
+
+@metrics.data_function
+def reconcile_statuses():
+    """
+    Rebuilds the status aggregate of every instance from its handler keys, with one key scan per type.
+    Answers the number of instances reconciled.
+
+    Status writes and instance replaces and deletes go on meanwhile, so the aggregates are read before the handler keys
+    and each one that needs fixing is only written if it is still what was read (set_if); one that changed in between
+    was written by someone who saw newer handler keys than we did, and is left alone. An instance that has no aggregate
+    is only given one if its metadata was there, and none was written meanwhile (set_if_not_exists).
+    """
+    reconciled = 0
+    for policy_type_id in get_type_list():
+        instance_ids = set(_get_members(_generate_instance_index(policy_type_id)))
+        status_keys = {i: _generate_status_key(policy_type_id, i) for i in instance_ids}
+        metadata_keys = {i: _generate_instance_metadata_key(policy_type_id, i) for i in instance_ids}
+        # raw, so that set_if can compare against exactly what was read
+        existing = SDL._sdl.get(A1NS, set(status_keys.values()) | set(metadata_keys.values())) if instance_ids else {}
+        # instances deleted since the listing are skipped
+        aggregates = {i: _empty_status() for i in instance_ids if metadata_keys[i] in existing}
+        handler_prefix = "{0}{1}.".format(HANDLER_PREFIX, policy_type_id)
+        for key, status in SDL.find_and_get(A1NS, handler_prefix).items():
+            policy_instance_id = _handler_instance_id(key[len(handler_prefix):], instance_ids)
+            if policy_instance_id in aggregates:
+                aggregates[policy_instance_id]["handlers"] += 1
+                aggregates[policy_instance_id]["ok"] += status == "OK"
+
+        for policy_instance_id, aggregate in aggregates.items():
+            status_key = status_keys[policy_instance_id]
+            old = existing.get(status_key)
+            if old is None:
+                SDL._sdl.set_if_not_exists(A1NS, status_key, msgpack.packb(aggregate, use_bin_type=True))
+                continue
+            # handler keys have no time, so the last update time is kept
+            old_aggregate = msgpack.unpackb(old, raw=False)
+            aggregate["updated_at"] = old_aggregate.get("updated_at")
+            if aggregate != old_aggregate:
+                SDL._sdl.set_if(A1NS, status_key, old, msgpack.packb(aggregate, use_bin_type=True))
+        reconciled += len(aggregates)
+    return reconciled
+
+
+# Queue spill
+
+
+_spill_seq = itertools.count()
+
+
+def _generate_spill_prefix(queue_name):
+    return "{0}{1}.".format(SPILL_PREFIX, queue_name)
+
+
+def spill_entries(queue_name, entries):
+    """
+    write entries of a full queue to SDL, after any spilled before them; answers their keys, which sort in spill order
+    """
+    prefix = _generate_spill_prefix(queue_name)
+    now = time.time_ns()
+    keys = ["{0}{1:020d}.{2}.{3:012d}".format(prefix, now, REPLICA_ID, next(_spill_seq)) for _ in entries]
+    _set_many_uncached(dict(zip(keys, entries)))
+    return keys
+
+
+def find_spilled_keys(queue_name):
+    """
+    answers the keys of the spilled entries of a queue, in spill order; this takes a key scan, so a queue keeps
+    the keys it spills and found, and only scans again once it took all of them
+    """
+    return sorted(SDL.find_keys(A1NS, _generate_spill_prefix(queue_name)))
+
+
+def take_spilled_entries(keys):
+    """
+    reads back and removes spilled entries, given their keys in spill order; answers those that were still there, in that order.
+    Replicas sharing the SDL drain the same spill, so each entry is claimed by removing it only if it is still what was read;
+    an entry another replica claimed first is left to that replica.
+    """
+    if not keys:
+        return []
+    values = SDL._sdl.get(A1NS, set(keys))
+    taken = []
+    for key in keys:
+        if key in values and SDL._sdl.remove_if(A1NS, key, values[key]):
+            taken.append(msgpack.unpackb(values[key], raw=False))
+    return taken
+
+
+# Indexes
+
+
+@metrics.data_function
+def build_indexes():
+    """
+    One-shot migration that builds the id index groups and status aggregates from the keys of an existing database.
+    Answers False if they were already built.
+    """
+    version = SDL.get(A1NS, INDEX_VERSION_KEY)
+    if version == INDEX_VERSION:
+        return False
+    if version is None:
+        _build_id_indexes()
+    mdc_logger.debug("Built the status aggregates of {0} instances".format(reconcile_statuses()))
+    SDL.set(A1NS, INDEX_VERSION_KEY, INDEX_VERSION)
+    return True
+
+
+def _build_id_indexes():
+    """
+    builds the id index groups; only key names and instance metadata are read
+    """
+
+    type_ids = [k[len(TYPE_PREFIX):] for k in SDL.find_keys(A1NS, TYPE_PREFIX)]
+    _add_members(TYPE_INDEX, type_ids)
+
+    instances = {}  # handler prefix -> (type id, instance id)
+    for key in SDL.find_keys(A1NS, INSTANCE_PREFIX):
+        policy_type_id, policy_instance_id = key[len(INSTANCE_PREFIX):].split(".", 1)
+        instances[_generate_handler_prefix(policy_type_id, policy_instance_id)] = (policy_type_id, policy_instance_id)
+    by_type = {}
+    for policy_type_id, policy_instance_id in instances.values():
+        by_type.setdefault(policy_type_id, []).append(policy_instance_id)
+    for policy_type_id, instance_ids in by_type.items():
+        _add_members(_generate_instance_index(policy_type_id), instance_ids)
+
+    # older versions of A1 lost deletions that were pending when they restarted; schedule those again
+    metadata = _get_many([_generate_instance_metadata_key(t, i) for t, i in instances.values()])
+    max_ttl = max(INSTANCE_DELETE_RESP_TTL, INSTANCE_DELETE_NO_RESP_TTL)
+    pendings = []
+    for policy_type_id, policy_instance_id in instances.values():
+        instance_metadata = metadata.get(_generate_instance_metadata_key(policy_type_id, policy_instance_id), {})
+        if instance_metadata.get("has_been_deleted"):
+            deadline = instance_metadata.get("deleted_at", 0) + max_ttl
+            pendings.append(json.dumps([int(policy_type_id), policy_instance_id, deadline]))
+    _add_members(PENDING_DELETE_INDEX, pendings)
+
+    # instance ids may contain dots, so match each handler key to the longest instance prefix
+    prefixes = sorted(instances, key=len, reverse=True)
+    by_instance = {}
+    for key in SDL.find_keys(A1NS, HANDLER_PREFIX):
+        prefix = next((p for p in prefixes if key.startswith(p)), None)
+        if prefix is None:
+            mdc_logger.warning("Not indexing handler key {0} of a non-existent instance".format(key))
+            continue
+        by_instance.setdefault(instances[prefix], []).append(key[len(prefix):])
+    for (policy_type_id, policy_instance_id), handler_ids in by_instance.items():
+        _add_members(_generate_handler_index(policy_type_id, policy_instance_id), handler_ids)
+
+    mdc_logger.debug("Indexed {0} types, {1} instances".format(len(type_ids), len(instances)))
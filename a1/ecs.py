@@ -0,0 +1,120 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Client of the A1-EI coordinator service (ECS)
+"""
+import os
+import json
+from concurrent.futures import ThreadPoolExecutor
+from threading import BoundedSemaphore, Lock
+from mdclogpy import Logger
+from a1 import metrics
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+
+ECS_SERVICE_HOST = os.environ.get("ECS_SERVICE_HOST", "http://ecs-service:8083")
+# seconds to wait for a connection to, and then for a response from, the ECS
+ECS_CONNECT_TIMEOUT = float(os.environ.get("A1_ECS_CONNECT_TIMEOUT", 3))
+ECS_READ_TIMEOUT = float(os.environ.get("A1_ECS_READ_TIMEOUT", 10))
+# number of requests to the ECS in flight at a time; this is also the number of kept alive connections
+ECS_WORKERS = int(os.environ.get("A1_ECS_WORKERS", 4))
+# number of requests that may wait for a worker before new ones are dropped
+ECS_MAX_PENDING = int(os.environ.get("A1_ECS_MAX_PENDING", 100))
+
+_pending_depth = metrics.queue_depth_gauge.labels(queue="ecs_pending")
+
+
+class EcsClient:
+    """
+    Calls the ECS from a pool of worker threads over one keep-alive session, so that a slow ECS
+    only delays the callers that need its answer. The session, and requests, are only loaded for the first call.
+    """
+
+    def __init__(self, workers=None, max_pending=None):
+        """
+        Parameters
+        ----------
+        workers: int (optional)
+            number of worker threads, default ECS_WORKERS
+        max_pending: int (optional)
+            number of submitted requests, running or waiting, beyond which submit() refuses work; default ECS_WORKERS + ECS_MAX_PENDING
+        """
+        self.workers = workers or ECS_WORKERS
+        self.ei_type_path = ECS_SERVICE_HOST + "/A1-EI/v1/eitypes"
+        self.ei_job_path = ECS_SERVICE_HOST + "/A1-EI/v1/eijobs/"
+        self.timeout = (ECS_CONNECT_TIMEOUT, ECS_READ_TIMEOUT)
+        self._session = None
+        self._session_lock = Lock()
+
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="a1-ecs")
+        self._slots = BoundedSemaphore(max_pending or self.workers + ECS_MAX_PENDING)
+
+    def submit(self, func, *args):
+        """
+        runs func(*args) on a worker; answers False, without running it, if too much work is pending
+        """
+        if not self._slots.acquire(blocking=False):
+            return False
+        _pending_depth.inc()
+        future = self._executor.submit(func, *args)
+        future.add_done_callback(self._done)
+        return True
+
+    def _done(self, _future):
+        _pending_depth.dec()
+        self._slots.release()
+
+    @property
+    def session(self):
+        """
+        the keep-alive session, created on first use
+        """
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests  # pylint: disable=import-outside-toplevel
+                    from requests.adapters import HTTPAdapter  # pylint: disable=import-outside-toplevel
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.workers)
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    self._session = session
+        return self._session
+
+    def get_ei_types(self):
+        """
+        answers the response to a query of all EI types
+        """
+        return self.session.get(self.ei_type_path, timeout=self.timeout)
+
+    def create_ei_job(self, ei_job_id, job):
+        """
+        answers the response to the creation of an EI job
+        """
+        headers = {'Content-type': 'application/json'}
+        return self.session.put(self.ei_job_path + ei_job_id, data=json.dumps(job), headers=headers, timeout=self.timeout)
+
+    def shutdown(self):
+        """
+        stops the workers once the submitted work is done
+        """
+        self._executor.shutdown(wait=False)
+        if self._session is not None:
+            self._session.close()
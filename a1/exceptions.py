@@ -45,3 +45,19 @@ class PolicyTypeAlreadyExists(A1Error):
 
 class PolicyTypeIdMismatch(A1Error):
     """a policy type request path ID differs from its body ID"""
+
+
+class BulkRequestTooLarge(A1Error):
+    """a bulk request has more items than allowed"""
+
+
+class InvalidCursor(A1Error):
+    """a paging cursor was not answered by A1, or was for a different listing"""
+
+
+class QueueFull(A1Error):
+    """a queue that rejects work when full has no room"""
+
+
+class RmrUnavailable(A1Error):
+    """the process that owns RMR can't be reached"""
@@ -0,0 +1,182 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Calls between the processes of one A1 over a unix socket, see a1/run.py
+"""
+import os
+import socket
+import struct
+from threading import Thread, Lock
+import msgpack
+from mdclogpy import Logger
+from a1.exceptions import QueueFull, RmrUnavailable
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+# each frame is a 4 byte big endian length followed by that many bytes of msgpack
+_LENGTH = struct.Struct(">I")
+# exceptions that are raised again in the caller; anything else fails the call with RmrUnavailable
+_EXCEPTIONS = {"QueueFull": QueueFull}
+
+
+def _send_frame(sock, obj):
+    body = msgpack.packb(obj, use_bin_type=True)
+    sock.sendall(_LENGTH.pack(len(body)) + body)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def _recv_frame(sock):
+    (size,) = _LENGTH.unpack(_recv_exactly(sock, _LENGTH.size))
+    return msgpack.unpackb(_recv_exactly(sock, size), raw=False)
+
+
+class Server:
+    """
+    Answers calls of the given functions, by name, from a thread per connection.
+    Arguments and results must be msgpack-able; tuples arrive as lists.
+    """
+
+    def __init__(self, path, functions):
+        """
+        Parameters
+        ----------
+        path: str
+            the unix socket to listen on; a stale one is replaced
+        functions: dict
+            name -> function that may be called
+        """
+        self.path = path
+        self.functions = functions
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(path)
+        self._sock.listen()
+        self._conns = set()
+        self._conns_lock = Lock()
+        self.thread = Thread(target=self._accept, daemon=True)
+        self.thread.start()
+
+    def _accept(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:  # closed by stop()
+                return
+            with self._conns_lock:
+                self._conns.add(conn)
+            Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        try:
+            while True:
+                name, args = _recv_frame(conn)
+                try:
+                    reply = {"result": self.functions[name](*args)}
+                except Exception as exc:  # pylint: disable=broad-except
+                    reply = {"error": type(exc).__name__, "message": str(exc)}
+                _send_frame(conn, reply)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self._conns_lock:
+                self._conns.discard(conn)
+            conn.close()
+
+    def stop(self):
+        """
+        stops accepting connections and closes the ones made
+        """
+        self._sock.close()
+        with self._conns_lock:
+            for conn in self._conns:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:  # already gone
+                    pass
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class Client:
+    """
+    Calls functions of a Server over one connection, made when first needed and made again if it breaks
+    (eg because the serving process was restarted). Safe to share between threads; calls take turns.
+    """
+
+    def __init__(self, path, timeout=5):
+        self.path = path
+        self.timeout = timeout
+        self._sock = None
+        self._lock = Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.path)
+        return sock
+
+    def _close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def call(self, name, *args):
+        """
+        answers what the named function answered; raises RmrUnavailable if the server can't be reached, or failed
+        with an exception the caller does not know how to answer.
+        A call is only retried if it failed before the request was sent: once sent, the server may have done it already,
+        so a failure while waiting for the reply (eg a timeout) is raised rather than doing it twice.
+        """
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self._sock = self._connect()
+                    _send_frame(self._sock, [name, args])
+                    break
+                except OSError as exc:
+                    # a connection made before the server restarted breaks on first use; try once more on a new one
+                    self._close()
+                    if attempt == 2:
+                        raise RmrUnavailable("{0} can't be reached: {1}".format(self.path, repr(exc))) from exc
+            try:
+                reply = _recv_frame(self._sock)
+            except OSError as exc:
+                self._close()
+                raise RmrUnavailable("{0} did not answer {1}: {2}".format(self.path, name, repr(exc))) from exc
+        if "error" in reply:
+            if reply["error"] in _EXCEPTIONS:
+                raise _EXCEPTIONS[reply["error"]](reply["message"])
+            # the owner failed to do it, which to the caller is no different from the owner being unreachable
+            raise RmrUnavailable("{0} failed {1}: {2}: {3}".format(self.path, name, reply["error"], reply["message"]))
+        return reply["result"]
+
+    def close(self):
+        with self._lock:
+            self._close()
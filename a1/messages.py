@@ -17,6 +17,25 @@
 """
 rmr messages
 """
+import json
+
+try:
+    import orjson  # optional, a much faster encoder
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(obj):
+    """
+    encodes obj to json bytes, with orjson when it is installed
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            # eg integers beyond 64 bits, which json handles
+            pass
+    return json.dumps(obj).encode("utf-8")
 
 
 def a1_to_handler(operation, policy_type_id, policy_instance_id, payload=None):
@@ -31,6 +50,19 @@ def a1_to_handler(operation, policy_type_id, policy_instance_id, payload=None):
     }
 
 
+def a1_to_handler_bytes(operation, policy_type_id, policy_instance_id, encoded_payload):
+    """
+    answers the same message as dumps(a1_to_handler(...)), given a payload that is already encoded with dumps;
+    the payload is copied in as is rather than encoded again
+    """
+    return b"".join((
+        b'{"operation":', dumps(operation),
+        b',"policy_type_id":', dumps(policy_type_id),
+        b',"policy_instance_id":', dumps(policy_instance_id),
+        b',"payload":', encoded_payload, b"}",
+    ))
+
+
 def ei_to_handler(ei_job_id, payload=None):
     """
     used to create the payloads that get sent to downstream policy handlers
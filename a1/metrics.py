@@ -0,0 +1,114 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Latency, throughput and queue metrics of the REST API, the data layer, SDL and RMR.
+
+All of these work with the multiprocess collector behind /a1-p/metrics. To keep the cost per
+observation low, labelled children are looked up once and reused wherever the label values are known up front.
+"""
+import functools
+import time
+from prometheus_client import Counter, Gauge, Histogram
+
+# most data layer and SDL calls take well under 5ms, the default buckets start there
+FAST_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, float("inf"))
+
+request_latency_histogram = Histogram('A1RequestLatency', 'Seconds to handle a REST request', ['endpoint', 'method', 'code'])
+data_latency_histogram = Histogram('A1DataLatency', 'Seconds spent in a data layer function', ['function'], buckets=FAST_BUCKETS)
+sdl_latency_histogram = Histogram('A1SdlLatency', 'Seconds spent in an SDL call', ['operation'], buckets=FAST_BUCKETS)
+rmr_received_counter = Counter('A1RmrReceived', 'RMR messages received', ['mtype'])
+rmr_sent_counter = Counter('A1RmrSent', 'RMR messages sent (kind send) or returned to sender (kind rts)', ['kind', 'mtype', 'result'])
+rmr_send_attempts_histogram = Histogram(
+    'A1RmrSendAttempts', 'Attempts an RMR send or rts took, retries included', ['kind'], buckets=(1, 2, 3, 4, 6, 8, 16, float("inf"))
+)
+rmr_loop_histogram = Histogram('A1RmrLoopIteration', 'Seconds to handle one batch of received RMR messages', buckets=FAST_BUCKETS)
+queue_depth_gauge = Gauge('A1QueueDepth', 'Work waiting in a queue', ['queue'], multiprocess_mode='livesum')
+
+
+def data_function(func):
+    """
+    decorator that observes the time spent in a data layer function, labelled with its name
+    """
+    child = data_latency_histogram.labels(function=func.__name__)
+
+    @functools.wraps(func)
+    def timed(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            child.observe(time.perf_counter() - start)
+
+    return timed
+
+
+class TimedStorage:
+    """
+    Sits in front of an SDL storage object (ricsdl SyncStorage) and observes the time spent in each call,
+    labelled with the name of the method called
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+        child = sdl_latency_histogram.labels(operation=name)
+
+        @functools.wraps(attr)
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - start)
+
+        # later lookups find the wrapper directly and skip __getattr__
+        setattr(self, name, timed)
+        return timed
+
+
+def observe_rmr_send(kind, mtype_name, attempts, ok):
+    """
+    counts one RMR send ("send") or return to sender ("rts") and the attempts it took
+    """
+    rmr_sent_counter.labels(kind=kind, mtype=mtype_name, result="ok" if ok else "failed").inc()
+    rmr_send_attempts_histogram.labels(kind=kind).observe(attempts)
+
+
+def instrument_app(flask_app):
+    """
+    observes the latency of every request the flask app handles, labelled with the route (not the path, which has ids in it)
+    """
+    # only processes serving the REST API need flask, see a1/__init__.py
+    from flask import request, g  # pylint: disable=import-outside-toplevel
+
+    @flask_app.before_request
+    def start_timer():  # pylint: disable=unused-variable
+        g.a1_request_start = time.perf_counter()
+
+    @flask_app.after_request
+    def observe_latency(response):  # pylint: disable=unused-variable
+        start = getattr(g, "a1_request_start", None)
+        if start is not None:
+            endpoint = request.url_rule.rule if request.url_rule is not None else "unmatched"
+            request_latency_histogram.labels(endpoint=endpoint, method=request.method, code=response.status_code).observe(
+                time.perf_counter() - start
+            )
+        return response
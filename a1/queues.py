@@ -0,0 +1,215 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Bounded in-memory queues that shed load, or spill to SDL, when they are full
+"""
+import itertools
+import os
+import queue
+from collections import deque
+from threading import Lock
+from mdclogpy import Logger
+from prometheus_client import Counter
+from a1 import data, metrics
+from a1.exceptions import QueueFull
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+# what a put into a full queue does
+DROP_OLDEST = "drop_oldest"  # make room by dropping the oldest entry
+REJECT = "reject"  # raise QueueFull, which the REST API answers with a 503 (or 429)
+SPILL = "spill"  # write the entry to SDL; spilled entries come back once the queue has drained
+POLICIES = (DROP_OLDEST, REJECT, SPILL)
+
+# how many spilled entries are read back from SDL at a time
+UNSPILL_BATCH_SIZE = int(os.environ.get("A1_UNSPILL_BATCH_SIZE", 100))
+
+overflow_counter = Counter('A1QueueOverflow', 'Entries put into a full queue, by queue and by what the queue did with them', ['queue', 'policy'])
+
+
+class BoundedQueue:
+    """
+    Thread safe FIFO that holds at most maxsize entries in memory, handling a put into a full queue according to its policy.
+
+    Once an entry has been spilled, later entries are spilled too until the spill has been read back,
+    so that entries still come out in the order they were put. The queue keeps the keys of the entries it spilled
+    (and of those found spilled at startup), so reading them back needs no key scan; it is done without holding the lock.
+    Entries are spilled with msgpack, which answers lists for tuples; subclasses that spill tuples restore them in _restore.
+    Has the subset of the queue.Queue interface that _RmrLoop uses.
+    """
+
+    def __init__(self, name, maxsize=0, policy=REJECT):
+        """
+        Parameters
+        ----------
+        name: str
+            names the queue in metrics, and its spilled entries in SDL
+        maxsize: int (optional)
+            the most entries held in memory; 0, the default, means no bound
+        policy: str (optional)
+            one of POLICIES, default REJECT
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown queue full policy {0}, expected one of {1}".format(policy, ", ".join(POLICIES)))
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        self._lock = Lock()
+        # held while reading back spilled entries, so that only one reader at a time takes from the front of the spill
+        self._unspill_lock = Lock()
+        self._overflow = overflow_counter.labels(queue=name, policy=policy)
+        self._spilled_depth = metrics.queue_depth_gauge.labels(queue=name + "_spilled")
+        # keys of the spilled entries, oldest first; entries spilled by an earlier run of A1 are sent too
+        self._spill_keys = deque(data.find_spilled_keys(name) if policy == SPILL else ())
+        self._spilled_depth.set(len(self._spill_keys))
+
+    # the in-memory entries, overridden by subclasses; callers hold the lock
+
+    def _merge(self, _entry):
+        """answers whether entry was merged into one already queued, so that it takes no room of its own"""
+        return False
+
+    def _append(self, entry):
+        raise NotImplementedError
+
+    def _popleft(self):
+        raise NotImplementedError
+
+    def _size(self):
+        raise NotImplementedError
+
+    def _restore(self, entry):
+        """answers a spilled entry as it was put"""
+        return entry
+
+    def _full(self, count=1):
+        return bool(self.maxsize) and self._size() + count > self.maxsize
+
+    def check_room(self, count=1):
+        """
+        raises QueueFull if the queue rejects puts and has no room for count more entries; a caller checks
+        before doing work that would be wasted if its put was rejected
+        """
+        with self._lock:
+            if self.policy == REJECT and self._full(count):
+                self._overflow.inc(count)
+                raise QueueFull("the {0} queue is full".format(self.name))
+
+    def put(self, entry):
+        """
+        queue an entry, or handle it according to the policy if the queue is full
+        """
+        with self._lock:
+            if not self._spill_keys:
+                if self._merge(entry):
+                    return
+                if not self._full():
+                    self._append(entry)
+                    return
+
+            if self.policy == REJECT:
+                self._overflow.inc()
+                raise QueueFull("the {0} queue is full".format(self.name))
+            self._overflow.inc()
+            if self.policy == DROP_OLDEST:
+                self._popleft()
+                self._append(entry)
+            else:
+                # spilled under the lock, so that the keys are kept in the order the entries were put
+                self._spill_keys.extend(data.spill_entries(self.name, [entry]))
+                self._spilled_depth.set(len(self._spill_keys))
+
+    def _unspill(self):
+        """
+        Reads back the oldest batch of spilled entries into memory. The keys stay queued while they are read,
+        so that puts meanwhile keep spilling behind them. Once all known keys are read back, the spill is scanned
+        once for entries other replicas spilled; entries another replica took first are skipped.
+        """
+        batch_size = min(UNSPILL_BATCH_SIZE, self.maxsize) if self.maxsize else UNSPILL_BATCH_SIZE
+        with self._unspill_lock:
+            with self._lock:
+                if self._size():  # another reader got here first
+                    return
+                keys = list(itertools.islice(self._spill_keys, batch_size))
+                last_batch = len(keys) == len(self._spill_keys)
+            if not keys:
+                return
+            try:
+                entries = data.take_spilled_entries(keys)
+                found = data.find_spilled_keys(self.name) if last_batch else []
+            except Exception as exc:  # pylint: disable=broad-except
+                mdc_logger.warning("Failed to read back spilled {0} entries, retrying later: {1}".format(self.name, repr(exc)))
+                return
+            with self._lock:
+                for _ in keys:
+                    self._spill_keys.popleft()
+                for entry in entries:
+                    # coalesced like a put, so that entries spilled one after the other still merge
+                    entry = self._restore(entry)
+                    if not self._merge(entry):
+                        self._append(entry)
+                if found:
+                    # keys spilled here meanwhile are found too; the scan sorts them all in spill order
+                    self._spill_keys = deque(sorted(set(self._spill_keys).union(found)))
+                self._spilled_depth.set(len(self._spill_keys))
+
+    def get(self, block=False, timeout=None):  # pylint: disable=unused-argument
+        """
+        answers the oldest entry; never blocks, raises queue.Empty instead
+        """
+        with self._lock:
+            if self._size():
+                return self._popleft()
+            if not self._spill_keys:
+                raise queue.Empty
+        self._unspill()
+        with self._lock:
+            if not self._size():
+                raise queue.Empty
+            return self._popleft()
+
+    def empty(self):
+        with self._lock:
+            return not self._size() and not self._spill_keys
+
+    def qsize(self):
+        """the number of entries in memory; spilled entries are not counted"""
+        with self._lock:
+            return self._size()
+
+
+class FifoQueue(BoundedQueue):
+    """
+    A BoundedQueue of tuples
+    """
+
+    def __init__(self, name, maxsize=0, policy=REJECT):
+        self._entries = deque()
+        super().__init__(name, maxsize, policy)
+
+    def _append(self, entry):
+        self._entries.append(entry)
+
+    def _popleft(self):
+        return self._entries.popleft()
+
+    def _size(self):
+        return len(self._entries)
+
+    def _restore(self, entry):
+        return tuple(entry)
@@ -17,27 +17,172 @@
 """
 A1 entrypoint
 """
+import glob
+import os
+import signal
+import socket
+import traceback
+import distutils.util
 from os import environ
 from gevent.pywsgi import WSGIServer
 from mdclogpy import Logger
-from a1 import app
-from a1 import a1rmr
+from prometheus_client import multiprocess
+import a1
+from a1 import a1rmr, coordination, data, warmup
 
 
 mdc_logger = Logger()
 mdc_logger.mdclog_format_init(configmap_monitor=True)
 
+PORT = 10000
+# number of processes serving the REST API; one of them also owns RMR and sends for the others
+WORKERS = int(environ.get("A1_WORKERS", 1))
+# where the process that owns RMR listens for the sends of the others
+RMR_OWNER_SOCKET = environ.get("A1_RMR_OWNER_SOCKET", "/tmp/a1-rmr-owner.sock")
+# coordinate the background work with the other replicas (and worker processes) sharing the SDL
+COORDINATION = bool(distutils.util.strtobool(environ.get("A1_COORDINATION", "True")))
 
-def main():
-    """Entrypoint"""
-    mdc_logger.debug("A1Mediator starts")
+
+def _build_indexes():
+    # databases written by older versions of A1 have no id indexes yet; this is a no-op once they are built
+    if data.build_indexes():
+        mdc_logger.debug("Built the policy type and instance indexes and the status aggregates")
+
+
+def _start_background_work():
+    """resumes the pending deletions, this replica's share of them if it coordinates with others"""
+    if COORDINATION:
+        coordination.start_coordination()
+    else:
+        mdc_logger.debug("Resumed {0} pending instance deletions".format(data.resume_deletions()))
+
+
+def _start_rmr():
+    """starts the rmr thread"""
     # start rmr thread
     mdc_logger.debug("Starting RMR thread with RMR_RTG_SVC {0}, RMR_SEED_RT {1}".format(environ.get('RMR_RTG_SVC'), environ.get('RMR_SEED_RT')))
     mdc_logger.debug("RMR initialization must complete before webserver can start")
     a1rmr.start_rmr_thread()
     mdc_logger.debug("RMR initialization complete")
+
+
+def main():
+    """Entrypoint"""
+    mdc_logger.debug("A1Mediator starts")
+    if WORKERS > 1:
+        _supervise_workers()
+        return
+    # build the app before starting any threads, which would compete with loading the API spec
+    app = a1.app
+    data.init_sdl()
+    _build_indexes()
+    warmup.start_warm_up()
+    _start_background_work()
+    _start_rmr()
     # start webserver
-    port = 10000
-    mdc_logger.debug("Starting gevent webserver on port {0}".format(port))
-    http_server = WSGIServer(("", port), app)
+    mdc_logger.debug("Starting gevent webserver on port {0}".format(PORT))
+    http_server = WSGIServer(("", PORT), app)
     http_server.serve_forever()
+
+
+def _worker(listener, owner, restarted):
+    """
+    body of a worker process; serves the REST API on the shared listener until killed.
+    The owner also runs the rmr thread and sends for the others.
+    """
+    # the supervisor never connects to SDL, so each worker has a connection of its own
+    data.init_sdl()
+    warmup.start_warm_up()
+    # each worker is a replica of its own; a replaced one takes over the deletions of its predecessor once that
+    # one's heartbeat expires, or right away without coordination
+    if COORDINATION or restarted or owner:
+        _start_background_work()
+    if owner:
+        _start_rmr()
+        a1rmr.serve_rmr_workers(RMR_OWNER_SOCKET)
+    else:
+        a1rmr.connect_rmr_owner(RMR_OWNER_SOCKET)
+    mdc_logger.debug("Worker {0} serving on port {1}{2}".format(os.getpid(), PORT, ", owning RMR" if owner else ""))
+    WSGIServer(listener, a1.app).serve_forever()
+
+
+def _fork_worker(listener, owner, restarted):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        try:
+            _worker(listener, owner, restarted)
+        except BaseException:  # pylint: disable=broad-except
+            mdc_logger.error("Worker {0} failed: {1}".format(os.getpid(), traceback.format_exc()))
+        os._exit(1)  # never return into the supervisor's code
+    return pid
+
+
+def _run_in_child(func):
+    """
+    runs func in a child process and waits for it, so that whatever threads it starts stay out of the supervisor
+    """
+    pid = os.fork()
+    if pid == 0:
+        try:
+            func()
+        except BaseException:  # pylint: disable=broad-except
+            mdc_logger.error("{0} failed: {1}".format(func.__name__, traceback.format_exc()))
+            os._exit(1)
+        os._exit(0)
+    _, status = os.waitpid(pid, 0)
+    multiprocess.mark_process_dead(pid)
+    if status:
+        raise RuntimeError("{0} failed, see the log".format(func.__name__))
+
+
+def _clear_metrics():
+    """
+    removes the metric files of earlier runs; their pids may be reused, which would add stale values to live ones
+    """
+    directory = environ.get("prometheus_multiproc_dir", environ.get("PROMETHEUS_MULTIPROC_DIR"))
+    if directory:
+        for name in ("counter", "gauge_*", "histogram", "summary"):
+            for path in glob.glob(os.path.join(directory, "{0}_[0-9]*.db".format(name))):
+                os.unlink(path)
+
+
+def _supervise_workers():
+    """
+    runs A1_WORKERS worker processes that share one listening socket, the first of them owning RMR,
+    and replaces any that exit. The supervisor itself starts no threads, so forking it is safe.
+    """
+    _clear_metrics()
+    _run_in_child(_build_indexes)
+    # load the API spec and build the app once, here, rather than in every worker
+    a1.app  # pylint: disable=pointless-statement
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(("", PORT))
+    listener.listen(1024)
+    listener.setblocking(False)  # gevent waits for connections itself
+
+    owner_pid = _fork_worker(listener, True, False)
+    workers = {_fork_worker(listener, False, False) for _ in range(WORKERS - 1)}
+
+    def stop(_signum, _frame):
+        for pid in workers | {owner_pid}:
+            os.kill(pid, signal.SIGTERM)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, stop)
+    while True:
+        pid, status = os.wait()
+        mdc_logger.warning("Worker {0} exited with status {1}, replacing it".format(pid, status))
+        # gauges of the dead worker stop counting toward /a1-p/metrics
+        multiprocess.mark_process_dead(pid)
+        if pid == owner_pid:
+            owner_pid = _fork_worker(listener, True, True)
+        else:
+            workers.discard(pid)
+            workers.add(_fork_worker(listener, False, True))
+
+
+def reconcile():
+    """Rebuilds the instance status aggregates from the handler statuses"""
+    print("Reconciled the status of {0} policy instances".format(data.reconcile_statuses()))
@@ -0,0 +1,124 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Runs work at a deadline from a single thread
+"""
+import heapq
+import itertools
+import time
+from threading import Thread, Condition
+from mdclogpy import Logger
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+# seconds to wait before retrying a batch whose callback raised, eg because SDL was briefly unavailable
+RETRY_DELAY = 1
+
+
+class DeadlineScheduler:
+    """
+    Keeps a heap of (deadline, key) and hands the keys whose deadline has passed to a callback,
+    in batches, from one thread. This replaces a sleeping thread per piece of work.
+    Deadlines are wall clock (time.time()) so that they can be persisted and resumed by another process.
+    A key that is already scheduled is not scheduled again, so resuming persisted work more than once is cheap.
+    """
+
+    def __init__(self, callback, batch_size=100, depth_gauge=None):
+        """
+        Parameters
+        ----------
+        callback: function
+            called with a list of at most batch_size due keys
+        batch_size: int (optional)
+            the most keys handed to one callback
+        depth_gauge: prometheus_client.Gauge (optional)
+            set to the number of scheduled keys whenever it changes
+        """
+        self.callback = callback
+        self.batch_size = batch_size
+        self.depth_gauge = depth_gauge
+        self.keep_going = True
+        self._heap = []
+        self._scheduled = set()
+        self._seq = itertools.count()  # tie breaker, so keys never have to be compared
+        self._cond = Condition()
+
+        self.thread = Thread(target=self.loop, daemon=True)
+        self.thread.start()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def _depth_changed(self):
+        """caller must hold the lock"""
+        if self.depth_gauge is not None:
+            self.depth_gauge.set(len(self._heap))
+
+    def schedule(self, key, deadline):
+        """
+        run the callback for key once time.time() passes deadline, unless key is scheduled already
+        """
+        with self._cond:
+            if key in self._scheduled:
+                return
+            self._scheduled.add(key)
+            heapq.heappush(self._heap, (deadline, next(self._seq), key))
+            self._depth_changed()
+            self._cond.notify()
+
+    def _take_due(self):
+        """
+        waits until something is due and answers it, at most batch_size keys; answers [] when stopping
+        """
+        with self._cond:
+            while self.keep_going:
+                now = time.time()
+                due = []
+                while self._heap and self._heap[0][0] <= now and len(due) < self.batch_size:
+                    key = heapq.heappop(self._heap)[2]
+                    self._scheduled.discard(key)
+                    due.append(key)
+                if due:
+                    self._depth_changed()
+                    return due
+                self._cond.wait(self._heap[0][0] - now if self._heap else None)
+            return []
+
+    def loop(self):
+        """
+        hands due keys to the callback until stopped
+        """
+        while self.keep_going:
+            due = self._take_due()
+            if not due:
+                continue
+            try:
+                self.callback(due)
+            except Exception as exc:  # pylint: disable=broad-except
+                mdc_logger.warning("Scheduled work failed, retrying in {0}s: {1}".format(RETRY_DELAY, repr(exc)))
+                for key in due:
+                    self.schedule(key, time.time() + RETRY_DELAY)
+
+    def stop(self):
+        """
+        stops the thread; anything still scheduled is dropped (persist it if it matters)
+        """
+        with self._cond:
+            self.keep_going = False
+            self._cond.notify()
@@ -0,0 +1,104 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Compiled policy instance validators, cached per policy type and version
+"""
+from threading import Lock
+from jsonschema.validators import validator_for
+from jsonschema.exceptions import best_match
+from prometheus_client import Counter
+
+
+validator_cache_counters = Counter('A1SchemaValidatorCache', 'Policy type validator cache lookups', ['result'])
+
+# policy types cannot be replaced, only deleted and created again, maybe by another process; a compiled validator
+# is kept with the version of the type it was compiled for (see data.get_type_validator) and only used for that version
+_VALIDATORS = {}  # policy_type_id -> (version, validator)
+_VALIDATORS_LOCK = Lock()
+
+
+def compile_validator(schema):
+    """
+    checks a create_schema and builds a validator for it; raises SchemaError if the schema itself is bad
+    """
+    cls = validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def cache_validator(policy_type_id, version, validator):
+    """
+    remember the compiled validator for a version of a type
+    """
+    with _VALIDATORS_LOCK:
+        _VALIDATORS[policy_type_id] = (version, validator)
+
+
+def evict_validator(policy_type_id):
+    """
+    forget the compiled validator for a type
+    """
+    with _VALIDATORS_LOCK:
+        _VALIDATORS.pop(policy_type_id, None)
+
+
+def clear_validators():
+    """
+    forget all compiled validators
+    """
+    with _VALIDATORS_LOCK:
+        _VALIDATORS.clear()
+
+
+def get_validator(policy_type_id, version, schema_loader):
+    """
+    retrieve the compiled validator for a version of a type
+    schema_loader is only called on a miss, including a validator of another version, and answers the create_schema
+    """
+    with _VALIDATORS_LOCK:
+        entry = _VALIDATORS.get(policy_type_id)
+    if entry is not None and entry[0] == version:
+        validator_cache_counters.labels(result='hit').inc()
+        return entry[1]
+
+    validator_cache_counters.labels(result='miss').inc()
+    validator = compile_validator(schema_loader())
+    cache_validator(policy_type_id, version, validator)
+    return validator
+
+
+def validate_instance(validator, instance):
+    """
+    validate an instance against the compiled create_schema of its type, see get_validator
+    raises the same ValidationError that jsonschema.validate would
+    """
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+
+def validate_instances(validator, instances):
+    """
+    validate several instances of a type, given as a dict of policy_instance_id to instance, against the compiled
+    create_schema of the type. answers a dict of policy_instance_id to ValidationError for the instances that are not valid
+    """
+    errors = {}
+    for policy_instance_id, instance in instances.items():
+        error = best_match(validator.iter_errors(instance))
+        if error is not None:
+            errors[policy_instance_id] = error
+    return errors
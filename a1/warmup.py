@@ -0,0 +1,96 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Warms up the caches of a starting process, and tells when it is ready to take traffic
+"""
+import os
+import time
+import distutils.util
+from concurrent.futures import ThreadPoolExecutor
+from threading import Event, Thread
+from mdclogpy import Logger
+from prometheus_client import Gauge
+from a1 import data
+
+mdc_logger = Logger(name=__name__)
+mdc_logger.mdclog_format_init(configmap_monitor=True)
+
+# load the policy types, compile their schemas and (if the data layer caches) load the instance metadata before
+# reporting ready; without it, a process is ready right away and the first requests pay for this instead
+WARM_UP = bool(distutils.util.strtobool(os.environ.get("A1_WARM_UP", "True")))
+# types or instances read from SDL at a time, and the number of batches read at the same time
+WARM_UP_BATCH_SIZE = int(os.environ.get("A1_WARM_UP_BATCH_SIZE", 100))
+WARM_UP_WORKERS = int(os.environ.get("A1_WARM_UP_WORKERS", 4))
+
+warm_up_gauge = Gauge('A1WarmUpSeconds', 'Seconds the last startup warm-up took', multiprocess_mode='max')
+
+_READY = Event()
+
+
+def _batches(ids, batch_size):
+    for start in range(0, len(ids), batch_size):
+        yield ids[start:start + batch_size]
+
+
+def warm_up(batch_size=None, workers=None):
+    """
+    loads every policy type, compiles its schema and, if the data layer caches, loads the metadata of every instance,
+    in batches of batch_size read by workers threads; answers the number of types and instances loaded
+    """
+    batch_size = batch_size or WARM_UP_BATCH_SIZE
+    with ThreadPoolExecutor(max_workers=workers or WARM_UP_WORKERS, thread_name_prefix="a1-warmup") as executor:
+        type_ids = data.get_type_list()
+        futures = [executor.submit(data.warm_policy_types, batch) for batch in _batches(type_ids, batch_size)]
+        if data.caching_enabled():
+            for policy_type_id, instance_ids in zip(type_ids, executor.map(data.get_instance_list, type_ids)):
+                futures.extend(
+                    executor.submit(data.warm_instance_metadata, policy_type_id, batch) for batch in _batches(instance_ids, batch_size)
+                )
+        return sum(future.result() for future in futures)
+
+
+def _warm_up_and_report():
+    started = time.perf_counter()
+    try:
+        loaded = warm_up()
+        mdc_logger.debug("Warmed up {0} policy types and instances".format(loaded))
+    except Exception as exc:  # pylint: disable=broad-except
+        # the caches fill on demand anyway, so a failed warm-up only costs latency
+        mdc_logger.warning("Warm-up failed, serving with cold caches: {0}".format(repr(exc)))
+    elapsed = time.perf_counter() - started
+    warm_up_gauge.set(elapsed)
+    mdc_logger.debug("Warm-up took {0:.3f}s".format(elapsed))
+    _READY.set()
+
+
+def start_warm_up():
+    """
+    warms up in a background thread, if A1_WARM_UP is on, so that the healthcheck is served meanwhile;
+    is_ready() answers True once it is done
+    """
+    if not WARM_UP:
+        _READY.set()
+        return
+    _READY.clear()
+    Thread(target=_warm_up_and_report, daemon=True).start()
+
+
+def is_ready():
+    """
+    answers whether the warm-up is done
+    """
+    return _READY.is_set()
@@ -0,0 +1,283 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Offline benchmarks of the A1 data layer, REST API and RMR loop.
+
+Runs against the fake SDL, optionally with a delay added to every SDL call to stand in for the
+round trip to a DBaaS, and with RMR sends mocked out; the RMR library itself must be installed.
+Reports throughput and p50/p99 latency per operation, RMR send buffer allocations and payload copies per
+operation where there were any, and can save the results as a baseline and
+compare a later run against it:
+
+    python benchmarks/bench.py --save baseline.json
+    python benchmarks/bench.py --compare baseline.json
+"""
+import argparse
+import importlib
+import json
+import os
+import queue
+import sys
+import tempfile
+import time
+
+# both are read when a1 is imported
+os.environ.setdefault("USE_FAKE_SDL", "True")
+os.environ.setdefault("prometheus_multiproc_dir", tempfile.mkdtemp())
+
+from ricxappframe.rmr.rmr_mocks import rmr_mocks  # noqa: E402
+from a1 import a1rmr, data, app, messages  # noqa: E402
+from benchutil import compare, measure, report  # noqa: E402
+
+TYPE_ID = 20000
+POLICY_TYPE = {
+    "name": "benchmark",
+    "description": "benchmark policy type",
+    "policy_type_id": TYPE_ID,
+    "create_schema": {
+        "$schema": "http://json-schema.org/draft-07/schema#",
+        "type": "object",
+        "properties": {
+            "class": {"type": "integer", "minimum": 1, "maximum": 256},
+            "enforce": {"type": "boolean"},
+            "window_length": {"type": "integer", "minimum": 15, "maximum": 300},
+        },
+        "required": ["class", "enforce", "window_length"],
+        "additionalProperties": False,
+    },
+}
+INSTANCE = {"class": 12, "enforce": True, "window_length": 20}
+HANDLERS = ["handler_a", "handler_b", "handler_c"]
+
+
+class LatencyStorage:
+    """
+    Stands in for the SDL storage backend, adding a fixed delay to every call
+    """
+
+    def __init__(self, storage, latency):
+        self._storage = storage
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+
+        def delayed(*args, **kwargs):
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+
+        return delayed
+
+
+class _Patcher:
+    """the subset of pytest's monkeypatch that rmr_mocks.patch_rmr uses"""
+
+    @staticmethod
+    def setattr(target, value):
+        module, name = target.rsplit(".", 1)
+        setattr(importlib.import_module(module), name, value)
+
+
+class _BatchFeeder:
+    """
+    Receive function for an _RmrLoop that hands it one batch at a time and records when the loop
+    comes back for more, which it only does once it has handled the previous batch
+    """
+
+    def __init__(self):
+        self._batches = queue.Queue()
+        self._handled = queue.Queue()
+        self._outstanding = False
+
+    def rcv(self):
+        if self._outstanding:
+            self._outstanding = False
+            self._handled.put(None)
+        try:
+            batch = self._batches.get(timeout=0.1)
+        except queue.Empty:
+            return []
+        self._outstanding = True
+        return batch
+
+    def run(self, batch):
+        """hands the loop a batch and waits until it has been handled"""
+        self._batches.put(batch)
+        self._handled.get()
+
+
+def _instance_id(group, i):
+    return "{0}-{1}".format(group, i)
+
+
+def data_benchmarks():
+    """the a1/data.py operations"""
+
+    def iid(i):
+        return _instance_id("data", i)
+
+    yield "data.store_policy_instance", lambda i: data.store_policy_instance(TYPE_ID, iid(i), INSTANCE)
+    yield "data.get_policy_instance", lambda i: data.get_policy_instance(TYPE_ID, iid(i))
+    yield "data.get_instance_list", lambda i: data.get_instance_list(TYPE_ID)
+    yield "data.set_policy_instance_status", lambda i: data.set_policy_instance_status(TYPE_ID, iid(i), HANDLERS[i % len(HANDLERS)], "OK")
+    yield "data.get_policy_instance_status", lambda i: data.get_policy_instance_status(TYPE_ID, iid(i))
+    yield "data.get_policy_type", lambda i: data.get_policy_type(TYPE_ID)
+    yield "data.get_type_list", lambda i: data.get_type_list()
+    yield "data.delete_policy_instance", lambda i: data.delete_policy_instance(TYPE_ID, iid(i))
+
+
+def rest_benchmarks():
+    """the REST endpoints"""
+    client = app.app.test_client()
+    policies = "/a1-p/policytypes/{0}/policies".format(TYPE_ID)
+
+    def instance_url(i):
+        return "{0}/{1}".format(policies, _instance_id("rest", i))
+
+    def check(res, code):
+        if res.status_code != code:
+            raise RuntimeError("{0} answered {1}".format(res.request.path, res.status_code))
+
+    etags = {}
+
+    def get_instance(i):
+        res = client.get(instance_url(i))
+        check(res, 200)
+        etags[i] = res.headers["ETag"]
+
+    yield "PUT instance", lambda i: check(client.put(instance_url(i), json=INSTANCE), 202)
+    yield "GET instance", get_instance
+    yield "GET instance (not modified)", lambda i: check(client.get(instance_url(i), headers={"If-None-Match": etags[i]}), 304)
+    yield "GET instance status", lambda i: check(client.get(instance_url(i) + "/status"), 200)
+    yield "GET instance list", lambda i: check(client.get(policies), 200)
+    yield "GET type", lambda i: check(client.get("/a1-p/policytypes/{0}".format(TYPE_ID)), 200)
+    yield "GET type list", lambda i: check(client.get("/a1-p/policytypes"), 200)
+    yield "GET healthcheck", lambda i: check(client.get("/a1-p/healthcheck"), 200)
+    yield "DELETE instance", lambda i: check(client.delete(instance_url(i)), 202)
+
+
+def rmr_benchmarks(batch_size, feeder, loop):
+    """batches of received RMR messages, handled by the RMR loop, and batches of sends"""
+    for i in range(batch_size):
+        data.store_policy_instance(TYPE_ID, _instance_id("rmr", i), INSTANCE)
+
+    def response(i):
+        pay = {"policy_type_id": TYPE_ID, "policy_instance_id": _instance_id("rmr", i % batch_size), "handler_id": HANDLERS[i % len(HANDLERS)], "status": "OK"}
+        return ({"payload": json.dumps(pay).encode(), "message type": a1rmr.A1_POLICY_RESPONSE}, None)
+
+    responses = [response(i) for i in range(batch_size)]
+    query = json.dumps({"policy_type_id": TYPE_ID}).encode()
+
+    encoded = data.encode_policy_instance(TYPE_ID, _instance_id("rmr", 0), INSTANCE)
+    sends = [messages.a1_to_handler_bytes("CREATE", TYPE_ID, _instance_id("rmr", i), encoded) for i in range(batch_size)]
+
+    def send_all(_):
+        for payload in sends:
+            loop._send_msg(payload, a1rmr.A1_POLICY_REQUEST, TYPE_ID)
+
+    def handle_responses(_):
+        feeder.run(responses)
+        # the loop hands the statuses to its workers, the batch is done once they are written
+        loop.status_workers.join()
+
+    yield "rmr.policy_responses[{0}]".format(batch_size), handle_responses
+    yield "rmr.policy_sends[{0}]".format(batch_size), send_all
+    yield "rmr.policy_query[{0} instances]".format(batch_size), lambda i: feeder.run([
+        ({"payload": query, "message type": a1rmr.A1_POLICY_QUERY}, rmr_mocks.Rmr_mbuf_t())
+    ])
+
+
+def _send_counts(loop):
+    """
+    answers the send buffer counts of the given loop and the module's loop added up, see a1rmr._SendBufferPool
+    """
+    counts = dict(loop.send_buffers.stats)
+    for event, count in a1rmr.__RMR_LOOP__.send_buffers.stats.items():
+        counts[event] += count
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200, help="calls per benchmark")
+    parser.add_argument("--batch-size", type=int, default=100, help="messages per received RMR batch, and instances per policy query")
+    parser.add_argument("--sdl-latency-ms", type=float, default=0, help="delay added to every SDL call")
+    parser.add_argument("--only", action="append", choices=["data", "rest", "rmr"], help="run only these groups")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline; exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown tolerated by --compare")
+    args = parser.parse_args(argv)
+    groups = args.only or ["data", "rest", "rmr"]
+
+    if args.sdl_latency_ms:
+        data.SDL._sdl = LatencyStorage(data.SDL._sdl, args.sdl_latency_ms / 1000)
+
+    rmr_mocks.patch_rmr(_Patcher)
+    _Patcher.setattr("ricxappframe.rmr.rmr.rmr_send_msg", rmr_mocks.send_mock_generator(0))
+    _Patcher.setattr("ricxappframe.rmr.rmr.rmr_rts_msg", lambda mrc, sbuf, payload=None, mtype=None: rmr_mocks.send_mock_generator(0)(mrc, sbuf))
+
+    # the REST API queues its sends on the module's loop; received batches are handled by a loop of our own
+    feeder = _BatchFeeder()
+    a1rmr.start_rmr_thread(init_func_override=lambda: None, rcv_func_override=lambda: [])
+    loop = a1rmr._RmrLoop(init_func_override=lambda: None, rcv_func_override=feeder.rcv)
+    loop.rcv_blocks = True  # the feeder waits for batches itself
+
+    data.store_policy_type(TYPE_ID, POLICY_TYPE)
+    benchmarks = {
+        "data": data_benchmarks,
+        "rest": rest_benchmarks,
+        "rmr": lambda: rmr_benchmarks(args.batch_size, feeder, loop),
+    }
+    results = {}
+    try:
+        for group in groups:
+            for name, func in benchmarks[group]():
+                before = _send_counts(loop)
+                results[name] = measure(func, args.iterations)
+                # sends queued by the REST API go out from the module's loop, give it a moment to drain
+                time.sleep(0.05)
+                after = _send_counts(loop)
+                if after["copy"] != before["copy"]:
+                    results[name]["send_allocs_per_op"] = (after["alloc"] - before["alloc"]) / args.iterations
+                    results[name]["payload_copies_per_op"] = (after["copy"] - before["copy"]) / args.iterations
+    finally:
+        loop.keep_going = False
+        a1rmr.stop_rmr_thread()
+
+    baseline = {}
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        for setting in ("batch_size", "sdl_latency_ms"):
+            if saved["settings"].get(setting) != getattr(args, setting):
+                print("warning: the baseline was taken with {0}={1}".format(setting, saved["settings"].get(setting)), file=sys.stderr)
+        regressions = compare(results, baseline, args.tolerance)
+    report(results, baseline, regressions)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Measuring, comparing and reporting shared by the benchmarks; importing it has no side effects
+"""
+import time
+
+
+def _percentile(ordered, fraction):
+    return ordered[int(round(fraction * (len(ordered) - 1)))]
+
+
+def measure(func, iterations):
+    """
+    calls func(0) .. func(iterations - 1) and answers the throughput and latency percentiles
+    """
+    durations = []
+    start = time.perf_counter()
+    for i in range(iterations):
+        t = time.perf_counter()
+        func(i)
+        durations.append(time.perf_counter() - t)
+    total = time.perf_counter() - start
+    durations.sort()
+    return {
+        "iterations": iterations,
+        "ops_per_sec": iterations / total,
+        "p50_ms": _percentile(durations, 0.5) * 1000,
+        "p99_ms": _percentile(durations, 0.99) * 1000,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    answers the names of the benchmarks that got slower than the baseline by more than tolerance
+    """
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if (
+            result["ops_per_sec"] < base["ops_per_sec"] * (1 - tolerance)
+            or result["p50_ms"] > base["p50_ms"] * (1 + tolerance)
+            or result["p99_ms"] > base["p99_ms"] * (1 + tolerance)
+        ):
+            regressions.append(name)
+    return regressions
+
+
+def report(results, baseline, regressions):
+    """
+    prints a table of the results, with the change of each against the baseline, if any
+    """
+    print("{0:<40} {1:>12} {2:>10} {3:>10} {4:>10} {5:>10}  {6}".format(
+        "benchmark", "ops/s", "p50 ms", "p99 ms", "allocs/op", "copies/op", "vs baseline p50" if baseline else ""
+    ))
+    for name, result in results.items():
+        note = ""
+        if name in baseline:
+            note = "{0:+.0%}".format(result["p50_ms"] / baseline[name]["p50_ms"] - 1) if baseline[name]["p50_ms"] else ""
+            if name in regressions:
+                note += "  REGRESSION"
+        allocs, copies = ("{0:.2f}".format(result[k]) if k in result else "-" for k in ("send_allocs_per_op", "payload_copies_per_op"))
+        print("{0:<40} {1:>12.1f} {2:>10.3f} {3:>10.3f} {4:>10} {5:>10}  {6}".format(
+            name, result["ops_per_sec"], result["p50_ms"], result["p99_ms"], allocs, copies, note
+        ))
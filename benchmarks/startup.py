@@ -0,0 +1,110 @@
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+"""
+Offline benchmark of A1 startup.
+
+Launches A1 (run-a1) with the fake SDL again and again, and reports how long it takes from the launch until
+it serves its first request, and how long importing its entrypoint takes; the RMR library must be installed.
+Like bench.py, it can save the results as a baseline and compare a later run against it:
+
+    python benchmarks/startup.py --save startup.json
+    python benchmarks/startup.py --compare startup.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+from benchutil import compare, measure, report
+
+PORT = 10000
+
+
+def _env():
+    env = dict(os.environ, USE_FAKE_SDL="True")
+    env.setdefault("prometheus_multiproc_dir", tempfile.mkdtemp())
+    return env
+
+
+def _run_a1_command():
+    run_a1 = shutil.which("run-a1")
+    return [run_a1] if run_a1 else [sys.executable, "-c", "from a1.run import main; main()"]
+
+
+def launch_until_served(command, url, timeout):
+    """
+    launches command, waits until url answers 200, then stops it; answers the seconds until the 200
+    """
+    started = time.perf_counter()
+    proc = subprocess.Popen(command, env=_env(), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            if proc.poll() is not None:
+                raise RuntimeError("{0} exited with {1}".format(command, proc.returncode))
+            try:
+                with urllib.request.urlopen(url, timeout=1) as res:
+                    if res.status == 200:
+                        return time.perf_counter() - started
+            except (urllib.error.URLError, ConnectionError):  # not listening yet, or not healthy yet
+                pass
+            time.sleep(0.01)
+        raise RuntimeError("{0} did not answer {1} within {2}s".format(command, url, timeout))
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="launches per benchmark")
+    parser.add_argument("--path", default="/a1-p/healthcheck", help="the request waited for")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for one launch to serve")
+    parser.add_argument("--save", metavar="FILE", help="save the results as a baseline")
+    parser.add_argument("--compare", metavar="FILE", help="compare against a saved baseline; exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative slowdown tolerated by --compare")
+    args = parser.parse_args(argv)
+
+    url = "http://localhost:{0}{1}".format(PORT, args.path)
+    imports = [sys.executable, "-c", "import a1.run"]
+    results = {
+        "import a1.run": measure(lambda i: subprocess.run(imports, env=_env(), check=True), args.runs),
+        "run-a1 to first request": measure(lambda i: launch_until_served(_run_a1_command(), url, args.timeout), args.runs),
+    }
+
+    baseline = {}
+    regressions = []
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.tolerance)
+    report(results, baseline, regressions)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2, sort_keys=True)
+
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
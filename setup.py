@@ -23,8 +23,10 @@
     author="Tommy Carpenter",
     description="RIC A1 Mediator for policy/intent changes",
     url="https://gerrit.o-ran-sc.org/r/admin/repos/ric-plt/a1",
-    entry_points={"console_scripts": ["run-a1=a1.run:main"]},
+    entry_points={"console_scripts": ["run-a1=a1.run:main", "a1-reconcile-statuses=a1.run:reconcile"]},
     # we require jsonschema, should be in that list, but connexion already requires a specific version of it
     install_requires=["requests", "Flask", "connexion[swagger-ui]", "gevent", "prometheus-client", "mdclogpy", "ricxappframe>=2.0.0,<3.0.0"],
+    # orjson is used to encode policy messages when installed
+    extras_require={"fast-json": ["orjson"]},
     package_data={"a1": ["openapi.yaml"]},
 )
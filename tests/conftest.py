@@ -20,7 +20,8 @@
 import tempfile
 import os
 import pytest
-from a1 import app
+from a1 import app, data
+from a1.cache import LruCache
 
 
 @pytest.fixture
@@ -39,6 +40,16 @@ def client():
     os.unlink(app.app.config["DATABASE"])
 
 
+@pytest.fixture
+def lru_cache(monkeypatch):
+    """
+    an empty data layer cache, plugged in for the one test
+    """
+    cache = LruCache(100, 0)
+    monkeypatch.setattr(data, "_CACHE", cache)
+    yield cache
+
+
 @pytest.fixture
 def adm_type_good():
     """
@@ -0,0 +1,128 @@
+"""
+tests for the data layer cache
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import time
+from ricxappframe.xapp_sdl import SDLWrapper
+from a1 import data
+from a1.cache import LruCache, MISSING
+
+
+def test_lru_eviction():
+    """
+    the least recently used entry goes first
+    """
+    cache = LruCache(2, 0)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1  # b is now the least recently used
+    cache.put("c", 3)
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert len(cache) == 2
+
+
+def test_ttl_expiry():
+    """
+    entries expire after ttl seconds
+    """
+    cache = LruCache(10, 0.05)
+    cache.put("a", 1)
+    assert cache.get("a") == 1
+    time.sleep(0.1)
+    assert cache.get("a") is MISSING
+
+
+def test_fill_loses_race_with_invalidation():
+    """
+    a value read before an invalidation must not be cached after it
+    """
+    cache = LruCache(10, 0)
+    generation = cache.generation
+    cache.invalidate("a")  # eg another replica wrote "a" while we were reading it
+    cache.fill("a", "old", generation)
+    assert cache.get("a") is MISSING
+
+    generation = cache.generation
+    cache.fill("a", "new", generation)
+    assert cache.get("a") == "new"
+
+
+def test_fill_loses_race_with_put():
+    """
+    a value read before a write-through put must not replace the value put
+    """
+    cache = LruCache(10, 0)
+    generation = cache.generation
+    cache.put("a", "v2")  # we wrote "a" while another thread was reading it
+    cache.fill("a", "v1", generation)
+    assert cache.get("a") == "v2"
+
+
+def test_fill_races_only_with_its_key():
+    """
+    a change of one key does not drop the fills of others, unless it is forgotten or the cache is cleared
+    """
+    cache = LruCache(2, 0)
+    generation = cache.generation
+    cache.put("a", 1)
+    cache.invalidate("b")
+    cache.fill("c", 3, generation)
+    assert cache.get("c") == 3
+
+    generation = cache.generation
+    cache.put("d", 4)
+    cache.put("e", 5)
+    cache.put("f", 6)  # "d" is forgotten, so a fill of it may have raced
+    cache.fill("d", "old", generation)
+    assert cache.get("d") is MISSING
+
+    generation = cache.generation
+    cache.clear()
+    cache.fill("g", 7, generation)
+    assert cache.get("g") is MISSING
+
+
+def test_data_write_through_and_remote_invalidation(monkeypatch, lru_cache, adm_type_good):
+    """
+    writes go through the cache, and invalidations from other replicas drop entries
+    """
+    monkeypatch.setattr(data, "SDL", SDLWrapper(use_fake_sdl=True))
+    tid = adm_type_good["policy_type_id"]
+    key = data._generate_type_key(tid)
+    data.store_policy_type(tid, adm_type_good)
+    assert lru_cache.get(key) == adm_type_good
+
+    # reads are served from the cache, even if SDL changed underneath without telling us
+    changed = dict(adm_type_good, description="changed elsewhere")
+    data.SDL.set(data.A1NS, key, changed)
+    assert data.get_policy_type(tid) == adm_type_good
+
+    # another replica tells us it changed the key
+    data._on_invalidation(data.CACHE_INVALIDATION_CHANNEL, ["someotherreplica:" + key])
+    assert lru_cache.get(key) is MISSING
+    assert data.get_policy_type(tid) == changed
+    assert lru_cache.get(key) == changed
+
+    # our own events are ignored, we wrote through already
+    data._on_invalidation(data.CACHE_INVALIDATION_CHANNEL, [data._invalidation_event(key)])
+    assert lru_cache.get(key) == changed
+
+    data.delete_policy_type(tid)
+    assert lru_cache.get(key) is MISSING
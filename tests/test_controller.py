@@ -18,11 +18,13 @@
 #   limitations under the License.
 # ==================================================================================
 import time
+import threading
 import json
+import pytest
 from ricxappframe.rmr.rmr_mocks import rmr_mocks
 from ricxappframe.xapp_sdl import SDLWrapper
 from ricsdl.exceptions import RejectedByBackend, NotConnected, BackendError
-from a1 import a1rmr, data
+from a1 import a1rmr, controller, data, ipc, validation, warmup
 
 RCV_ID = "test_receiver"
 ADM_CRTL_TID = 6660666
@@ -392,6 +394,355 @@ def test_illegal_types(client, adm_type_good):
     assert res.status_code == 400
 
 
+def test_validator_cache(client, adm_type_good, adm_instance_good):
+    """
+    test that compiled validators are cached when a type is stored and evicted when it is deleted
+    """
+    res = client.put(ADM_CTRL_TYPE, json=adm_type_good)
+    assert res.status_code == 201
+    assert ADM_CRTL_TID in validation._VALIDATORS
+
+    # a miss (eg after a restart) reloads the schema and validates just the same
+    validation.clear_validators()
+    res = client.put(ADM_CTRL_INSTANCE, json={"not": "expected"})
+    assert res.status_code == 400
+    assert ADM_CRTL_TID in validation._VALIDATORS
+
+    # another process deleted the type and created it again with another schema
+    recreated = dict(adm_type_good, create_schema=dict(adm_type_good["create_schema"], required=["notthere"]))
+    data.SDL.set(data.A1NS, data._generate_type_key(ADM_CRTL_TID), recreated)
+    data.SDL.set(data.A1NS, data._generate_type_version_key(ADM_CRTL_TID), data._type_version(recreated))
+    res = client.put(ADM_CTRL_INSTANCE, json=adm_instance_good)
+    assert res.status_code == 400
+
+    res = client.delete(ADM_CTRL_TYPE)
+    assert res.status_code == 204
+    assert ADM_CRTL_TID not in validation._VALIDATORS
+
+    # a type with a broken schema is rejected outright
+    bad_type = dict(adm_type_good, create_schema={"type": "notatype"})
+    res = client.put(ADM_CTRL_TYPE, json=bad_type)
+    assert res.status_code == 400
+    res = client.get(ADM_CTRL_TYPE)
+    assert res.status_code == 404
+
+
+def test_sends_do_not_wait_for_the_loop(monkeypatch):
+    """
+    a queued send goes out right away rather than on the next loop iteration
+    """
+    rmr_mocks.patch_rmr(monkeypatch)
+    sent = []
+
+    def send_and_record(_mrc, sbuf):
+        sent.append(sbuf.contents.payload)
+        return rmr_mocks.send_mock_generator(0)(_mrc, sbuf)
+
+    monkeypatch.setattr("ricxappframe.rmr.rmr.rmr_send_msg", send_and_record)
+    a1rmr.queue_instance_send(("CREATE", ADM_CRTL_TID, "fast", {}))
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.01)
+    assert len(sent) == 1
+    assert json.loads(sent[0])["policy_instance_id"] == "fast"
+
+
+def test_send_failures_do_not_stop_the_send_thread(monkeypatch):
+    """
+    a message that can't be sent is dropped, and the ones behind it still go out
+    """
+    rmr_mocks.patch_rmr(monkeypatch)
+    sent = []
+
+    def send_or_fail(_mrc, sbuf):
+        if json.loads(sbuf.contents.payload)["policy_instance_id"] == "broken":
+            raise ValueError("broken")
+        sent.append(sbuf.contents.payload)
+        return rmr_mocks.send_mock_generator(0)(_mrc, sbuf)
+
+    monkeypatch.setattr("ricxappframe.rmr.rmr.rmr_send_msg", send_or_fail)
+    a1rmr.queue_instance_sends([("CREATE", ADM_CRTL_TID, "broken", {}), ("CREATE", ADM_CRTL_TID, "fine", {})])
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.01)
+    assert [json.loads(s)["policy_instance_id"] for s in sent] == ["fine"]
+    assert a1rmr.__RMR_LOOP__.send_thread.is_alive()
+
+
+def test_send_buffer_pool(monkeypatch):
+    """
+    sends reuse pooled buffers, and only a failed send builds a message summary
+    """
+    rmr_mocks.patch_rmr(monkeypatch)
+    monkeypatch.setattr("ricxappframe.rmr.rmr.rmr_send_msg", rmr_mocks.send_mock_generator(0))
+    loop = a1rmr.__RMR_LOOP__
+    pool = a1rmr._SendBufferPool(None, depth=1)
+    monkeypatch.setattr(loop, "send_buffers", pool)
+    summarized = []
+    monkeypatch.setattr("ricxappframe.rmr.rmr.message_summary", lambda sbuf: summarized.append(sbuf) or {})
+
+    for i in range(3):
+        loop._send_msg(b"x" * 100, a1rmr.A1_POLICY_REQUEST, i)
+    assert pool.stats == {"alloc": 1, "reuse": 2, "free": 0, "copy": 3}
+    assert summarized == []
+
+    # a payload larger than any pooled buffer gets one of its own; the mocks report a capacity of 4096, so it is kept
+    sbuf = pool.take(b"x" * 100000, a1rmr.A1_POLICY_REQUEST, 1)
+    assert pool.stats["alloc"] == 2
+    pool.give(sbuf)
+    assert pool.stats["free"] == 1  # the 4096 class already holds its one idle buffer
+
+    monkeypatch.setattr("ricxappframe.rmr.rmr.rmr_send_msg", rmr_mocks.send_mock_generator(10))
+    loop._send_msg(b"x" * 100, a1rmr.A1_POLICY_REQUEST, 1)
+    assert len(summarized) == 1
+    pool.clear()
+    assert pool.stats["free"] == 2
+
+
+def test_status_workers(monkeypatch):
+    """
+    statuses of one instance are written in the order they arrived, different instances in parallel
+    """
+    written = []
+
+    def slow_set(statuses):
+        time.sleep(0.001)
+        written.extend((policy_instance_id, status, threading.current_thread()) for _, policy_instance_id, _, status in statuses)
+        return set()
+
+    monkeypatch.setattr(data, "set_policy_instance_statuses", slow_set)
+    workers = a1rmr._StatusWorkers(workers=4)
+    for i in range(20):
+        for iid in ("a", "b", "c"):
+            workers.put(ADM_CRTL_TID, iid, RCV_ID, i)
+    workers.join()
+    for iid in ("a", "b", "c"):
+        assert [status for i, status, _ in written if i == iid] == list(range(20))
+        assert len({thread for i, _, thread in written if i == iid}) == 1
+    assert len({thread for _, _, thread in written}) == len({hash((ADM_CRTL_TID, iid)) % 4 for iid in "abc"})
+    workers.stop()
+
+
+def test_coalesced_sends():
+    """
+    only the newest pending message per instance goes out, with the operations merged
+    """
+    q = a1rmr._InstanceSendQueue()
+    q.put((("CREATE", 1, "a", {"v": 1}), 1.0))
+    q.put((("CREATE", 1, "b", {"v": 1}), 2.0))
+    q.put((("UPDATE", 1, "a", {"v": 2}), 3.0))  # still a CREATE, handlers never saw a
+    q.put((("DELETE", 1, "b", ""), 4.0))  # cancels the pending CREATE of b
+    q.put((("UPDATE", 1, "c", {"v": 1}), 5.0))
+    q.put((("DELETE", 1, "c", ""), 6.0))
+    q.put((("DELETE", 1, "d", ""), 7.0))
+    q.put((("CREATE", 1, "d", {"v": 2}), 8.0))  # handlers had d, so they get the new body as an update
+
+    assert q.qsize() == 3
+    assert q.get() == (("CREATE", 1, "a", {"v": 2}), 1.0)
+    assert q.get() == (("DELETE", 1, "c", ""), 5.0)
+    assert q.get() == (("UPDATE", 1, "d", {"v": 2}), 7.0)
+    assert q.empty()
+
+
+def test_bulk_instances(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    test creating and deleting many instances in one request
+    """
+    rmr_mocks.patch_rmr(monkeypatch)
+    sent = []
+
+    def send_and_record(_mrc, sbuf):
+        sent.append(json.loads(sbuf.contents.payload))
+        return rmr_mocks.send_mock_generator(0)(_mrc, sbuf)
+
+    monkeypatch.setattr("ricxappframe.rmr.rmr.rmr_send_msg", send_and_record)
+
+    res = client.post(ADM_CTRL_POLICIES, json={"put": {"a": adm_instance_good}})
+    assert res.status_code == 404
+
+    _put_ac_type(client, adm_type_good)
+    res = client.post(ADM_CTRL_POLICIES, json={
+        "put": {"a": adm_instance_good, "b": {"not": "expected"}, "c": adm_instance_good},
+        "delete": ["c", "zz"],
+    })
+    assert res.status_code == 200
+    assert [(r["policy_instance_id"], r["operation"], r["status"]) for r in res.json["results"]] == [
+        ("a", "PUT", 202), ("b", "PUT", 400), ("c", "PUT", 400), ("c", "DELETE", 400), ("zz", "DELETE", 404)
+    ]
+    assert client.get(ADM_CTRL_POLICIES).json == ["a"]
+    assert client.get(ADM_CTRL_POLICIES + "/a").json == adm_instance_good
+    res = client.get(ADM_CTRL_TYPE + "/status?instance_status=NOT IN EFFECT&has_been_deleted=false")
+    assert [(r["policy_instance_id"], r["instance_status"]) for r in res.json] == [("a", "NOT IN EFFECT")]
+    assert client.get(ADM_CTRL_TYPE + "/status?instance_status=IN EFFECT").json == []
+
+    max_items = controller.BULK_MAX_ITEMS
+    monkeypatch.setattr(controller, "BULK_MAX_ITEMS", 1)
+    res = client.post(ADM_CTRL_POLICIES, json={"put": {"a": adm_instance_good}, "delete": ["a"]})
+    assert res.status_code == 413
+    monkeypatch.setattr(controller, "BULK_MAX_ITEMS", max_items)
+
+    # a delete queued before the create went out would cancel it, see test_coalesced_sends
+    for _ in range(50):
+        if sent:
+            break
+        time.sleep(0.01)
+    res = client.post(ADM_CTRL_POLICIES, json={"delete": ["a"]})
+    assert [r["status"] for r in res.json["results"]] == [202]
+    assert client.get(ADM_CTRL_POLICIES + "/a/status").json["has_been_deleted"] is True
+
+    for _ in range(10):
+        if client.get(ADM_CTRL_POLICIES).json == []:
+            break
+        time.sleep(1)
+    _delete_ac_type(client)
+    assert [(m["operation"], m["policy_instance_id"]) for m in sent] == [("CREATE", "a"), ("DELETE", "a")]
+
+
+def test_paging(client, adm_type_good):
+    """
+    test paging through, and streaming, the type list
+    """
+    type_ids = [ADM_CRTL_TID + i for i in range(5)]
+    for type_id in type_ids:
+        res = client.put("/a1-p/policytypes/{0}".format(type_id), json=dict(adm_type_good, policy_type_id=type_id))
+        assert res.status_code == 201
+
+    pages = []
+    res = client.get("/a1-p/policytypes?limit=2")
+    pages.append(res.json)
+    while "X-Next-Cursor" in res.headers:
+        res = client.get("/a1-p/policytypes?limit=2&cursor={0}".format(res.headers["X-Next-Cursor"]))
+        pages.append(res.json)
+    assert pages == [type_ids[:2], type_ids[2:4], type_ids[4:]]
+
+    # a cursor of the instance listing is no good here
+    res = client.get("/a1-p/policytypes?cursor=ImEi")
+    assert res.status_code == 400
+    res = client.get("/a1-p/policytypes?cursor=notbase64!")
+    assert res.status_code == 400
+
+    res = client.get("/a1-p/policytypes?limit=4", headers={"Accept": "application/x-ndjson"})
+    assert res.status_code == 200
+    assert res.mimetype == "application/x-ndjson"
+    assert [json.loads(line) for line in res.data.decode().splitlines()] == type_ids[:4]
+    assert "X-Next-Cursor" in res.headers
+
+    for type_id in type_ids:
+        res = client.delete("/a1-p/policytypes/{0}".format(type_id))
+        assert res.status_code == 204
+
+
+def test_conditional_get(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    types, instances and statuses carry an ETag, and a client that has the current version gets a 304
+    """
+    _put_ac_type(client, adm_type_good)
+    res = client.get(ADM_CTRL_TYPE)
+    etag = res.headers["ETag"]
+    res = client.get(ADM_CTRL_TYPE, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+    assert res.headers["ETag"] == etag
+    assert res.data == b""
+
+    _put_ac_instance(client, monkeypatch, adm_instance_good)
+    res = client.get(ADM_CTRL_INSTANCE)
+    assert res.json == adm_instance_good
+    instance_etag = res.headers["ETag"]
+    assert client.get(ADM_CTRL_INSTANCE, headers={"If-None-Match": instance_etag}).status_code == 304
+    res = client.get(ADM_CTRL_INSTANCE_STATUS)
+    status_etag = res.headers["ETag"]
+    assert client.get(ADM_CTRL_INSTANCE_STATUS, headers={"If-None-Match": status_etag}).status_code == 304
+
+    # a second read of an unchanged instance is served from the response cache, without reading the instance
+    monkeypatch.setattr(data, "get_versioned_policy_instance", lambda *args: pytest.fail("instance read"))
+    res = client.get(ADM_CTRL_INSTANCE)
+    assert res.status_code == 200
+    assert res.json == adm_instance_good
+    monkeypatch.undo()
+
+    # a status change is a new version of the status, not of the instance
+    data.set_policy_instance_status(ADM_CRTL_TID, ADM_CTRL_IID, "handler", "OK")
+    res = client.get(ADM_CTRL_INSTANCE_STATUS, headers={"If-None-Match": status_etag})
+    assert res.status_code == 200
+    assert res.json["instance_status"] == "IN EFFECT"
+    assert res.headers["ETag"] != status_etag
+    assert client.get(ADM_CTRL_INSTANCE, headers={"If-None-Match": instance_etag}).status_code == 304
+
+    # replacing the instance makes a new version
+    _test_put_patch(monkeypatch)
+    changed = dict(adm_instance_good, window_length=adm_instance_good["window_length"] + 1)
+    assert client.put(ADM_CTRL_INSTANCE, json=changed).status_code == 202
+    res = client.get(ADM_CTRL_INSTANCE, headers={"If-None-Match": instance_etag})
+    assert res.status_code == 200
+    assert res.json == changed
+    assert res.headers["ETag"] != instance_etag
+
+    # types stored before types had versions are versioned by their body
+    data.SDL.delete(data.A1NS, data._generate_type_version_key(ADM_CRTL_TID))
+    res = client.get(ADM_CTRL_TYPE, headers={"If-None-Match": etag})
+    assert res.status_code == 304
+
+    # so is marking the status deleted
+    status_etag = client.get(ADM_CTRL_INSTANCE_STATUS).headers["ETag"]
+    _delete_instance(client)
+    res = client.get(ADM_CTRL_INSTANCE_STATUS, headers={"If-None-Match": status_etag})
+    assert res.status_code == 200
+    assert res.json["has_been_deleted"] is True
+
+    _instance_is_gone(client)
+    assert client.get(ADM_CTRL_INSTANCE, headers={"If-None-Match": res.headers["ETag"]}).status_code == 404
+    _delete_ac_type(client)
+
+
+def test_full_send_queue(client, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    a full send queue that rejects work tells clients to retry later, without storing what it could not send
+    """
+    _put_ac_type(client, adm_type_good)
+    loop = a1rmr.__RMR_LOOP__
+    monkeypatch.setattr(loop.instance_send_queue, "_full", lambda count=1: True)
+    monkeypatch.setattr(loop.ei_job_result_queue, "_full", lambda count=1: True)
+
+    res = client.put(ADM_CTRL_INSTANCE, json=adm_instance_good)
+    assert res.status_code == 503
+    assert res.headers["Retry-After"] == "1"
+    assert client.get(ADM_CTRL_INSTANCE).status_code == 404
+    res = client.post(ADM_CTRL_POLICIES, json={"put": {"a": adm_instance_good}})
+    assert res.status_code == 503
+    assert client.get(ADM_CTRL_POLICIES).json == []
+    res = client.post("/data-delivery", json={"job": "1", "payload": "x"})
+    assert res.status_code == 503
+
+    monkeypatch.setattr(controller, "QUEUE_FULL_STATUS", 429)
+    assert client.put(ADM_CTRL_INSTANCE, json=adm_instance_good).status_code == 429
+    _delete_ac_type(client)
+
+
+def test_rmr_owner_unavailable(client, monkeypatch, tmp_path, adm_type_good, adm_instance_good):
+    """
+    a worker tells clients to retry later when the process owning rmr can't be reached, or fails to queue the send
+    """
+    _put_ac_type(client, adm_type_good)
+
+    def broken(*_args):
+        raise ValueError("broken")
+
+    path = str(tmp_path / "owner.sock")
+    monkeypatch.setattr(a1rmr, "__RMR_OWNER__", ipc.Client(path, timeout=1))
+    assert client.put(ADM_CTRL_INSTANCE, json=adm_instance_good).status_code == 503
+
+    server = ipc.Server(path, {"check_instance_send_room": broken, "queue_instance_sends": broken})
+    try:
+        assert client.put(ADM_CTRL_INSTANCE, json=adm_instance_good).status_code == 503
+    finally:
+        a1rmr.__RMR_OWNER__.close()
+        server.stop()
+    assert client.get(ADM_CTRL_INSTANCE).status_code == 404
+    _delete_ac_type(client)
+
+
 def test_healthcheck(client):
     """
     test healthcheck
@@ -400,6 +751,38 @@ def test_healthcheck(client):
     assert res.status_code == 200
 
 
+def test_readiness(client, monkeypatch, lru_cache, adm_type_good):
+    """
+    a1 is ready once warm-up has loaded the types and compiled their schemas
+    """
+    res = client.put(ADM_CTRL_TYPE, json=adm_type_good)
+    assert res.status_code == 201
+    validation.clear_validators()
+    lru_cache.clear()
+    monkeypatch.setattr(warmup, "WARM_UP", True)
+    blocked = threading.Event()
+    monkeypatch.setattr(data, "get_type_list", lambda real=data.get_type_list: blocked.wait() and real())
+
+    warmup.start_warm_up()
+    res = client.get("/a1-p/readiness")
+    assert res.status_code == 503
+    assert client.get("/a1-p/healthcheck").status_code == 200
+
+    blocked.set()
+    for _ in range(50):
+        if warmup.is_ready():
+            break
+        time.sleep(0.01)
+    res = client.get("/a1-p/readiness")
+    assert res.status_code == 200
+    assert ADM_CRTL_TID in validation._VALIDATORS
+    assert lru_cache.get(data._generate_type_key(ADM_CRTL_TID)) == adm_type_good
+    assert warmup.warm_up_gauge._value.get() > 0
+
+    res = client.delete(ADM_CTRL_TYPE)
+    assert res.status_code == 204
+
+
 def test_metrics(client):
     """
     test Prometheus metrics
@@ -407,7 +790,19 @@ def test_metrics(client):
     res = client.get("/a1-p/metrics")
     assert res.status_code == 200
 
+    # requests are labelled with their route, and earlier tests sent and received rmr messages
+    res = client.get("/a1-p/metrics")
+    text = res.data.decode()
+    assert 'A1RequestLatency_count{code="200",endpoint="/a1-p/metrics",method="GET"}' in text
+    assert 'A1RmrReceived_total{mtype="A1_POLICY_RESPONSE"}' in text
+    assert 'A1RmrSent_total{kind="send",mtype="A1_POLICY_REQUEST",result="ok"}' in text
+    assert 'A1QueueDepth{queue="instance_send"}' in text
+    assert 'A1QueueOverflow_total{policy="reject",queue="instance_send"}' in text
+
 
 def teardown_module():
     """module teardown"""
-    a1rmr.stop_rmr_thread()
+    # the send thread frees its pooled buffers as it stops, which were allocated by the rmr mocks
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        rmr_mocks.patch_rmr(monkeypatch)
+        a1rmr.stop_rmr_thread()
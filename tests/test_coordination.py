@@ -0,0 +1,174 @@
+"""
+tests for the coordination of replicas
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import time
+import pytest
+from ricxappframe.xapp_sdl import SDLWrapper
+from a1 import coordination, data
+
+TID = 6660666
+
+
+class _Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def fake_sdl(monkeypatch):
+    """
+    a fresh, empty fake SDL for every test, shared by all replicas
+    """
+    sdl = SDLWrapper(use_fake_sdl=True)
+    monkeypatch.setattr(data, "SDL", sdl)
+    yield sdl
+    data.set_ownership(None)
+
+
+def _replicas(clock, count=3):
+    replicas = [coordination.Coordinator(replica_id="r{0}".format(i), ttl=10, clock=clock) for i in range(count)]
+    for _ in range(2):  # the first round finds the replicas that ticked before
+        for r in replicas:
+            r.tick()
+    return replicas
+
+
+def _owners(replicas, keys):
+    return {k: [r.replica_id for r in replicas if r.owns(k)] for k in keys}
+
+
+def test_leader_and_partitions(fake_sdl):
+    """
+    the replicas agree on one leader, and each key is owned by exactly one of them
+    """
+    replicas = _replicas(_Clock())
+    assert [r.is_leader for r in replicas].count(True) == 1
+    assert all(r.members == ("r0", "r1", "r2") for r in replicas)
+    owners = _owners(replicas, range(300))
+    assert all(len(o) == 1 for o in owners.values())
+    assert all(40 < [o[0] for o in owners.values()].count(r.replica_id) for r in replicas)
+
+
+def test_failover(fake_sdl):
+    """
+    a replica that stops beating loses its leadership and its keys, and only its keys move
+    """
+    clock = _Clock()
+    replicas = _replicas(clock)
+    leader = next(r for r in replicas if r.is_leader)
+    others = [r for r in replicas if r is not leader]
+    before = _owners(replicas, range(300))
+    changes = []
+    others[0].on_change(lambda: changes.append(others[0].members))
+
+    clock.now += 5
+    for r in others:
+        r.tick()
+    assert not any(r.is_leader for r in others)  # the lease is still good
+
+    clock.now += 6
+    for _ in range(2):
+        for r in others:
+            r.tick()
+    assert [r.is_leader for r in others].count(True) == 1
+    assert changes == [tuple(sorted(r.replica_id for r in others))]
+    after = _owners(others, range(300))
+    assert all(len(o) == 1 for o in after.values())
+    assert all(after[k] == before[k] for k in before if before[k] != [leader.replica_id])
+
+    # the leader cleans up heartbeats that are long gone
+    clock.now += 11
+    for r in others:
+        r.tick()
+    assert len(fake_sdl.find_keys(data.A1NS, coordination.REPLICA_PREFIX)) == 2
+
+
+def test_stop_hands_over(fake_sdl):
+    """
+    a replica that leaves hands over right away
+    """
+    replicas = _replicas(_Clock())
+    leader = next(r for r in replicas if r.is_leader)
+    leader.stop()
+    others = [r for r in replicas if r is not leader]
+    for r in others:
+        r.tick()
+    assert [r.is_leader for r in others].count(True) == 1
+    assert all(leader.replica_id not in r.members for r in others)
+
+
+def test_leader_jobs(fake_sdl):
+    """
+    jobs run on the leader only, every interval, unless they are for every replica
+    """
+    clock = _Clock()
+    ran = []
+    replicas = [coordination.Coordinator(replica_id=i, ttl=10, clock=clock) for i in ("r0", "r1")]
+    for r in replicas:
+        r.add_job(lambda r=r: ran.append(("leader", r.replica_id)), 5)
+        r.add_job(lambda r=r: ran.append(("every", r.replica_id)), 0, leader_only=False)
+        r.tick()
+    leader = next(r for r in replicas if r.is_leader).replica_id
+    assert ran == []  # a job first runs one interval after the first tick
+
+    for _ in range(6):
+        clock.now += 1
+        for r in replicas:
+            r.tick()
+    assert ran.count(("leader", leader)) == 1
+    assert len([j for j in ran if j[0] == "leader"]) == 1
+    assert ran.count(("every", "r0")) == ran.count(("every", "r1")) == 6
+
+
+def test_deletions_are_partitioned(fake_sdl, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    each pending deletion is done by the replica that owns it, and by another one once the owner is gone
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 0)
+    clock = _Clock()
+    mine, theirs = _replicas(clock, 2)
+    data.set_ownership(mine.owns)
+
+    data.store_policy_type(TID, adm_type_good)
+    iids = [str(i) for i in range(20)]
+    data.store_policy_instances(TID, {i: adm_instance_good for i in iids})
+    data.delete_policy_instances(TID, iids)
+    owned = [i for i in iids if any(mine.owns(p) for p in _pending(fake_sdl, i))]
+    assert 0 < len(owned) < len(iids)
+
+    deadline = time.time() + 5
+    while time.time() < deadline and len(data.get_instance_list(TID)) > len(iids) - len(owned):
+        time.sleep(0.05)
+    assert data.get_instance_list(TID) == sorted(set(iids) - set(owned))
+
+    # the other replica leaves; its deletions are ours now
+    theirs.stop()
+    mine.on_change(data.resume_deletions)
+    mine.tick()
+    deadline = time.time() + 5
+    while time.time() < deadline and data.get_instance_list(TID):
+        time.sleep(0.05)
+    assert data.get_instance_list(TID) == []
+
+
+def _pending(fake_sdl, policy_instance_id):
+    return [p for p in fake_sdl.get_members(data.A1NS, data.PENDING_DELETE_INDEX) if '"{0}"'.format(policy_instance_id) in p]
@@ -0,0 +1,428 @@
+"""
+tests for the data layer
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import json
+import time
+import msgpack
+import pytest
+from ricxappframe.xapp_sdl import SDLWrapper
+from a1 import data, messages
+from a1.exceptions import PolicyTypeNotFound, PolicyInstanceNotFound
+
+TID = 6660666
+IID = "x"
+
+
+class _CountingStorage:
+    """
+    sits between the SDL wrapper and the SDL storage, recording every call; each call is one round trip
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self.calls = []
+
+    def __getattr__(self, name):
+        attr = getattr(self._storage, name)
+        if not callable(attr):
+            return attr
+
+        def counted(*args, **kwargs):
+            self.calls.append(name)
+            return attr(*args, **kwargs)
+
+        return counted
+
+
+@pytest.fixture
+def fake_sdl(monkeypatch):
+    """
+    a fresh, empty fake SDL for every test
+    """
+    sdl = SDLWrapper(use_fake_sdl=True)
+    monkeypatch.setattr(data, "SDL", sdl)
+    yield sdl
+
+
+@pytest.fixture
+def round_trips(fake_sdl):
+    """
+    records the SDL calls made through data.SDL
+    """
+    counter = _CountingStorage(fake_sdl._sdl)
+    fake_sdl._sdl = counter
+    yield counter.calls
+
+
+def test_build_indexes(fake_sdl, adm_type_good, adm_instance_good):
+    """
+    a database written before indexes existed gets them built from its keys
+    """
+    # the way older versions of A1 wrote things; note the dots in an instance id
+    fake_sdl.set(data.A1NS, data._generate_type_key(TID), adm_type_good)
+    for iid in ["a", "a.b"]:
+        fake_sdl.set(data.A1NS, data._generate_instance_key(TID, iid), adm_instance_good)
+        fake_sdl.set(data.A1NS, data._generate_instance_metadata_key(TID, iid), {"created_at": 0, "has_been_deleted": False})
+    fake_sdl.set(data.A1NS, data._generate_handler_key(TID, "a", "h1"), "OK")
+    fake_sdl.set(data.A1NS, data._generate_handler_key(TID, "a.b", "h2"), "OK")
+
+    assert data.get_type_list() == []
+
+    assert data.build_indexes()
+    assert not data.build_indexes()  # one-shot
+
+    assert data.get_type_list() == [TID]
+    assert data.get_instance_list(TID) == ["a", "a.b"]
+    assert fake_sdl.get_members(data.A1NS, data._generate_handler_index(TID, "a")) == {"h1"}
+    assert fake_sdl.get_members(data.A1NS, data._generate_handler_index(TID, "a.b")) == {"h2"}
+    assert data.get_policy_instance_status(TID, "a.b")["instance_status"] == "IN EFFECT"
+
+
+def test_status_aggregates(fake_sdl, adm_type_good, adm_instance_good):
+    """
+    status writes keep the aggregate of the instance up to date, and reconcile_statuses rebuilds it from the handlers
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instance(TID, IID, adm_instance_good)
+    status_key = data._generate_status_key(TID, IID)
+
+    def aggregate():
+        agg = fake_sdl.get(data.A1NS, status_key)
+        return agg["handlers"], agg["ok"]
+
+    assert aggregate() == (0, 0)
+    data.set_policy_instance_status(TID, IID, "h1", "OK")
+    data.set_policy_instance_status(TID, IID, "h2", "NOTOK")
+    data.set_policy_instance_status(TID, IID, "h1", "OK")  # repeated, counted once
+    assert aggregate() == (2, 1)
+    data.set_policy_instance_status(TID, IID, "h1", "NOTOK")
+    assert aggregate() == (2, 0)
+    assert data.get_policy_instance_status(TID, IID)["instance_status"] == "NOT IN EFFECT"
+    data.set_policy_instance_status(TID, IID, "h2", "OK")
+    assert data.get_policy_instance_status(TID, IID)["instance_status"] == "IN EFFECT"
+    updated_at = fake_sdl.get(data.A1NS, status_key)["updated_at"]
+    assert updated_at
+
+    # an aggregate that went wrong, or went missing, is rebuilt from the handler keys
+    fake_sdl.set(data.A1NS, status_key, {"handlers": 7, "ok": 0, "updated_at": updated_at})
+    data.store_policy_instance(TID, "y", adm_instance_good)
+    data.set_policy_instance_status(TID, "y", "h1", "OK")
+    fake_sdl.delete(data.A1NS, data._generate_status_key(TID, "y"))
+    assert data.reconcile_statuses() == 2
+    assert aggregate() == (2, 1)
+    assert fake_sdl.get(data.A1NS, status_key)["updated_at"] == updated_at
+    assert data.get_policy_instance_status(TID, "y")["instance_status"] == "IN EFFECT"
+
+    # replacing an instance resets its aggregate
+    data.store_policy_instance(TID, IID, adm_instance_good)
+    assert aggregate() == (0, 0)
+
+
+def test_reconcile_races(fake_sdl, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    reconcile_statuses leaves alone the aggregates that changed, and the instances that went away, while it scanned
+    """
+    data.store_policy_type(TID, adm_type_good)
+    for policy_instance_id in (IID, "gone"):
+        data.store_policy_instance(TID, policy_instance_id, adm_instance_good)
+        data.set_policy_instance_status(TID, policy_instance_id, "h1", "OK")
+    fake_sdl.set(data.A1NS, data._generate_status_key(TID, IID), {"handlers": 7, "ok": 0, "updated_at": None})
+
+    real_find_and_get = fake_sdl.find_and_get
+
+    def find_and_get_then_change(ns, prefix):
+        found = real_find_and_get(ns, prefix)
+        data.store_policy_instance(TID, IID, adm_instance_good)  # replaced, so no handlers and an empty aggregate
+        fake_sdl.delete(data.A1NS, data._generate_status_key(TID, "gone"))
+        return found
+
+    monkeypatch.setattr(fake_sdl, "find_and_get", find_and_get_then_change)
+    assert data.reconcile_statuses() == 2
+    assert fake_sdl.get(data.A1NS, data._generate_status_key(TID, IID))["handlers"] == 0
+    assert data.get_policy_instance_status(TID, IID)["instance_status"] == "NOT IN EFFECT"
+    assert fake_sdl.get(data.A1NS, data._generate_status_key(TID, "gone")) is None
+
+
+def test_listing_does_not_fetch_values(round_trips, adm_type_good, adm_instance_good):
+    """
+    listing and existence checks only read ids
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instance(TID, IID, adm_instance_good)
+
+    del round_trips[:]
+    assert data.get_type_list() == [TID]
+    assert data.get_instance_list(TID) == [IID]
+    assert round_trips == ["get_members", "is_member", "get_members"]
+
+
+def test_round_trips(round_trips, adm_type_good, adm_instance_good):
+    """
+    guards the number of SDL round trips of the hot paths
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instance(TID, IID, adm_instance_good)
+    data.set_policy_instance_status(TID, IID, "h1", "OK")
+    data.set_policy_instance_status(TID, IID, "h2", "NOTOK")
+
+    del round_trips[:]
+    assert data.get_policy_instance(TID, IID) == adm_instance_good
+    assert len(round_trips) == 1
+
+    del round_trips[:]
+    assert data.get_policy_instance_status(TID, IID)["instance_status"] == "IN EFFECT"
+    assert len(round_trips) == 1  # metadata and status aggregate
+
+    del round_trips[:]
+    data.set_policy_instance_status(TID, IID, "h2", "OK")
+    assert len(round_trips) == 2  # read and write of the handler status and aggregate; h2 is already indexed
+
+    del round_trips[:]
+    data.set_policy_instance_status(TID, IID, "h2", "OK")
+    assert len(round_trips) == 1  # unchanged, nothing to write
+
+    # errors still tell a missing type from a missing instance
+    with pytest.raises(PolicyInstanceNotFound):
+        data.get_policy_instance_status(TID, "nope")
+    with pytest.raises(PolicyTypeNotFound):
+        data.get_policy_instance_status(TID + 1, IID)
+
+    # a bulk delete costs the same whatever the number of instances, handlers or not
+    counts = []
+    for n in (1, 5):
+        ids = ["bulk{0}.{1}".format(n, i) for i in range(n)]
+        data.store_policy_instances(TID, {i: adm_instance_good for i in ids})
+        data.set_policy_instance_status(TID, ids[0], "h1", "OK")
+        del round_trips[:]
+        assert data.delete_policy_instances(TID, ids + ["nope"]) == ids
+        counts.append(len(round_trips))
+    assert counts == [4, 4]
+
+
+def test_status_batches(round_trips, adm_type_good, adm_instance_good):
+    """
+    a batch of statuses is validated and read in one round trip and written in one more; unchanged ones are skipped
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instances(TID, {"a": adm_instance_good, "b": adm_instance_good})
+    data.set_policy_instance_status(TID, "a", "h1", "OK")
+
+    def count(result):
+        return data.status_write_counters.labels(result=result)._value.get()
+
+    written, skipped = count("written"), count("skipped")
+    del round_trips[:]
+    missing = data.set_policy_instance_statuses([
+        (TID, "a", "h1", "OK"),  # unchanged
+        (TID, "a", "h2", "NOTOK"),
+        (TID, "b", "h1", "NOTOK"),
+        (TID, "b", "h1", "OK"),  # the last status of a handler wins
+        (TID, "nope", "h1", "OK"),
+        (TID + 1, "a", "h1", "OK"),
+    ])
+    assert missing == {(TID, "nope"), (TID + 1, "a")}
+    assert round_trips == ["get", "set", "add_member", "add_member"]  # the new handlers of a and b are indexed
+    assert count("written") - written == 2
+    assert count("skipped") - skipped == 2
+
+    assert data.get_policy_instance_status(TID, "b")["instance_status"] == "IN EFFECT"
+    agg = data.SDL.get(data.A1NS, data._generate_status_key(TID, "a"))
+    assert (agg["handlers"], agg["ok"]) == (2, 1)
+
+    del round_trips[:]
+    assert data.set_policy_instance_statuses([(TID, "a", "h1", "OK"), (TID, "b", "h1", "OK")]) == set()
+    assert round_trips == ["get"]
+
+
+def test_bulk_round_trips(round_trips, adm_type_good, adm_instance_good):
+    """
+    bulk writes take the same number of round trips however many instances they write
+    """
+    data.store_policy_type(TID, adm_type_good)
+    instances = {str(i): adm_instance_good for i in range(50)}
+
+    del round_trips[:]
+    assert set(data.store_policy_instances(TID, instances).values()) == {"CREATE"}
+    assert len(round_trips) == 4  # type check, metadata, instances and metadata, index
+    assert data.get_instance_list(TID) == sorted(instances)
+
+    data.set_policy_instance_status(TID, "7", "h1", "OK")
+    assert set(data.store_policy_instances(TID, instances).values()) == {"UPDATE"}
+    assert data.get_policy_instance_status(TID, "7")["instance_status"] == "NOT IN EFFECT"
+
+    del round_trips[:]
+    assert data.delete_policy_instances(TID, ["1", "2", "nope"]) == ["1", "2"]
+    assert len(round_trips) == 4  # type check, metadata and status aggregates read, metadata write, pending deletes
+    assert data.get_policy_instance_status(TID, "1")["has_been_deleted"]
+
+
+def test_instance_pages(fake_sdl, adm_type_good, adm_instance_good):
+    """
+    a page continues after the last id of the previous page, even if instances came or went in between
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instances(TID, {i: adm_instance_good for i in "abcde"})
+
+    assert data.get_instance_page(TID, 2) == (["a", "b"], "b")
+    data.store_policy_instance(TID, "bb", adm_instance_good)
+    assert data.get_instance_page(TID, 2, "b") == (["bb", "c"], "c")
+    assert data.get_instance_page(TID, 2, "c") == (["d", "e"], None)
+    assert data.get_instance_page(TID) == (["a", "b", "bb", "c", "d", "e"], None)
+    with pytest.raises(PolicyTypeNotFound):
+        data.get_instance_page(TID + 1, 2)
+
+
+def test_pages_reuse_ids(round_trips, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    the pages after the first reuse the ids the first read, until they change here or get old
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instances(TID, {i: adm_instance_good for i in "abcde"})
+
+    assert data.get_instance_page(TID, 2) == (["a", "b"], "b")
+    del round_trips[:]
+    assert data.get_instance_page(TID, 2, "b") == (["c", "d"], "d")
+    assert "get_members" not in round_trips
+    assert data.get_type_page(1) == ([TID], None)
+
+    # a change made by another replica, behind the back of this one, shows up once the ids get old
+    data.SDL._sdl._storage.add_member(data.A1NS, data._generate_instance_index(TID), {msgpack.packb("dd", use_bin_type=True)})
+    assert data.get_instance_page(TID, 2, "d") == (["e"], None)
+    monkeypatch.setattr(data, "ID_LIST_TTL", 0)
+    assert data.get_instance_page(TID, 2, "d") == (["dd", "e"], None)
+
+
+def test_type_statuses(round_trips, adm_type_good, adm_instance_good):
+    """
+    the statuses of a whole type come from one read of its metadata and status aggregates
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instances(TID, {i: adm_instance_good for i in ["a", "a.b", "c", "d"]})
+    data.set_policy_instance_status(TID, "a", "h1", "NOTOK")
+    data.set_policy_instance_status(TID, "a.b", "h.1", "OK")  # dots in both the instance and handler ids
+    data.set_policy_instance_status(TID, "c", "h1", "NOTOK")
+    data.set_policy_instance_status(TID, "c", "h2", "OK")
+    data.delete_policy_instance(TID, "d")
+
+    del round_trips[:]
+    statuses = data.get_type_statuses(TID)
+    assert len(round_trips) == 3  # type check, instance ids, metadata and aggregates
+    assert [(s["policy_instance_id"], s["instance_status"], s["has_been_deleted"]) for s in statuses] == [
+        ("a", "NOT IN EFFECT", False), ("a.b", "IN EFFECT", False), ("c", "IN EFFECT", False), ("d", "NOT IN EFFECT", True)
+    ]
+    for s in statuses:
+        assert {k: v for k, v in s.items() if k != "policy_instance_id"} == data.get_policy_instance_status(TID, s["policy_instance_id"])
+
+    assert [s["policy_instance_id"] for s in data.get_type_statuses(TID, "NOT IN EFFECT", False)] == ["a"]
+    assert [s["policy_instance_id"] for s in data.get_type_statuses(TID, has_been_deleted=True)] == ["d"]
+    with pytest.raises(PolicyTypeNotFound):
+        data.get_type_statuses(TID + 1)
+
+
+def _wait_for_deletions(fake_sdl, seconds=5):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        if fake_sdl.get_members(data.A1NS, data.PENDING_DELETE_INDEX) == set():
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_scheduled_delete(fake_sdl, monkeypatch, adm_type_good, adm_instance_good):
+    """
+    a deleted instance is removed by the deletion scheduler once its timer expires
+    """
+    monkeypatch.setattr(data, "INSTANCE_DELETE_NO_RESP_TTL", 0)
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instance(TID, IID, adm_instance_good)
+    data.set_policy_instance_status(TID, IID, "h1", "OK")
+    monkeypatch.setattr(data, "INSTANCE_DELETE_RESP_TTL", 0)
+    data.delete_policy_instance(TID, IID)
+
+    assert _wait_for_deletions(fake_sdl)
+    assert data.get_instance_list(TID) == []
+    assert fake_sdl.find_keys(data.A1NS, "a1.policy_inst") == []
+    assert fake_sdl.find_keys(data.A1NS, "a1.policy_handler") == []
+
+
+def test_resume_deletions(fake_sdl, adm_type_good, adm_instance_good):
+    """
+    deletions persisted by a process that went away are picked up again
+    """
+    data.store_policy_type(TID, adm_type_good)
+    for iid in ["deleted", "recreated"]:
+        data.store_policy_instance(TID, iid, adm_instance_good)
+        fake_sdl.set(data.A1NS, data._generate_instance_metadata_key(TID, iid), {"created_at": 0, "has_been_deleted": True, "deleted_at": 1})
+        data._add_members(data.PENDING_DELETE_INDEX, [json.dumps([TID, iid, 1])])
+    # PUT again after the DELETE; this one must survive
+    data.store_policy_instance(TID, "recreated", adm_instance_good)
+
+    assert data.resume_deletions() == 2
+    assert _wait_for_deletions(fake_sdl)
+    assert data.get_instance_list(TID) == ["recreated"]
+    assert data.get_policy_instance(TID, "recreated") == adm_instance_good
+
+
+def test_instances_in_batches(round_trips, adm_type_good, adm_instance_good):
+    """
+    a replay reads instances a batch at a time
+    """
+    data.store_policy_type(TID, adm_type_good)
+    for i in range(5):
+        data.store_policy_instance(TID, str(i), dict(adm_instance_good, window_length=20 + i))
+
+    del round_trips[:]
+    batches = list(data.get_encoded_instances_in_batches(TID, 2))
+    assert [[iid for iid, _ in b] for b in batches] == [["0", "1"], ["2", "3"], ["4"]]
+    assert json.loads(batches[2][0][1])["window_length"] == 24
+    assert len(round_trips) == 2 + 3  # type check, instance ids, one read per batch
+
+    with pytest.raises(PolicyTypeNotFound):
+        data.get_encoded_instances_in_batches(TID + 1, 2)
+
+
+def test_encoded_instances(fake_sdl, adm_type_good, adm_instance_good):
+    """
+    an instance is encoded once when stored, and that encoding is reused until it changes
+    """
+    data.store_policy_type(TID, adm_type_good)
+    data.store_policy_instance(TID, IID, adm_instance_good)
+    encoded = data.encode_policy_instance(TID, IID, adm_instance_good)
+    assert json.loads(encoded) == adm_instance_good
+
+    # reused for the stored object, and for a copy read back along with its metadata
+    assert data.encode_policy_instance(TID, IID, adm_instance_good) is encoded
+    assert [b for b in data.get_encoded_instances_in_batches(TID, 10)] == [[(IID, encoded)]]
+
+    # a replaced instance is encoded again, even when it compares equal to the old one
+    changed = dict(adm_instance_good, enforce=1)
+    data.store_policy_instance(TID, IID, changed)
+    assert json.loads(next(data.get_encoded_instances_in_batches(TID, 10))[0][1])["enforce"] is not True
+    assert json.loads(data.encode_policy_instance(TID, IID, adm_instance_good))["enforce"] is True
+
+
+def test_encoded_messages(monkeypatch):
+    """
+    a message built around an encoded payload is the same as one encoded whole, with or without orjson
+    """
+    for backend in (messages.orjson, None):
+        monkeypatch.setattr(messages, "orjson", backend)
+        payload = {"class": 12, "big": 2 ** 70, "name": "caf\u00e9"}
+        encoded = messages.a1_to_handler_bytes("CREATE", TID, IID, messages.dumps(payload))
+        assert json.loads(encoded) == messages.a1_to_handler("CREATE", TID, IID, payload)
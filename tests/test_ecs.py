@@ -0,0 +1,129 @@
+"""
+tests for the ecs client and the ei handling of the rmr loop
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import time
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread, Event
+import pytest
+from ricxappframe.rmr.rmr_mocks import rmr_mocks
+from a1 import a1rmr, ecs
+
+ECS_DELAY = 1
+EI_TYPES = b'["ei_type_1"]'
+
+
+class _StubEcs(BaseHTTPRequestHandler):
+    """answers like the ECS, but slowly"""
+
+    def do_GET(self):
+        time.sleep(ECS_DELAY)
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(EI_TYPES)))
+        self.end_headers()
+        self.wfile.write(EI_TYPES)
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        time.sleep(ECS_DELAY)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+@pytest.fixture
+def stub_ecs(monkeypatch):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubEcs)
+    Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr(ecs, "ECS_SERVICE_HOST", "http://127.0.0.1:{0}".format(server.server_port))
+    yield
+    server.shutdown()
+
+
+def test_slow_ecs_does_not_hold_up_policy_traffic(monkeypatch, stub_ecs):
+    """
+    ei messages are answered when the ecs answers, while the status update behind them is handled right away
+    """
+    rmr_mocks.patch_rmr(monkeypatch)
+    events = []
+    answered = Event()
+
+    def rts_and_record(_mrc, sbuf, payload=None, mtype=None):
+        events.append(("rts", mtype, payload))
+        if len([e for e in events if e[0] == "rts"]) == 2:
+            answered.set()
+        return rmr_mocks.send_mock_generator(0)(_mrc, sbuf)
+
+    def record_statuses(statuses):
+        events.extend(("status",) + tuple(status) for status in statuses)
+        return set()
+
+    monkeypatch.setattr("ricxappframe.rmr.rmr.rmr_rts_msg", rts_and_record)
+    monkeypatch.setattr("a1.data.set_policy_instance_statuses", record_statuses)
+
+    job = json.dumps({"job-id": "job1", "ei_type_id": "ei_type_1"}).encode()
+    status = json.dumps({"policy_type_id": 1, "policy_instance_id": "a", "handler_id": "h", "status": "OK"}).encode()
+    batches = [[
+        ({"payload": b"", "message type": a1rmr.A1_EI_QUERY_ALL}, rmr_mocks.Rmr_mbuf_t()),
+        ({"payload": job, "message type": a1rmr.A1_EI_CREATE_JOB}, rmr_mocks.Rmr_mbuf_t()),
+        ({"payload": status, "message type": a1rmr.A1_POLICY_RESPONSE}, None),
+    ]]
+
+    loop = a1rmr._RmrLoop(init_func_override=lambda: None, rcv_func_override=lambda: batches.pop() if batches else [])
+    try:
+        assert answered.wait(ECS_DELAY + 5)
+    finally:
+        loop.stop()  # while rmr is still patched
+
+    # the status update did not wait for the ecs
+    assert events[0] == ("status", 1, "a", "h", "OK")
+    answers = {mtype: payload for _, mtype, payload in events[1:]}
+    assert answers[a1rmr.AI_EI_QUERY_ALL_RESP] == EI_TYPES
+    assert json.loads(answers[a1rmr.A1_EI_CREATE_JOB_RESP]) == {"ei_job_id": "job1"}
+
+
+def test_submit_limit():
+    """
+    work beyond the pending limit is refused rather than queued
+    """
+    client = ecs.EcsClient(workers=1, max_pending=2)
+    release = Event()
+    try:
+        assert client.submit(release.wait)
+        assert client.submit(release.wait)
+        assert not client.submit(release.wait)
+    finally:
+        release.set()
+        client.shutdown()
+
+
+def test_worker_count(monkeypatch):
+    """
+    the pool has as many workers as the session keeps connections, A1_ECS_WORKERS by default
+    """
+    monkeypatch.setattr(ecs, "ECS_WORKERS", 2)
+    client = ecs.EcsClient()
+    try:
+        assert client._executor._max_workers == 2
+        assert client.session.get_adapter("http://ecs").poolmanager.connection_pool_kw["maxsize"] == 2
+    finally:
+        client.shutdown()
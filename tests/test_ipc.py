@@ -0,0 +1,85 @@
+"""
+tests for the calls between the processes of one A1
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import time
+import pytest
+from a1 import ipc
+from a1.exceptions import QueueFull, RmrUnavailable
+
+
+def _full(_item):
+    raise QueueFull("the test queue is full")
+
+
+def test_calls(tmp_path):
+    """
+    results come back, and so do the exceptions the caller knows how to answer; the others make the owner unavailable
+    """
+    path = str(tmp_path / "owner.sock")
+    queued = []
+    server = ipc.Server(path, {"queue": lambda items: queued.extend(tuple(i) for i in items) or len(queued), "full": _full})
+    client = ipc.Client(path)
+    try:
+        assert client.call("queue", [("CREATE", 1, "a", {"v": 1})]) == 1
+        assert client.call("queue", [("DELETE", 1, "a", ""), ("DELETE", 1, "b", "")]) == 3
+        assert queued[0] == ("CREATE", 1, "a", {"v": 1})
+        with pytest.raises(QueueFull):
+            client.call("full", [])
+        with pytest.raises(RmrUnavailable):
+            client.call("nope")
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_no_retry_once_sent(tmp_path):
+    """
+    a call the server got, but did not answer in time, is not made again
+    """
+    path = str(tmp_path / "owner.sock")
+    calls = []
+    server = ipc.Server(path, {"slow": lambda: calls.append(1) or time.sleep(0.5)})
+    client = ipc.Client(path, timeout=0.1)
+    try:
+        with pytest.raises(RmrUnavailable):
+            client.call("slow")
+        time.sleep(0.5)
+        assert calls == [1]
+    finally:
+        client.close()
+        server.stop()
+
+
+def test_server_restart(tmp_path):
+    """
+    a client carries on once the server is back, and says the server is unavailable meanwhile
+    """
+    path = str(tmp_path / "owner.sock")
+    server = ipc.Server(path, {"ping": lambda: "pong"})
+    client = ipc.Client(path, timeout=1)
+    assert client.call("ping") == "pong"
+    server.stop()
+    with pytest.raises(RmrUnavailable):
+        client.call("ping")
+    server = ipc.Server(path, {"ping": lambda: "pong again"})
+    try:
+        assert client.call("ping") == "pong again"
+    finally:
+        client.close()
+        server.stop()
@@ -0,0 +1,167 @@
+"""
+tests for the bounded queues
+"""
+# ==================================================================================
+#       Copyright (c) 2019-2020 Nokia
+#       Copyright (c) 2018-2020 AT&T Intellectual Property.
+#
+#   Licensed under the Apache License, Version 2.0 (the "License");
+#   you may not use this file except in compliance with the License.
+#   You may obtain a copy of the License at
+#
+#          http://www.apache.org/licenses/LICENSE-2.0
+#
+#   Unless required by applicable law or agreed to in writing, software
+#   distributed under the License is distributed on an "AS IS" BASIS,
+#   WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#   See the License for the specific language governing permissions and
+#   limitations under the License.
+# ==================================================================================
+import queue
+import threading
+import pytest
+from ricxappframe.xapp_sdl import SDLWrapper
+from a1 import data, queues, a1rmr
+from a1.exceptions import QueueFull
+
+
+@pytest.fixture
+def fake_sdl(monkeypatch):
+    """
+    a fresh, empty fake SDL for every test
+    """
+    sdl = SDLWrapper(use_fake_sdl=True)
+    monkeypatch.setattr(data, "SDL", sdl)
+    yield sdl
+
+
+def _drain(q):
+    out = []
+    while True:
+        try:
+            out.append(q.get())
+        except queue.Empty:
+            return out
+
+
+def _overflows(name, policy):
+    return queues.overflow_counter.labels(queue=name, policy=policy)._value.get()
+
+
+def test_reject():
+    """
+    a full rejecting queue raises, and says so before any work is done
+    """
+    q = queues.FifoQueue("test_reject", 2, queues.REJECT)
+    q.put((1,))
+    q.check_room()
+    q.put((2,))
+    with pytest.raises(QueueFull):
+        q.check_room()
+    with pytest.raises(QueueFull):
+        q.put((3,))
+    assert _drain(q) == [(1,), (2,)]
+    assert _overflows("test_reject", queues.REJECT) == 2
+
+
+def test_drop_oldest():
+    """
+    a full queue makes room by dropping its oldest entry; checking for room never fails
+    """
+    q = queues.FifoQueue("test_drop", 2, queues.DROP_OLDEST)
+    for i in range(5):
+        q.check_room()
+        q.put((i,))
+    assert _drain(q) == [(3,), (4,)]
+    assert _overflows("test_drop", queues.DROP_OLDEST) == 3
+
+
+def test_spill(fake_sdl):
+    """
+    entries beyond the bound go to SDL and come back in order; later entries queue behind them
+    """
+    q = queues.FifoQueue("test_spill", 2, queues.SPILL)
+    for i in range(5):
+        q.put((i, "x"))
+    assert q.qsize() == 2
+    assert not q.empty()
+    assert len(fake_sdl.find_keys(data.A1NS, data.SPILL_PREFIX)) == 3
+
+    assert q.get() == (0, "x")
+    assert q.get() == (1, "x")
+    q.put((5, "x"))  # there is room in memory again, but 2 .. 4 are still spilled
+    assert _drain(q) == [(i, "x") for i in range(2, 6)]
+    assert q.empty()
+    assert fake_sdl.find_keys(data.A1NS, data.SPILL_PREFIX) == []
+
+    # a new queue, eg after a restart, picks up what an old one spilled
+    q.put((6, "x"))
+    q.put((7, "x"))
+    q.put((8, "x"))
+    assert _drain(queues.FifoQueue("test_spill", 2, queues.SPILL)) == [(8, "x")]
+
+
+def test_unspill(fake_sdl, monkeypatch):
+    """
+    draining a spill scans SDL once, not once per batch, claims each entry so that replicas sharing the SDL never
+    both take one, and reads back without holding up puts
+    """
+    monkeypatch.setattr(queues, "UNSPILL_BATCH_SIZE", 10)
+    q = queues.FifoQueue("test_unspill", 1, queues.SPILL)
+    for i in range(51):
+        q.put((i,))
+    other = queues.FifoQueue("test_unspill", 1, queues.SPILL)  # another replica, found the 50 spilled at startup
+
+    scans = []
+    real_find_keys = fake_sdl.find_keys
+    monkeypatch.setattr(fake_sdl, "find_keys", lambda *args: scans.append(args) or real_find_keys(*args))
+    real_take = data.take_spilled_entries
+
+    def take_while_putting(keys):
+        putter = threading.Thread(target=q.put, args=((51,),))
+        putter.start()
+        putter.join(timeout=1)
+        assert not putter.is_alive()
+        monkeypatch.setattr(data, "take_spilled_entries", real_take)
+        return real_take(keys)
+
+    monkeypatch.setattr(data, "take_spilled_entries", take_while_putting)
+    assert q.get() == (0,)
+    assert q.get() == (1,)  # the first batch
+    taken = _drain(other) + _drain(q)
+    assert sorted(taken) == [(i,) for i in range(2, 52)]
+    assert _drain(q) == [] and _drain(other) == []
+    assert len(scans) <= 3  # a rescan by each queue once its known keys ran out, and maybe one more
+    assert fake_sdl.find_keys(data.A1NS, data.SPILL_PREFIX) == []
+
+
+def test_spilled_instance_sends(fake_sdl):
+    """
+    instance messages are merged only until the queue spills, so they never overtake a spilled message
+    """
+    q = a1rmr._InstanceSendQueue(1, queues.SPILL)
+    q.put((("CREATE", 1, "a", {"v": 1}), 1.0))
+    q.put((("UPDATE", 1, "b", {"v": 1}), 2.0))  # spilled
+    q.put((("UPDATE", 1, "a", {"v": 2}), 3.0))  # spilled too, not merged
+    assert _drain(q) == [
+        (("CREATE", 1, "a", {"v": 1}), 1.0), (("UPDATE", 1, "b", {"v": 1}), 2.0), (("UPDATE", 1, "a", {"v": 2}), 3.0)
+    ]
+
+
+def test_spilled_instance_sends_merge(fake_sdl):
+    """
+    messages for one instance that were spilled one after the other are merged when read back
+    """
+    q = a1rmr._InstanceSendQueue(2, queues.SPILL)
+    q.put((("CREATE", 1, "x", {"v": 1}), 1.0))
+    q.put((("CREATE", 1, "y", {"v": 1}), 2.0))
+    q.put((("DELETE", 1, "a", {}), 3.0))  # spilled
+    q.put((("CREATE", 1, "a", {"v": 2}), 4.0))  # spilled too
+    assert _drain(q) == [
+        (("CREATE", 1, "x", {"v": 1}), 1.0), (("CREATE", 1, "y", {"v": 1}), 2.0), (("UPDATE", 1, "a", {"v": 2}), 3.0)
+    ]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        queues.FifoQueue("test_unknown", 1, "block")